@@ -7,21 +7,75 @@ import os
 load_dotenv()
 
 # Importar componentes
-from src.infrastructure.database import db
+from src.infrastructure.database import (
+    db, prepare_schema, configure_id_storage, shard_bind_key, replica_bind_key, configure_replicas
+)
 from src.infrastructure.sqlalchemy_repositories import (
     SQLAlchemyUserRepository,
     SQLAlchemyBloodTestRepository,
     SQLAlchemyChatConversationRepository,
-    SQLAlchemyChatMessageRepository
+    SQLAlchemyChatMessageRepository,
+    SQLAlchemyCohortRiskRepository,
+    SQLAlchemyAnalyteTrendRepository,
+    SQLAlchemyMessageSearchRepository,
+    SQLAlchemyConversationArchiveRepository,
+    SQLAlchemyRetentionRepository
 )
 from src.infrastructure.gemini_service import GeminiService
+from src.infrastructure.reference_ranges import ReferenceRangeRegistry
+from src.infrastructure.conversation_archive import resolve_codec
+from src.infrastructure.sharding import (
+    ShardRouter,
+    prepare_shards,
+    ShardedUserRepository,
+    ShardedBloodTestRepository,
+    ShardedChatConversationRepository,
+    ShardedChatMessageRepository,
+    ShardedMessageSearchRepository,
+    ShardedCohortRiskRepository,
+    ShardedAnalyteTrendRepository,
+    ShardedConversationArchiveRepository,
+    ShardedRetentionRepository
+)
+from src.infrastructure.replicas import (
+    ReplicaReadRouter,
+    create_stickiness_store,
+    ReplicaUserRepository,
+    ReplicaBloodTestRepository,
+    ReplicaChatConversationRepository,
+    ReplicaChatMessageRepository,
+    ReplicaAnalyteTrendRepository
+)
+from src.domain.services import BloodTestAnalysisService
 from src.application.use_cases import (
     CreateUserUseCase,
     AnalyzeBloodTestUseCase,
     ChatWithUserUseCase,
-    GetUserHistoryUseCase
+    GetUserHistoryUseCase,
+    BulkImportUseCase,
+    ExportUserRecordsUseCase,
+    ExportBloodTestsToParquetUseCase,
+    CohortAnalyticsUseCase,
+    RebuildAnalyteTrendsUseCase,
+    SearchMessagesUseCase,
+    ArchiveIdleConversationsUseCase,
+    RepairConversationCountersUseCase,
+    PurgeExpiredDataUseCase
+)
+from src.infrastructure.profiling import ProfileStore, RequestProfiler
+from src.infrastructure.rate_limiting import (
+    SlidingWindowRateLimiter, AdmissionController, SharedAdmissionController, create_rate_limit_store
 )
-from src.presentation.controllers import UserController, ChatController, create_api
+from src.infrastructure.shared_state import SharedStateStore
+from src.infrastructure.traffic_capture import TrafficCaptureLog
+from src.presentation.controllers import (
+    UserController, ChatController, AdminController, AnalyticsController, SearchController, create_api
+)
+from src.presentation.monitoring import register_monitoring, register_profiling
+from src.presentation.http_caching import register_compression
+from src.presentation.load_control import register_load_control
+from src.presentation.websocket import register_chat_websocket
+from src.presentation.cli import register_commands
 
 def create_app():
     """Factory para crear la aplicación Flask"""
@@ -32,22 +86,167 @@ def create_app():
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
     
+    # Arranque diferido: el cliente de Gemini se configura en la primera llamada y el esquema solo
+    # se revisa si cambió su versión (acelera el arranque de workers y el autoescalado)
+    app.config['LAZY_INIT'] = os.getenv('LAZY_INIT', 'False').lower() == 'true'
+    
+    # Shards adicionales (separados por comas); DATABASE_URL es el shard 0. Los datos de cada
+    # paciente viven en un solo shard según su user_id
+    shard_urls = [url.strip() for url in os.getenv('SHARD_DATABASE_URLS', '').split(',') if url.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {shard_bind_key(index): url for index, url in enumerate(shard_urls, start=1)}
+    app.config['SHARD_COUNT'] = len(shard_urls) + 1
+    
+    # Réplicas de lectura para historial y conversaciones: REPLICA_DATABASE_URLS (separadas por
+    # comas) son las de DATABASE_URL; SHARD_REPLICA_DATABASE_URLS, las de cada shard adicional,
+    # en el mismo orden que SHARD_DATABASE_URLS y con los grupos separados por ';'
+    replica_groups = [os.getenv('REPLICA_DATABASE_URLS', '')] + os.getenv('SHARD_REPLICA_DATABASE_URLS', '').split(';')
+    replica_urls = {
+        shard: [url.strip() for url in group.split(',') if url.strip()]
+        for shard, group in enumerate(replica_groups[:app.config['SHARD_COUNT']])
+    }
+    for shard, urls in replica_urls.items():
+        app.config['SQLALCHEMY_BINDS'].update({replica_bind_key(shard, index): url for index, url in enumerate(urls)})
+    app.config['REPLICA_COUNTS'] = {shard: len(urls) for shard, urls in replica_urls.items() if urls}
+    # Segundos que las lecturas de un paciente van al primario después de que escribe
+    app.config['REPLICA_STICKY_SECONDS'] = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+    app.config['REPLICA_STICKY_STORAGE_URL'] = os.getenv('REPLICA_STICKY_STORAGE_URL', os.getenv('RATE_LIMIT_STORAGE_URL'))
+    
+    # Formato de los identificadores en la base: 'string' (CHAR 36) o 'binary' (BINARY 16, solo bases nuevas)
+    app.config['ID_STORAGE'] = os.getenv('ID_STORAGE', 'string')
+    
+    # Serialización de respuestas con modelos precompilados y orjson
+    app.config['FAST_JSON_RESPONSES'] = os.getenv('FAST_JSON_RESPONSES', 'False').lower() == 'true'
+    
+    # Compresión gzip/brotli de respuestas a partir de este tamaño (bytes)
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+    
+    # Exámenes recientes usados para la pendiente de cada tendencia por analito
+    app.config['TREND_WINDOW'] = int(os.getenv('TREND_WINDOW', 5))
+    
+    # Filas por lote al exportar expedientes en NDJSON
+    app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+    
+    # Exportación columnar (Parquet) para el equipo de datos
+    app.config['PARQUET_EXPORT_DIR'] = os.getenv('PARQUET_EXPORT_DIR', 'exports/blood_tests')
+    app.config['PARQUET_BATCH_SIZE'] = int(os.getenv('PARQUET_BATCH_SIZE', 5000))
+    
+    # Ruleset de rangos de referencia (JSON versionado); se recarga si el archivo cambia
+    app.config['REFERENCE_RANGES_PATH'] = os.getenv('REFERENCE_RANGES_PATH')
+    app.config['REFERENCE_RANGES_RELOAD_SECONDS'] = float(os.getenv('REFERENCE_RANGES_RELOAD_SECONDS', 5))
+    
+    # Archivo comprimido de conversaciones inactivas (flask --app app archive-conversations)
+    app.config['ARCHIVE_IDLE_DAYS'] = int(os.getenv('ARCHIVE_IDLE_DAYS', 90))
+    app.config['ARCHIVE_BATCH_SIZE'] = int(os.getenv('ARCHIVE_BATCH_SIZE', 50))
+    app.config['ARCHIVE_BATCH_PAUSE_SECONDS'] = float(os.getenv('ARCHIVE_BATCH_PAUSE_SECONDS', 0.1))
+    app.config['ARCHIVE_CODEC'] = os.getenv('ARCHIVE_CODEC')  # 'zstd' (requiere zstandard) o 'zlib'
+    
+    # Políticas de retención (flask --app app purge-expired-data); sin valor no se aplican
+    app.config['RETENTION_MESSAGE_DAYS'] = int(os.environ['RETENTION_MESSAGE_DAYS']) if os.getenv('RETENTION_MESSAGE_DAYS') else None
+    app.config['RETENTION_INACTIVE_USER_DAYS'] = (
+        int(os.environ['RETENTION_INACTIVE_USER_DAYS']) if os.getenv('RETENTION_INACTIVE_USER_DAYS') else None
+    )
+    app.config['RETENTION_CHUNK_SIZE'] = int(os.getenv('RETENTION_CHUNK_SIZE', 500))
+    app.config['RETENTION_MAX_SECONDS'] = float(os.getenv('RETENTION_MAX_SECONDS', 60))
+    app.config['RETENTION_MAX_ROWS'] = int(os.getenv('RETENTION_MAX_ROWS', 100000))
+    
+    # Límites de tasa y control de admisión de las rutas que usan el LLM
+    app.config['RATE_LIMIT_ENABLED'] = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+    app.config['RATE_LIMIT_STORAGE_URL'] = os.getenv('RATE_LIMIT_STORAGE_URL')
+    app.config['RATE_LIMIT_USER_PER_MINUTE'] = int(os.getenv('RATE_LIMIT_USER_PER_MINUTE', 20))
+    app.config['RATE_LIMIT_IP_PER_MINUTE'] = int(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 60))
+    app.config['LLM_MAX_IN_FLIGHT'] = int(os.getenv('LLM_MAX_IN_FLIGHT', 8))
+    
+    # Servidor pre-fork (flask --app app serve) y estado compartido entre sus workers
+    app.config['SERVE_HOST'] = os.getenv('SERVE_HOST', '0.0.0.0')
+    app.config['SERVE_PORT'] = int(os.getenv('PORT', 5000))
+    app.config['SERVE_WORKERS'] = int(os.getenv('SERVE_WORKERS', os.cpu_count() or 1))
+    app.config['SERVE_THREADS'] = int(os.getenv('SERVE_THREADS', 16))
+    app.config['SERVE_GRACEFUL_TIMEOUT'] = float(os.getenv('SERVE_GRACEFUL_TIMEOUT', 30))
+    app.config['SERVE_MAX_REQUESTS'] = int(os.getenv('SERVE_MAX_REQUESTS', 0))
+    app.config['SHARED_STATE_PATH'] = os.getenv('SHARED_STATE_PATH')
+    
+    # Trazas por petición (exportadas a JSONL)
+    app.config['TRACING_ENABLED'] = os.getenv('TRACING_ENABLED', 'False').lower() == 'true'
+    app.config['TRACE_EXPORT_PATH'] = os.getenv('TRACE_EXPORT_PATH', 'traces.jsonl')
+    app.config['TRACE_SAMPLE_RATE'] = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+    app.config['TRACE_SLOW_THRESHOLD_MS'] = float(os.getenv('TRACE_SLOW_THRESHOLD_MS', 2000))
+    
+    # Captura anonimizada del tráfico de /api (NDJSON con rotación) para reproducirlo con benchmarks/replay.py
+    app.config['TRAFFIC_CAPTURE_ENABLED'] = os.getenv('TRAFFIC_CAPTURE_ENABLED', 'False').lower() == 'true'
+    app.config['TRAFFIC_CAPTURE_PATH'] = os.getenv('TRAFFIC_CAPTURE_PATH', 'traffic/capture.ndjson')
+    app.config['TRAFFIC_CAPTURE_MAX_BYTES'] = int(os.getenv('TRAFFIC_CAPTURE_MAX_BYTES', 50 * 1024 * 1024))
+    app.config['TRAFFIC_CAPTURE_BACKUPS'] = int(os.getenv('TRAFFIC_CAPTURE_BACKUPS', 5))
+    app.config['TRAFFIC_CAPTURE_SALT'] = os.getenv('TRAFFIC_CAPTURE_SALT')
+    
+    # Administración y perfilado bajo demanda
+    app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', 'profiles')
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_MAX_FILES'] = int(os.getenv('PROFILE_MAX_FILES', 50))
+    
     # Inicializar extensiones
+    configure_id_storage(app.config['ID_STORAGE'])
+    configure_replicas(app.config['REPLICA_COUNTS'])
     db.init_app(app)
     CORS(app)
     
-    # Crear tablas
+    # Estado compartido entre los workers del servidor pre-fork (límites de tasa, cupos del LLM, lecturas del primario)
+    shared_state = SharedStateStore(app.config['SHARED_STATE_PATH']) if app.config['SHARED_STATE_PATH'] else None
+    
+    # Crear tablas y agregar columnas nuevas a las existentes (en cada shard)
+    shard_router = ShardRouter(app.config['SHARD_COUNT'])
     with app.app_context():
-        db.create_all()
+        if shard_router.shard_count == 1:
+            search_backend = prepare_schema(use_cache=app.config['LAZY_INIT'])
+        else:
+            search_backend = prepare_shards(shard_router, use_cache=app.config['LAZY_INIT'])
     
     # Inicializar repositorios
     user_repository = SQLAlchemyUserRepository()
     blood_test_repository = SQLAlchemyBloodTestRepository()
     conversation_repository = SQLAlchemyChatConversationRepository()
-    message_repository = SQLAlchemyChatMessageRepository()
+    search_repository = SQLAlchemyMessageSearchRepository(search_backend)
+    message_repository = SQLAlchemyChatMessageRepository(search_repository)
+    archive_repository = SQLAlchemyConversationArchiveRepository(
+        resolve_codec(app.config['ARCHIVE_CODEC']),
+        search_repository
+    )
+    retention_repository = SQLAlchemyRetentionRepository(search_repository)
+    cohort_repository = SQLAlchemyCohortRiskRepository()
+    trend_repository = SQLAlchemyAnalyteTrendRepository()
+    
+    if app.config['REPLICA_COUNTS']:
+        replica_router = ReplicaReadRouter(
+            create_stickiness_store(app.config['REPLICA_STICKY_STORAGE_URL'], shared_state),
+            app.config['REPLICA_STICKY_SECONDS']
+        )
+        message_repository = ReplicaChatMessageRepository(message_repository, replica_router, conversation_repository)
+        user_repository = ReplicaUserRepository(user_repository, replica_router)
+        blood_test_repository = ReplicaBloodTestRepository(blood_test_repository, replica_router)
+        conversation_repository = ReplicaChatConversationRepository(conversation_repository, replica_router)
+        trend_repository = ReplicaAnalyteTrendRepository(trend_repository, replica_router)
+    
+    if shard_router.shard_count > 1:
+        user_repository = ShardedUserRepository(user_repository, shard_router)
+        blood_test_repository = ShardedBloodTestRepository(blood_test_repository, shard_router)
+        conversation_repository = ShardedChatConversationRepository(conversation_repository, shard_router)
+        message_repository = ShardedChatMessageRepository(message_repository, shard_router)
+        search_repository = ShardedMessageSearchRepository(search_repository, shard_router)
+        archive_repository = ShardedConversationArchiveRepository(archive_repository, shard_router)
+        retention_repository = ShardedRetentionRepository(retention_repository, shard_router)
+        cohort_repository = ShardedCohortRiskRepository(cohort_repository, shard_router)
+        trend_repository = ShardedAnalyteTrendRepository(trend_repository, shard_router)
     
     # Inicializar servicios
-    gemini_service = GeminiService()
+    gemini_service = GeminiService(lazy=app.config['LAZY_INIT'])
+    # Acceso al servicio desde herramientas externas (p. ej. el LLM simulado de benchmarks/)
+    app.extensions['gemini_service'] = gemini_service
+    profile_store = ProfileStore(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_FILES'])
+    reference_ranges = ReferenceRangeRegistry(
+        app.config['REFERENCE_RANGES_PATH'],
+        app.config['REFERENCE_RANGES_RELOAD_SECONDS']
+    )
+    analysis_service = BloodTestAnalysisService(reference_ranges.current)
     
     # Inicializar casos de uso
     create_user_use_case = CreateUserUseCase(user_repository)
@@ -56,30 +255,134 @@ def create_app():
         blood_test_repository,
         conversation_repository,
         message_repository,
-        gemini_service
+        gemini_service,
+        trend_repository,
+        app.config['TREND_WINDOW'],
+        analysis_service
     )
     chat_with_user_use_case = ChatWithUserUseCase(
         user_repository,
         blood_test_repository,
         conversation_repository,
         message_repository,
-        gemini_service
+        gemini_service,
+        analysis_service
     )
     get_user_history_use_case = GetUserHistoryUseCase(
         user_repository,
         blood_test_repository,
-        conversation_repository
+        conversation_repository,
+        trend_repository
+    )
+    bulk_import_use_case = BulkImportUseCase(
+        user_repository,
+        blood_test_repository,
+        app.config['TREND_WINDOW'],
+        analysis_service
+    )
+    export_user_records_use_case = ExportUserRecordsUseCase(
+        user_repository,
+        blood_test_repository,
+        conversation_repository,
+        message_repository,
+        app.config['EXPORT_BATCH_SIZE']
+    )
+    export_blood_tests_use_case = ExportBloodTestsToParquetUseCase(
+        blood_test_repository,
+        app.config['PARQUET_BATCH_SIZE'],
+        analysis_service
+    )
+    cohort_analytics_use_case = CohortAnalyticsUseCase(
+        cohort_repository,
+        blood_test_repository,
+        analysis_service=analysis_service
+    )
+    search_messages_use_case = SearchMessagesUseCase(search_repository)
+    archive_conversations_use_case = ArchiveIdleConversationsUseCase(
+        archive_repository,
+        app.config['ARCHIVE_IDLE_DAYS'],
+        app.config['ARCHIVE_BATCH_SIZE'],
+        app.config['ARCHIVE_BATCH_PAUSE_SECONDS']
+    )
+    repair_counters_use_case = RepairConversationCountersUseCase(conversation_repository)
+    purge_expired_data_use_case = PurgeExpiredDataUseCase(
+        retention_repository,
+        app.config['RETENTION_MESSAGE_DAYS'],
+        app.config['RETENTION_INACTIVE_USER_DAYS'],
+        app.config['RETENTION_CHUNK_SIZE'],
+        app.config['RETENTION_MAX_SECONDS'],
+        app.config['RETENTION_MAX_ROWS']
+    )
+    rebuild_trends_use_case = RebuildAnalyteTrendsUseCase(
+        user_repository,
+        blood_test_repository,
+        trend_repository,
+        app.config['TREND_WINDOW']
     )
     
     # Factory functions para controladores
     def user_controller_factory():
-        return UserController(create_user_use_case, get_user_history_use_case)
+        return UserController(create_user_use_case, get_user_history_use_case, bulk_import_use_case,
+                              export_user_records_use_case)
     
     def chat_controller_factory():
         return ChatController(analyze_blood_test_use_case, chat_with_user_use_case)
     
+    def admin_controller_factory():
+        return AdminController(profile_store, export_user_records_use_case, reference_ranges)
+    
+    def analytics_controller_factory():
+        return AnalyticsController(cohort_analytics_use_case)
+    
+    def search_controller_factory():
+        return SearchController(search_messages_use_case)
+    
+    traffic_capture_log = None
+    if app.config['TRAFFIC_CAPTURE_ENABLED']:
+        traffic_capture_log = TrafficCaptureLog(
+            app.config['TRAFFIC_CAPTURE_PATH'],
+            app.config['TRAFFIC_CAPTURE_MAX_BYTES'],
+            app.config['TRAFFIC_CAPTURE_BACKUPS'],
+            app.config['TRAFFIC_CAPTURE_SALT']
+        )
+    
     # Crear API con Swagger
-    api = create_api(app, user_controller_factory, chat_controller_factory)
+    api = create_api(app, user_controller_factory, chat_controller_factory, admin_controller_factory,
+                     analytics_controller_factory, search_controller_factory, traffic_capture_log)
+    
+    # Métricas de latencia (Prometheus en /metrics) y trazas
+    register_monitoring(app)
+    
+    # Perfilado de peticiones (cProfile) por muestreo o con la cabecera X-Profile-Request
+    register_profiling(app, RequestProfiler(profile_store, app.config['PROFILE_SAMPLE_RATE']))
+    
+    # Compresión negociada de respuestas grandes
+    register_compression(app)
+    
+    # Límites de tasa por usuario/IP y descarte de carga (503 + Retry-After)
+    user_limiter = ip_limiter = admission = None
+    if app.config['RATE_LIMIT_ENABLED']:
+        rate_limit_store = create_rate_limit_store(app.config['RATE_LIMIT_STORAGE_URL'], shared_state)
+        user_limiter = SlidingWindowRateLimiter(rate_limit_store, app.config['RATE_LIMIT_USER_PER_MINUTE'])
+        ip_limiter = SlidingWindowRateLimiter(rate_limit_store, app.config['RATE_LIMIT_IP_PER_MINUTE'])
+        admission = (SharedAdmissionController(shared_state, app.config['LLM_MAX_IN_FLIGHT'])
+                     if shared_state is not None else AdmissionController(app.config['LLM_MAX_IN_FLIGHT']))
+        register_load_control(
+            app,
+            user_limiter=user_limiter,
+            ip_limiter=ip_limiter,
+            admission=admission,
+            resolve_conversation_owner=chat_with_user_use_case.get_conversation_owner
+        )
+    
+    # Comandos de línea de comandos (flask --app app <comando>, ver flask --app app --help)
+    register_commands(app, export_blood_tests_use_case, cohort_analytics_use_case, rebuild_trends_use_case,
+                      search_messages_use_case, archive_conversations_use_case, repair_counters_use_case,
+                      purge_expired_data_use_case, shared_state)
+    
+    # Chat por WebSocket con respuestas en streaming (requiere flask-sock)
+    if register_chat_websocket(app, chat_with_user_use_case, user_limiter, admission):
+        print("🔌 WebSocket de chat disponible en: ws://localhost:5000/api/chat/<conversation_id>/ws")
     
     print("🏥 Medical Chatbot API iniciada")
     print("📖 Documentación Swagger disponible en: http://localhost:5000/docs/")
@@ -0,0 +1,89 @@
+"""
+Benchmark de memoria de las entidades: dataclasses con __dict__ por instancia (como eran
+antes) frente a las entidades con __slots__ y al lote columnar BloodTestPanel.
+
+Uso:
+    python -m benchmarks.bench_entities --count 100000
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+import uuid
+from dataclasses import fields, make_dataclass
+from datetime import datetime, timedelta
+
+from src.domain.entities import User, BloodTest, BloodTestPanel, ChatMessage
+
+
+def unslotted(entity_class):
+    """Copia de la entidad como dataclass sin __slots__ (representación anterior)"""
+    return make_dataclass(f'Unslotted{entity_class.__name__}',
+                          [(field.name, field.type) for field in fields(entity_class)])
+
+
+def blood_test_rows(count: int):
+    """Filas en el orden de BloodTestPanel.ROW_FIELDS, con ids, valores y fechas distintos"""
+    random.seed(7)
+    now = datetime(2025, 1, 15, 8, 0, 0)
+    user_id = str(uuid.uuid4())
+    for index in range(count):
+        test_date = now - timedelta(minutes=index)
+        yield (str(uuid.uuid4()), user_id, *(random.uniform(1, 300) for _ in BloodTestPanel.ANALYTES),
+               test_date, test_date + timedelta(seconds=1))
+
+
+def user_rows(count: int):
+    now = datetime(2025, 1, 15, 8, 0, 0)
+    for index in range(count):
+        yield str(uuid.uuid4()), f'Paciente {index}', 20 + index % 60, 'female', now - timedelta(minutes=index)
+
+
+def message_rows(count: int):
+    now = datetime(2025, 1, 15, 8, 0, 0)
+    conversation_id = str(uuid.uuid4())
+    for index in range(count):
+        yield (str(uuid.uuid4()), conversation_id, f'Mensaje {index}', 'user' if index % 2 else 'assistant',
+               now - timedelta(seconds=index))
+
+
+def measure(build, rows) -> int:
+    """
+    Bytes que siguen ocupados tras construir el resultado. Las filas se generan dentro de
+    la medición, como las entrega el driver: lo que el resultado no retiene se libera.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build(rows)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def run(count: int) -> dict:
+    results = {}
+    for entity_class, make_rows in ((User, user_rows), (BloodTest, blood_test_rows), (ChatMessage, message_rows)):
+        before = unslotted(entity_class)
+        results[f'{entity_class.__name__} (dataclass con __dict__)'] = measure(
+            lambda rows: [before(*row) for row in rows], make_rows(count))
+        results[f'{entity_class.__name__} (__slots__)'] = measure(
+            lambda rows: [entity_class(*row) for row in rows], make_rows(count))
+        if entity_class is BloodTest:
+            results['BloodTestPanel (columnas array)'] = measure(BloodTestPanel.from_rows, make_rows(count))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f'Memoria retenida por {args.count} entidades')
+    for name, size in run(args.count).items():
+        print(f'  {name:<40} {size / 1024 / 1024:8.2f} MiB  ({size / args.count:6.1f} bytes/entidad)')
+
+
+if __name__ == '__main__':
+    main()
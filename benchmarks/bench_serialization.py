@@ -0,0 +1,92 @@
+"""
+Benchmark de serialización de respuestas de historial: marshal_with + json frente al
+serializador precompilado + orjson (FAST_JSON_RESPONSES).
+
+Uso:
+    python -m benchmarks.bench_serialization --blood-tests 500 --conversations 200
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask_restx import Api, marshal
+
+from src.presentation.swagger_models import create_swagger_models
+from src.presentation.serialization import compile_model, dumps, orjson
+
+
+def build_history_payload(blood_tests: int, conversations: int) -> dict:
+    """Respuesta de GET /api/users/<id>/history con el tamaño indicado"""
+    now = datetime(2025, 1, 15, 8, 0, 0)
+    return {
+        'success': True,
+        'data': {
+            'user': {
+                'id': '123e4567-e89b-12d3-a456-426614174000',
+                'name': 'María García',
+                'age': 45,
+                'gender': 'female'
+            },
+            'blood_tests': [
+                {
+                    'id': f'00000000-0000-0000-0000-{index:012d}',
+                    'glucose': 90.0 + index % 50,
+                    'cholesterol': 170.0 + index % 80,
+                    'test_date': (now - timedelta(days=index)).isoformat(),
+                    'created_at': (now - timedelta(days=index)).isoformat()
+                } for index in range(blood_tests)
+            ],
+            'conversations': [
+                {
+                    'id': f'10000000-0000-0000-0000-{index:012d}',
+                    'blood_test_id': f'00000000-0000-0000-0000-{index:012d}',
+                    'created_at': (now - timedelta(days=index)).isoformat(),
+                    'message_count': index % 30
+                } for index in range(conversations)
+            ]
+        }
+    }
+
+
+def run(blood_tests: int, conversations: int, repeat: int, number: int) -> dict:
+    app = Flask(__name__)
+    api = Api(app)
+    models = create_swagger_models(api)
+    payload = build_history_payload(blood_tests, conversations)
+    serialize = compile_model(models['success_response'])
+
+    def marshal_path():
+        with app.app_context():
+            return json.dumps(marshal(payload, models['success_response'])).encode('utf-8')
+
+    def fast_path():
+        return dumps(serialize(payload))
+
+    assert json.loads(marshal_path()) == json.loads(fast_path())
+
+    results = {}
+    for name, func in (('marshal_with+json', marshal_path), ('compiled+' + ('orjson' if orjson else 'json'), fast_path)):
+        timings = timeit.repeat(func, repeat=repeat, number=number)
+        results[name] = min(timings) / number * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blood-tests', type=int, default=500)
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    results = run(args.blood_tests, args.conversations, args.repeat, args.number)
+    baseline = next(iter(results.values()))
+    print(f'Historial con {args.blood_tests} exámenes y {args.conversations} conversaciones')
+    for name, milliseconds in results.items():
+        print(f'  {name:<22} {milliseconds:8.3f} ms/respuesta  ({baseline / milliseconds:5.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
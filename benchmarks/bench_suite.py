@@ -0,0 +1,229 @@
+"""
+Suite de benchmarks de extremo a extremo con un dataset sintético reproducible y el LLM simulado:
+
+- micro: servicio de dominio (análisis por rangos de referencia, tendencias) y repositorios
+  SQLAlchemy, cada llamada en su propio contexto de aplicación como en una petición
+- macro: cada endpoint de /api a través del cliente de pruebas de Flask
+
+Los resultados (p50/p95/p99 por caso) se guardan en JSON para compararlos entre ejecuciones con
+benchmarks.compare.
+
+Uso:
+    python -m benchmarks.bench_suite --output results.json
+    python -m benchmarks.bench_suite --users 2000 --iterations 200 --only macro --output after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .datasets import REFERENCE_DATE, blood_test_values, load_dataset, synthetic_question, synthetic_users
+from .harness import ADMIN_TOKEN, benchmark_app, print_table, summarize, write_results
+
+ADMIN_HEADERS = {'X-Admin-Token': ADMIN_TOKEN}
+
+
+def measure(call: Callable[[], object], iterations: int, warmup: int = 3,
+            check: Optional[Callable[[object], bool]] = None) -> dict:
+    """Ejecuta call iterations veces (más warmup sin medir) y resume las latencias"""
+    for _ in range(min(warmup, iterations)):
+        call()
+    samples = []
+    errors = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = call()
+        samples.append(time.perf_counter() - start)
+        if check is not None and not check(result):
+            errors += 1
+    return summarize(samples, errors=errors)
+
+
+# === MICRO ===
+
+def domain_cases(seed: int) -> List[Tuple[str, Callable[[], object]]]:
+    from src.domain.entities import BloodTest, User
+    from src.domain.services import BloodTestAnalysisService, TrendAnalysisService
+
+    patients = []
+    for record in synthetic_users(200, 1, seed):
+        user = User.create(record['name'], record['age'], record['gender'])
+        test = record['blood_tests'][0]
+        values = {key: value for key, value in test.items() if key != 'test_date'}
+        patients.append((user, BloodTest.create(user.id, values, REFERENCE_DATE), values))
+
+    analysis_service = BloodTestAnalysisService()
+    trend_service = TrendAnalysisService()
+    next_patient = itertools.cycle(patients).__next__
+
+    def analyze():
+        user, test, _ = next_patient()
+        return analysis_service.analyze_blood_test(test, user)
+
+    def update_trends():
+        user, _, values = next_patient()
+        trends = {}
+        for month in range(trend_service.window):
+            trends.update(trend_service.update_trends(trends, user.id, values,
+                                                      REFERENCE_DATE + timedelta(days=30 * month)))
+        return trends
+
+    return [
+        ('micro.domain.analyze_blood_test', analyze),
+        ('micro.domain.update_trends_window', update_trends),
+    ]
+
+
+def repository_cases(app, dataset, seed: int) -> List[Tuple[str, Callable[[], object]]]:
+    from src.domain.entities import ChatMessage, User
+    from src.infrastructure.database import prepare_schema
+    from src.infrastructure.sqlalchemy_repositories import (
+        SQLAlchemyUserRepository, SQLAlchemyBloodTestRepository, SQLAlchemyChatConversationRepository,
+        SQLAlchemyChatMessageRepository, SQLAlchemyMessageSearchRepository
+    )
+
+    with app.app_context():
+        search_repository = SQLAlchemyMessageSearchRepository(prepare_schema(use_cache=True))
+    users = SQLAlchemyUserRepository()
+    blood_tests = SQLAlchemyBloodTestRepository()
+    conversations = SQLAlchemyChatConversationRepository()
+    messages = SQLAlchemyChatMessageRepository(search_repository)
+
+    rng = random.Random(seed)
+    next_user = itertools.cycle(rng.sample(dataset.user_ids, len(dataset.user_ids))).__next__
+    next_conversation = itertools.cycle(rng.sample(dataset.conversation_ids, len(dataset.conversation_ids))).__next__
+
+    def in_context(call):
+        # Un contexto por llamada: sesión nueva, sin el mapa de identidad de la anterior
+        def run():
+            with app.app_context():
+                return call()
+        return run
+
+    return [
+        ('micro.repo.user.get_by_id', in_context(lambda: users.get_by_id(next_user()))),
+        ('micro.repo.user.save', in_context(lambda: users.save(User.create('Paciente benchmark', 40, 'female')))),
+        ('micro.repo.blood_test.get_by_user_id', in_context(lambda: blood_tests.get_by_user_id(next_user()))),
+        ('micro.repo.blood_test.get_panel_by_user_id',
+         in_context(lambda: blood_tests.get_panel_by_user_id(next_user()))),
+        ('micro.repo.conversation.list_by_user_id', in_context(lambda: conversations.list_by_user_id(next_user()))),
+        ('micro.repo.message.get_by_conversation_id',
+         in_context(lambda: messages.get_by_conversation_id(next_conversation()))),
+        ('micro.repo.message.save', in_context(lambda: messages.save(
+            ChatMessage.create(next_conversation(), synthetic_question(rng), 'user')))),
+        ('micro.repo.search.search', in_context(lambda: search_repository.search('colesterol', 20, 0))),
+    ]
+
+
+# === MACRO ===
+
+def read_body(response):
+    """Consume una respuesta en streaming (NDJSON) para medirla completa"""
+    response.get_data()
+    return response
+
+
+def endpoint_cases(client, dataset, seed: int) -> List[Tuple[str, Callable[[], object], int, float]]:
+    """(nombre, llamada, estado esperado, fracción de iteraciones) de cada endpoint de /api"""
+    rng = random.Random(seed)
+    next_user = itertools.cycle(rng.sample(dataset.user_ids, len(dataset.user_ids))).__next__
+    next_conversation = itertools.cycle(rng.sample(dataset.conversation_ids, len(dataset.conversation_ids))).__next__
+    bulk_records = synthetic_users(10 ** 9, 2, seed + 2)
+
+    # Un perfil guardado para el endpoint de descarga
+    client.get('/api/health', headers={**ADMIN_HEADERS, 'X-Profile-Request': 'true'})
+    profile_id = client.get('/api/admin/profiles', headers=ADMIN_HEADERS).get_json()['data'][0]['id']
+
+    def analyze():
+        return client.post('/api/chat/analyze', json={
+            'user_id': next_user(), **blood_test_values(rng, rng.choice(('male', 'female')))
+        })
+
+    return [
+        ('macro.GET /api/health', lambda: client.get('/api/health'), 200, 1),
+        ('macro.GET /api/swagger.json', lambda: client.get('/api/swagger.json'), 200, 1),
+        ('macro.POST /api/users', lambda: client.post('/api/users', json={
+            'name': 'Paciente benchmark', 'age': rng.randint(18, 85), 'gender': rng.choice(('male', 'female'))
+        }), 201, 1),
+        ('macro.POST /api/users/bulk (10)', lambda: client.post('/api/users/bulk', json={
+            'users': list(itertools.islice(bulk_records, 10))
+        }), 201, 0.2),
+        ('macro.GET /api/users/<id>/history', lambda: client.get(f'/api/users/{next_user()}/history'), 200, 1),
+        ('macro.GET /api/users/<id>/export', lambda: read_body(client.get(f'/api/users/{next_user()}/export')), 200, 1),
+        ('macro.POST /api/chat/analyze', analyze, 200, 1),
+        ('macro.POST /api/chat/<id>/message', lambda: client.post(
+            f'/api/chat/{next_conversation()}/message', json={'message': synthetic_question(rng)}
+        ), 200, 1),
+        ('macro.GET /api/analytics/cohorts', lambda: client.get('/api/analytics/cohorts'), 200, 1),
+        ('macro.GET /api/search/messages', lambda: client.get(
+            '/api/search/messages', query_string={'q': rng.choice(('colesterol', 'glucosa', 'ejercicio'))},
+            headers=ADMIN_HEADERS
+        ), 200, 1),
+        ('macro.GET /api/admin/profiles', lambda: client.get('/api/admin/profiles', headers=ADMIN_HEADERS), 200, 1),
+        ('macro.GET /api/admin/profiles/<id>', lambda: client.get(
+            f'/api/admin/profiles/{profile_id}', query_string={'format': 'text'}, headers=ADMIN_HEADERS
+        ), 200, 0.2),
+        ('macro.GET /api/admin/export',
+         lambda: read_body(client.get('/api/admin/export', headers=ADMIN_HEADERS)), 200, 0.1),
+        ('macro.GET /api/admin/reference-ranges',
+         lambda: client.get('/api/admin/reference-ranges', headers=ADMIN_HEADERS), 200, 1),
+        ('macro.POST /api/admin/reference-ranges',
+         lambda: client.post('/api/admin/reference-ranges', headers=ADMIN_HEADERS), 200, 0.2),
+    ]
+
+
+def run(args) -> Dict[str, dict]:
+    results = {}
+    if args.only in (None, 'micro'):
+        for name, call in domain_cases(args.seed):
+            results[name] = measure(call, args.iterations * 10)
+
+    with benchmark_app(args.database_url, args.llm_latency_ms, args.llm_jitter_ms, args.seed,
+                       FAST_JSON_RESPONSES=str(args.fast_json).lower()) as app:
+        client = app.test_client()
+        started = time.perf_counter()
+        dataset = load_dataset(client, args.users, args.tests_per_user, args.conversations_per_user,
+                               args.messages_per_conversation, args.seed)
+        print(f'Dataset: {len(dataset.user_ids)} usuarios y {len(dataset.conversation_ids)} conversaciones '
+              f'({time.perf_counter() - started:.1f} s)')
+
+        if args.only in (None, 'micro'):
+            for name, call in repository_cases(app, dataset, args.seed):
+                results[name] = measure(call, args.iterations)
+
+        if args.only in (None, 'macro'):
+            for name, call, status, fraction in endpoint_cases(client, dataset, args.seed):
+                results[name] = measure(call, max(1, int(args.iterations * fraction)),
+                                        check=lambda response, status=status: response.status_code == status)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', choices=('micro', 'macro'), help='ejecutar solo una parte')
+    parser.add_argument('--iterations', type=int, default=50, help='llamadas medidas por caso')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--tests-per-user', type=int, default=3)
+    parser.add_argument('--conversations-per-user', type=int, default=1)
+    parser.add_argument('--messages-per-conversation', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--llm-latency-ms', type=float, default=20.0, help='latencia base del LLM simulado')
+    parser.add_argument('--llm-jitter-ms', type=float, default=10.0, help='variación añadida según el prompt')
+    parser.add_argument('--fast-json', action='store_true', help='con FAST_JSON_RESPONSES=true')
+    parser.add_argument('--database-url', help='por defecto, un archivo SQLite temporal')
+    parser.add_argument('--output', help="archivo JSON de resultados ('-' para stdout)")
+    args = parser.parse_args()
+
+    started = datetime.now()
+    results = run(args)
+    print(f'\nResultados ({(datetime.now() - started).total_seconds():.1f} s)')
+    print_table(results)
+    parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'database_url')}
+    write_results(args.output, 'bench_suite', parameters, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compara dos archivos de resultados de bench_suite o replay (JSON) caso por caso y marca las
+regresiones: casos cuya métrica empeora más que el umbral. Con --fail-on-regression termina con
+código 1 si hay alguna, para usarlo en CI.
+
+Uso:
+    python -m benchmarks.compare before.json after.json
+    python -m benchmarks.compare before.json after.json --metric p95 --threshold 15 --fail-on-regression
+"""
+import argparse
+import json
+import sys
+
+# Métricas donde un valor mayor es mejor; en el resto (latencias) es peor
+HIGHER_IS_BETTER = frozenset({'throughput'})
+
+
+def load(path: str) -> dict:
+    with open(path, encoding='utf-8') as results_file:
+        return json.load(results_file)
+
+
+def compare(before: dict, after: dict, metric: str, threshold: float):
+    """Filas (caso, antes, después, cambio %, regresión) de los casos presentes en ambos archivos"""
+    rows = []
+    for name, summary in after['results'].items():
+        previous = before['results'].get(name)
+        if previous is None or metric not in summary or metric not in previous:
+            continue
+        old, new = previous[metric], summary[metric]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        rows.append((name, old, new, change, worse > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default='p50', choices=('mean', 'p50', 'p95', 'p99', 'max', 'throughput'))
+    parser.add_argument('--threshold', type=float, default=10.0, help='porcentaje de empeoramiento tolerado')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    rows = compare(before, after, args.metric, args.threshold)
+    print(f"{args.metric}: {before['environment'].get('commit')} ({before['created_at']}) -> "
+          f"{after['environment'].get('commit')} ({after['created_at']})")
+    if before['parameters'] != after['parameters']:
+        print('⚠️ Las ejecuciones usaron parámetros distintos; la comparación puede no ser válida')
+
+    width = max((len(row[0]) for row in rows), default=10)
+    for name, old, new, change, regression in rows:
+        marker = '  ▲ regresión' if regression else ''
+        print(f'  {name:<{width}} {old:>12.3f} {new:>12.3f} {change:>+8.1f}%{marker}')
+
+    missing = sorted(set(before['results']) ^ set(after['results']))
+    if missing:
+        print(f"Casos presentes en un solo archivo: {', '.join(missing)}")
+
+    regressions = sum(1 for row in rows if row[4])
+    print(f'{regressions} regresiones por encima del {args.threshold:g} %')
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Utilidades comunes de bench_suite.py, datasets.py y replay.py: aplicación con base temporal y
+LLM simulado, resumen de latencias y resultados en JSON comparables con compare.py.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from .llm_stub import install_llm_stub
+
+RESULTS_FORMAT_VERSION = 1
+
+# Token de administrador de la aplicación de benchmark (búsqueda, exportación total, perfiles)
+ADMIN_TOKEN = 'benchmark-admin'
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextmanager
+def benchmark_app(database_url: Optional[str] = None, llm_latency_ms: float = 0.0, llm_jitter_ms: float = 0.0,
+                  seed: int = 0, **config) -> Iterator:
+    """
+    Aplicación completa (create_app) con el LLM simulado, sin límites de tasa y con una base SQLite
+    temporal salvo que se indique database_url. config sobrescribe variables de entorno de
+    create_app, p. ej. FAST_JSON_RESPONSES='true'.
+    """
+    temporary_dir = tempfile.mkdtemp(prefix='bench_app_')
+    env = {
+        'DATABASE_URL': database_url or f"sqlite:///{os.path.join(temporary_dir, 'bench.db')}",
+        'RATE_LIMIT_ENABLED': 'false',
+        'LAZY_INIT': 'true',  # el cliente real de Gemini no llega a configurarse
+        'ADMIN_TOKEN': ADMIN_TOKEN,
+        'PROFILE_DIR': os.path.join(temporary_dir, 'profiles'),
+        'PARQUET_EXPORT_DIR': os.path.join(temporary_dir, 'exports'),
+        **{key: str(value) for key, value in config.items()}
+    }
+    previous = {key: os.environ.get(key) for key in [*env, 'GEMINI_API_KEY']}
+    os.environ.update(env)
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    try:
+        from app import create_app
+        app = create_app()
+        install_llm_stub(app, latency_ms=llm_latency_ms, jitter_ms=llm_jitter_ms, seed=seed)
+        yield app
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+def percentile(sorted_samples: Sequence[float], fraction: float) -> float:
+    """Percentil por interpolación lineal sobre muestras ya ordenadas"""
+    if not sorted_samples:
+        return 0.0
+    position = (len(sorted_samples) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * (position - lower)
+
+
+def summarize(samples: List[float], elapsed: Optional[float] = None, errors: int = 0) -> Dict[str, float]:
+    """
+    Resumen de latencias (muestras en segundos, resultado en ms). El throughput es por segundo de
+    reloj si se indica elapsed; si no, el de una ejecución secuencial (1 / media).
+    """
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered) if ordered else 0.0
+    if elapsed:
+        throughput = len(ordered) / elapsed
+    else:
+        throughput = 1 / mean if mean else 0.0
+    return {
+        'unit': 'ms',
+        'count': len(ordered),
+        'errors': errors,
+        'mean': round(mean * 1000, 4),
+        'p50': round(percentile(ordered, 0.50) * 1000, 4),
+        'p95': round(percentile(ordered, 0.95) * 1000, 4),
+        'p99': round(percentile(ordered, 0.99) * 1000, 4),
+        'max': round(ordered[-1] * 1000, 4) if ordered else 0.0,
+        'throughput': round(throughput, 2)
+    }
+
+
+def environment() -> Dict[str, Optional[str]]:
+    """Versión del código y del intérprete con que se obtuvieron los resultados"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': str(os.cpu_count())
+    }
+
+
+def write_results(path: Optional[str], suite: str, parameters: dict, results: Dict[str, dict]) -> dict:
+    """Guarda los resultados en JSON (o los escribe en stdout con path '-')"""
+    document = {
+        'format': RESULTS_FORMAT_VERSION,
+        'suite': suite,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'parameters': parameters,
+        'results': results
+    }
+    if path == '-':
+        json.dump(document, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write('\n')
+    elif path:
+        with open(path, 'w', encoding='utf-8') as results_file:
+            json.dump(document, results_file, indent=2, ensure_ascii=False)
+    return document
+
+
+def print_table(results: Dict[str, dict], file=None) -> None:
+    """Tabla de latencias por caso"""
+    file = file or sys.stdout
+    width = max((len(name) for name in results), default=10)
+    print(f"  {'caso':<{width}} {'n':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10} {'errores':>8}",
+          file=file)
+    for name, summary in results.items():
+        print(f"  {name:<{width}} {summary['count']:>6} {summary['p50']:>10.3f} {summary['p95']:>10.3f} "
+              f"{summary['p99']:>10.3f} {summary['throughput']:>10.1f} {summary['errors']:>8}", file=file)
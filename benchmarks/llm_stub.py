@@ -0,0 +1,85 @@
+"""
+Modelo de Gemini simulado para benchmarks y reproducciones de tráfico: responde sin red, con
+una latencia configurable y un texto que depende solo del prompt y de la semilla, de modo que
+dos ejecuciones con los mismos datos hacen exactamente el mismo trabajo.
+
+Se instala en una aplicación ya creada sustituyendo el modelo de su GeminiService:
+
+    install_llm_stub(app, latency_ms=800, jitter_ms=400)
+"""
+import random
+import time
+import zlib
+from typing import Iterator
+
+_SENTENCES = (
+    'Los valores de glucosa se encuentran dentro del rango esperado para su edad.',
+    'El colesterol total está ligeramente elevado y conviene repetir el examen en tres meses.',
+    'La hemoglobina y el hematocrito son compatibles con una buena oxigenación.',
+    'Los triglicéridos responden bien a la actividad física regular y a reducir azúcares.',
+    'La función renal, estimada por creatinina y urea, no muestra alteraciones.',
+    'Consulte a su médico antes de modificar cualquier tratamiento.',
+    'Una alimentación rica en fibra ayuda a mantener el perfil lipídico.',
+    'El recuento de plaquetas y glóbulos blancos no sugiere procesos infecciosos.',
+)
+
+
+class StubResponse:
+    """Respuesta (o fragmento de streaming) con la misma interfaz que la de google.generativeai"""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubGenerativeModel:
+    """
+    Sustituto determinista de genai.GenerativeModel. La latencia de cada llamada es
+    latency_ms más una parte de jitter_ms elegida con el hash del prompt; en streaming, la
+    primera parte llega tras first_chunk_ratio de esa latencia y el resto se reparte entre
+    los fragmentos.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, response_chars: int = 800,
+                 chunks: int = 8, first_chunk_ratio: float = 0.3, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.response_chars = response_chars
+        self.chunks = max(1, chunks)
+        self.first_chunk_ratio = first_chunk_ratio
+        self.seed = seed
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')) ^ self.seed)
+        latency = (self.latency_ms + rng.random() * self.jitter_ms) / 1000
+        text = self._text(rng)
+        if stream:
+            return self._stream(text, latency)
+        time.sleep(latency)
+        return StubResponse(text)
+
+    def _text(self, rng: random.Random) -> str:
+        parts = []
+        length = 0
+        while length < self.response_chars:
+            sentence = rng.choice(_SENTENCES)
+            parts.append(sentence)
+            length += len(sentence) + 1
+        return ' '.join(parts)[:self.response_chars]
+
+    def _stream(self, text: str, latency: float) -> Iterator[StubResponse]:
+        size = -(-len(text) // self.chunks)
+        pieces = [text[start:start + size] for start in range(0, len(text), size)]
+        time.sleep(latency * self.first_chunk_ratio)
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(latency * (1 - self.first_chunk_ratio) / max(1, len(pieces) - 1))
+            yield StubResponse(piece)
+
+
+def install_llm_stub(app, **options) -> StubGenerativeModel:
+    """Sustituye el modelo de Gemini de la aplicación por el simulado"""
+    model = StubGenerativeModel(**options)
+    app.extensions['gemini_service'].model = model
+    return model
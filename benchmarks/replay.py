@@ -0,0 +1,452 @@
+"""
+Reproduce una captura de tráfico (TRAFFIC_CAPTURE_ENABLED=true) contra la aplicación con el LLM
+simulado, a N veces la velocidad original y con un máximo de peticiones simultáneas, e informa la
+latencia p50/p95/p99 y el throughput por endpoint.
+
+Por defecto arranca la aplicación en este proceso con una base SQLite temporal y la sirve con el
+servidor pre-fork (--workers, --threads). Los pacientes y conversaciones que la captura usa pero
+no crea se generan antes de empezar; los que sí crea (POST /api/users, /api/chat/analyze, ...)
+se asocian con los ids reales a medida que responden. Con --url se reproduce contra un servidor
+ya en marcha (que usará su propio LLM).
+
+La planificación es abierta: cada petición sale en su instante (ts / speed) aunque las anteriores
+no hayan respondido, y su latencia se mide desde ese instante. Las que usan un id creado por otra
+petición salen, como mucho, cuando esa responde, y se miden desde ese momento. Si --concurrency no
+alcanza, la espera en el cliente aparece como latencia y como retraso de salida.
+
+Uso:
+    python -m benchmarks.replay traffic/capture.ndjson --speed 5 --concurrency 64
+    python -m benchmarks.replay traffic/capture.ndjson.2 traffic/capture.ndjson.1 traffic/capture.ndjson \\
+        --speed 10 --workers 4 --llm-latency-ms 900 --llm-jitter-ms 600 --output replay.json
+    python -m benchmarks.replay capture.ndjson --url http://staging:5000 --admin-token ... --speed 2
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import queue
+import random
+import signal
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from src.infrastructure.traffic_capture import IDENTIFIER_FIELDS, iter_identifiers, read_capture
+
+from .datasets import QUESTIONS, blood_test_values, load_dataset, synthetic_users
+from .harness import ADMIN_TOKEN, benchmark_app, percentile, print_table, summarize, write_results
+
+# Respuesta de send(): estado y cuerpo JSON (None si no lo es)
+Sender = Callable[[str, str, Any, bool], Tuple[int, Any]]
+
+_FILLER = ' '.join(QUESTIONS)
+
+
+class IdMap:
+    """
+    Seudónimo de la captura -> id real en el objetivo. Las peticiones que usan un id que otra
+    aún está creando se aparcan (sin ocupar un hilo) hasta que ese id se conoce.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, Tuple[str, float]] = {}  # seudónimo -> (id real, instante en que se conoció)
+        self._waiters: Dict[str, List[Callable[[], None]]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def set(self, pseudonym: str, real_id: str) -> None:
+        with self._lock:
+            self._ids[pseudonym] = (real_id, time.perf_counter())
+            waiters = self._waiters.pop(pseudonym, [])
+        for callback in waiters:
+            callback()
+
+    def get(self, pseudonym: str) -> Tuple[str, float]:
+        return self._ids[pseudonym]
+
+    def when_known(self, pseudonyms: List[str], callback: Callable[[], None]) -> None:
+        """Llama a callback cuando se conozcan todos los seudónimos (enseguida si ya se conocen)"""
+        with self._lock:
+            missing = next((pseudonym for pseudonym in pseudonyms if pseudonym not in self._ids), None)
+            if missing is not None:
+                self._waiters[missing].append(lambda: self.when_known(pseudonyms, callback))
+                return
+        callback()
+
+
+def entry_ids(value: Any) -> List[str]:
+    """Seudónimos que usa una parte de la entrada (params, query o body)"""
+    if isinstance(value, list):
+        return [pseudonym for item in value for pseudonym in entry_ids(item)]
+    if not isinstance(value, dict):
+        return []
+    if '$id' in value:
+        return [value['$id']]
+    return [pseudonym for item in value.values() for pseudonym in entry_ids(item)]
+
+
+def materialize(value: Any, ids: IdMap) -> Any:
+    """Valor concreto a partir de la forma anonimizada de la captura (con todos sus ids ya conocidos)"""
+    if isinstance(value, list):
+        return [materialize(item, ids) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '$id' in value:
+        return ids.get(value['$id'])[0]
+    if '$text' in value:
+        return (_FILLER * (value['$text'] // len(_FILLER) + 1))[:max(1, value['$text'])]
+    if '$date' in value:
+        return f"{value['$date']}-15T08:00:00"
+    return {key: materialize(item, ids) for key, item in value.items()}
+
+
+def request_path(entry: Dict[str, Any], params: Dict[str, Any], query: Dict[str, Any]) -> str:
+    path = entry['route']
+    for name, value in params.items():
+        path = path.replace(f'<string:{name}>', urllib.parse.quote(str(value), safe=''))
+    return path + ('?' + urllib.parse.urlencode(query) if query else '')
+
+
+def referenced_ids(entries: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Seudónimos usados por las peticiones y el campo en que aparecen (user_id, conversation_id, ...)"""
+    referenced = {}
+
+    def walk(value, field=None):
+        if isinstance(value, dict):
+            if '$id' in value and field in IDENTIFIER_FIELDS:
+                referenced.setdefault(value['$id'], field)
+            else:
+                for key, item in value.items():
+                    walk(item, key)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item, field)
+
+    for entry in entries:
+        walk(entry['params'])
+        walk(entry['query'])
+        walk(entry['body'])
+    return referenced
+
+
+def seed_missing_ids(send: Sender, entries: List[Dict[str, Any]], ids: IdMap, seed: int) -> Counter:
+    """Crea los usuarios y conversaciones que la captura usa pero no crea"""
+    created = {pseudonym for entry in entries for pseudonym in entry.get('created', ())}
+    missing = {pseudonym: field for pseudonym, field in referenced_ids(entries).items() if pseudonym not in created}
+    users = [pseudonym for pseudonym, field in missing.items() if field == 'user_id']
+    conversations = [pseudonym for pseudonym, field in missing.items() if field == 'conversation_id']
+
+    # Un paciente por usuario faltante y otro como dueño de cada conversación faltante
+    records = list(synthetic_users(len(users) + len(conversations), 2, seed))
+    real_user_ids = []
+    for start in range(0, len(records), 500):
+        status, body = send('POST', '/api/users/bulk', {'users': records[start:start + 500]}, False)
+        if status != 201:
+            raise RuntimeError(f'No se pudieron crear los pacientes de la reproducción (estado {status})')
+        real_user_ids.extend(body['data']['user_ids'])
+    for pseudonym, real_id in zip(users, real_user_ids):
+        ids.set(pseudonym, real_id)
+
+    rng = random.Random(seed)
+    for pseudonym, real_id, record in zip(conversations, real_user_ids[len(users):], records[len(users):]):
+        status, body = send('POST', '/api/chat/analyze',
+                            {'user_id': real_id, **blood_test_values(rng, record['gender'])}, False)
+        if status != 200:
+            raise RuntimeError(f'No se pudieron crear las conversaciones de la reproducción (estado {status})')
+        ids.set(pseudonym, body['data']['conversation_id'])
+
+    # El resto (p. ej. perfiles) no se puede generar: se envía el seudónimo y el objetivo responde 404
+    skipped = Counter()
+    for pseudonym, field in missing.items():
+        if field not in ('user_id', 'conversation_id'):
+            ids.set(pseudonym, pseudonym)
+            skipped[field] += 1
+    return skipped
+
+
+def client_sender(client, admin_token: str) -> Sender:
+    """send() sobre el cliente de pruebas de Flask (preparación antes de arrancar el servidor)"""
+    def send(method, path, body, admin):
+        headers = {'X-Admin-Token': admin_token} if admin else {}
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+    return send
+
+
+def http_sender(base_url: str, admin_token: Optional[str], timeout: float) -> Sender:
+    """send() por HTTP, con una conexión por petición (como clientes independientes)"""
+    target = urllib.parse.urlsplit(base_url)
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+
+    def send(method, path, body, admin):
+        headers = {'Connection': 'close', 'Accept-Encoding': 'gzip'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if admin and admin_token:
+            headers['X-Admin-Token'] = admin_token
+        connection = connection_class(target.hostname, target.port, timeout=timeout)
+        try:
+            connection.request(method, target.path.rstrip('/') + path, body=payload, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            if not response.headers.get('Content-Type', '').startswith('application/json'):
+                return response.status, None
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                return response.status, None
+        finally:
+            connection.close()
+    return send
+
+
+class Replayer:
+    """Envía las entradas de la captura en su instante relativo dividido por speed"""
+
+    def __init__(self, send: Sender, entries: List[Dict[str, Any]], ids: IdMap, speed: float,
+                 concurrency: int, dependency_timeout: float):
+        self.send = send
+        self.entries = entries
+        self.ids = ids
+        self.speed = speed
+        self.concurrency = concurrency
+        self.dependency_timeout = dependency_timeout
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._progress = threading.Condition(self._lock)
+        self._outstanding = 0
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.errors: Counter = Counter()
+        self.lags: List[float] = []
+        self.unresolved: Set[str] = set()
+        self.abandoned = 0
+
+    def run(self) -> float:
+        """Reproduce la captura y devuelve la duración total en segundos"""
+        threads = [threading.Thread(target=self._work, daemon=True) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+
+        origin = self.entries[0]['ts']
+        started = time.perf_counter() + 0.1
+        for entry in self.entries:
+            due = started + (entry['ts'] - origin) / self.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                self._outstanding += 1
+            self._schedule(entry, due)
+
+        # Esperar a las pendientes; las que siguen aparcadas sin avances se abandonan
+        with self._progress:
+            while self._outstanding:
+                remaining = self._outstanding
+                self._progress.wait_for(lambda: self._outstanding < remaining, self.dependency_timeout)
+                if self._outstanding == remaining:
+                    self.abandoned = remaining
+                    break
+        elapsed = time.perf_counter() - started
+
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        return elapsed
+
+    def _schedule(self, entry: Dict[str, Any], due: float) -> None:
+        pseudonyms = entry_ids(entry['params']) + entry_ids(entry['query']) + entry_ids(entry['body'])
+        self.ids.when_known(pseudonyms, lambda: self._queue.put((entry, due, pseudonyms)))
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._replay(*item)
+            with self._progress:
+                self._outstanding -= 1
+                self._progress.notify_all()
+
+    def _replay(self, entry: Dict[str, Any], due: float, pseudonyms: List[str]) -> None:
+        endpoint = f"{entry['method']} {entry['route']}"
+        # Un cliente real envía la petición cuando tiene la respuesta que le dio el id, no antes
+        ready = max([due] + [self.ids.get(pseudonym)[1] for pseudonym in pseudonyms])
+        unresolved = {pseudonym for pseudonym in pseudonyms if self.ids.get(pseudonym)[0] == pseudonym}
+        params = materialize(entry['params'], self.ids)
+        query = materialize(entry['query'], self.ids)
+        body = materialize(entry['body'], self.ids)
+        sent = time.perf_counter()
+        try:
+            status, response = self.send(entry['method'], request_path(entry, params, query), body, entry['admin'])
+        except (OSError, http.client.HTTPException):
+            status, response = None, None
+        finished = time.perf_counter()
+
+        if entry.get('created'):
+            if status is not None and status < 300 and response is not None:
+                for pseudonym, real_id in zip(entry['created'], iter_identifiers(response)):
+                    self.ids.set(pseudonym, real_id)
+            else:
+                # Sin ids reales: las peticiones que los esperan salen con el seudónimo (y reciben 404)
+                for pseudonym in entry['created']:
+                    self.ids.set(pseudonym, pseudonym)
+
+        with self._lock:
+            self.latencies[endpoint].append(finished - ready)
+            self.lags.append(sent - ready)
+            self.statuses[endpoint][str(status) if status is not None else 'connection_error'] += 1
+            if status is None or status >= 500:
+                self.errors[endpoint] += 1
+            self.unresolved.update(unresolved)
+
+    def report(self, elapsed: float) -> Dict[str, dict]:
+        captured = defaultdict(list)
+        for entry in self.entries:
+            captured[f"{entry['method']} {entry['route']}"].append(entry['duration_ms'] / 1000)
+
+        results = {}
+        for endpoint in sorted(self.latencies):
+            summary = summarize(self.latencies[endpoint], elapsed, self.errors[endpoint])
+            ordered = sorted(captured[endpoint])
+            summary['captured_p50'] = round(percentile(ordered, 0.50) * 1000, 4)
+            summary['captured_p95'] = round(percentile(ordered, 0.95) * 1000, 4)
+            summary['statuses'] = dict(self.statuses[endpoint])
+            results[f'replay.{endpoint}'] = summary
+        results['replay.total'] = summarize([sample for samples in self.latencies.values() for sample in samples],
+                                            elapsed, sum(self.errors.values()))
+        return results
+
+
+def wait_until_healthy(base_url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'{base_url}/api/health', timeout=1) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.05)
+    raise RuntimeError(f'Sin respuesta de {base_url}/api/health en {timeout} s')
+
+
+def start_local_server(app, workers: int, threads: int) -> Tuple[str, int]:
+    """Sirve la aplicación con el servidor pre-fork en un proceso hijo; devuelve su URL y pid"""
+    from src.infrastructure.database import dispose_engines
+    from src.presentation.server import PreforkServer
+    from .bench_startup import free_port
+
+    port = free_port()
+    with app.app_context():
+        dispose_engines()
+
+    def after_fork():
+        with app.app_context():
+            dispose_engines(close=False)
+
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            PreforkServer(app, '127.0.0.1', port, workers, threads, graceful_timeout=5,
+                          after_fork=after_fork).run()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    return f'http://127.0.0.1:{port}', pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('captures', nargs='+', help='archivos de captura (incluidos los rotados)')
+    parser.add_argument('--speed', type=float, default=1.0, help='multiplicador de velocidad (5 = 5x)')
+    parser.add_argument('--concurrency', type=int, default=32, help='máximo de peticiones simultáneas')
+    parser.add_argument('--limit', type=int, help='reproducir solo las primeras N peticiones')
+    parser.add_argument('--dependency-timeout', type=float, default=90.0,
+                        help='al final, segundos sin avances tras los que se abandonan las peticiones que esperan un id')
+    parser.add_argument('--timeout', type=float, default=60.0, help='timeout de cada petición')
+    parser.add_argument('--url', help='servidor ya en marcha en lugar de la aplicación local')
+    parser.add_argument('--admin-token', help='token para las peticiones de administración (con --url)')
+    parser.add_argument('--workers', type=int, default=1, help='workers del servidor local')
+    parser.add_argument('--threads', type=int, default=32, help='hilos por worker del servidor local')
+    parser.add_argument('--users', type=int, default=0, help='pacientes de fondo en la base local')
+    parser.add_argument('--llm-latency-ms', type=float, default=800.0)
+    parser.add_argument('--llm-jitter-ms', type=float, default=400.0)
+    parser.add_argument('--database-url', help='base de la aplicación local (por defecto, SQLite temporal)')
+    parser.add_argument('--config', action='append', default=[], metavar='CLAVE=VALOR',
+                        help='variable de entorno de la aplicación local, p. ej. FAST_JSON_RESPONSES=true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="archivo JSON de resultados ('-' para stdout)")
+    args = parser.parse_args()
+
+    entries = read_capture(args.captures)[:args.limit]
+    if not entries:
+        parser.error('La captura no tiene peticiones')
+    span = entries[-1]['ts'] - entries[0]['ts']
+    print(f'{len(entries)} peticiones capturadas en {span:.1f} s; reproducción a {args.speed:g}x '
+          f'(~{span / args.speed:.1f} s) con {args.concurrency} simultáneas')
+
+    ids = IdMap()
+    if args.url:
+        base_url = args.url.rstrip('/')
+        send = http_sender(base_url, args.admin_token, args.timeout)
+        skipped = seed_missing_ids(send, entries, ids, args.seed)
+        run_replay(args, entries, ids, send, skipped)
+        return
+
+    config = dict(item.split('=', 1) for item in args.config)
+    with benchmark_app(args.database_url, seed=args.seed, **config) as app:
+        client = app.test_client()
+        if args.users:
+            load_dataset(client, args.users, seed=args.seed)
+        skipped = seed_missing_ids(client_sender(client, ADMIN_TOKEN), entries, ids, args.seed)
+        # La preparación se hace sin latencia; la reproducción, con la configurada
+        stub = app.extensions['gemini_service'].model
+        stub.latency_ms, stub.jitter_ms = args.llm_latency_ms, args.llm_jitter_ms
+
+        base_url, server_pid = start_local_server(app, args.workers, args.threads)
+        try:
+            wait_until_healthy(base_url, 30)
+            print(f'Servidor local en {base_url} ({args.workers} workers x {args.threads} hilos)')
+            run_replay(args, entries, ids, http_sender(base_url, ADMIN_TOKEN, args.timeout), skipped)
+        finally:
+            os.kill(server_pid, signal.SIGTERM)
+            os.waitpid(server_pid, 0)
+
+
+def run_replay(args, entries, ids: IdMap, send: Sender, skipped: Counter) -> None:
+    if skipped:
+        print(f"Ids sin crear en la captura que no se pueden generar: {dict(skipped)} (responderán 404)")
+    replayer = Replayer(send, entries, ids, args.speed, args.concurrency, args.dependency_timeout)
+    elapsed = replayer.run()
+    results = replayer.report(elapsed)
+
+    print(f'\nLatencia desde el instante programado ({elapsed:.1f} s, '
+          f"{results['replay.total']['throughput']:.1f} peticiones/s)")
+    print_table(results)
+    lags = sorted(replayer.lags)
+    print(f'Retraso de salida p95: {percentile(lags, 0.95) * 1000:.1f} ms'
+          + ('  (⚠️ el cliente no sigue el ritmo: aumentar --concurrency)' if percentile(lags, 0.95) > 0.1 else ''))
+    if replayer.unresolved:
+        print(f'{len(replayer.unresolved)} ids no se pudieron asociar a uno real (se enviaron como seudónimo)')
+    if replayer.abandoned:
+        print(f'⚠️ {replayer.abandoned} peticiones abandonadas: esperaban ids que ninguna respuesta devolvió')
+    parameters = {key: value for key, value in vars(args).items()
+                  if key not in ('output', 'admin_token', 'database_url', 'captures')}
+    write_results(args.output, 'replay', parameters, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+from datetime import datetime, timezone
+from typing import Annotated, Any, ClassVar, Dict, List, Optional, Type, TypeVar, Union
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+BLOOD_TEST_FIELDS = (
+    'glucose', 'cholesterol', 'hdl_cholesterol', 'ldl_cholesterol',
+    'triglycerides', 'hemoglobin', 'hematocrit', 'white_blood_cells',
+    'red_blood_cells', 'platelets', 'creatinine', 'urea'
+)
+
+VALID_GENDERS = frozenset({'male', 'female', 'masculino', 'femenino'})
+
+# Mínimo de valores de examen requeridos para un análisis
+MIN_BLOOD_TEST_VALUES = 3
+
+# Máximo de registros aceptados en una importación masiva
+MAX_BULK_RECORDS = 1000
+
+PositiveNumber = Union[Annotated[int, Field(strict=True, gt=0)], Annotated[float, Field(strict=True, gt=0)]]
+LabValue = Optional[Annotated[float, Field(strict=True, ge=0)]]
+NonEmptyString = Annotated[str, Field(strict=True, min_length=1)]
+
+SchemaT = TypeVar('SchemaT', bound='RequestSchema')
+
+
+class RequestValidationError(ValueError):
+    """Error de validación con un mensaje listo para devolver al cliente"""
+
+
+class RequestSchema(BaseModel):
+    """Base de los esquemas de entrada; los validadores se compilan en pydantic-core"""
+
+    model_config = ConfigDict(extra='ignore', str_strip_whitespace=True)
+
+    # Mensaje por campo cuando falla su tipo o sus restricciones
+    field_messages: ClassVar[Dict[str, str]] = {}
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        _FIELD_MESSAGES.update(cls.field_messages)
+
+    @classmethod
+    def parse(cls: Type[SchemaT], data: Any) -> SchemaT:
+        """Valida el cuerpo de la petición o lanza RequestValidationError"""
+        try:
+            return cls.model_validate(data if data is not None else {})
+        except ValidationError as error:
+            raise RequestValidationError(_first_message(error)) from None
+
+
+# Mensajes de todos los esquemas, para errores en registros anidados
+_FIELD_MESSAGES: Dict[str, str] = {}
+
+
+def _first_message(error: ValidationError) -> str:
+    """Traduce el primer error de pydantic a un mensaje para el cliente"""
+    detail = error.errors(include_url=False)[0]
+    # Se descartan las etiquetas de las ramas de Union (p. ej. 'constrained-int')
+    location = tuple(part for part in detail['loc'] if isinstance(part, int) or part.isidentifier())
+    field = next((part for part in reversed(location) if isinstance(part, str)), None)
+    if detail['type'] == 'missing':
+        return f'Campo requerido: {field}'
+
+    if detail['type'] == 'value_error':
+        message = str(detail['ctx']['error'])
+    elif field in _FIELD_MESSAGES:
+        message = _FIELD_MESSAGES[field]
+    else:
+        message = f'{field}: {detail["msg"]}' if field else detail['msg']
+
+    # En registros anidados se indica la ruta, p. ej. users[3].blood_tests[0]
+    parent = location[:-1] if location and location[-1] == field else location
+    if parent:
+        path = ''.join(f'[{part}]' if isinstance(part, int) else f'.{part}' for part in parent).lstrip('.')
+        return f'{path}: {message}'
+    return message
+
+
+class BloodTestValues(RequestSchema):
+    """Valores de un examen de sangre"""
+
+    glucose: LabValue = None
+    cholesterol: LabValue = None
+    hdl_cholesterol: LabValue = None
+    ldl_cholesterol: LabValue = None
+    triglycerides: LabValue = None
+    hemoglobin: LabValue = None
+    hematocrit: LabValue = None
+    white_blood_cells: LabValue = None
+    red_blood_cells: LabValue = None
+    platelets: LabValue = None
+    creatinine: LabValue = None
+    urea: LabValue = None
+    test_date: Optional[datetime] = None
+
+    field_messages: ClassVar[Dict[str, str]] = {
+        **{field: f'{field} debe ser un número positivo' for field in BLOOD_TEST_FIELDS},
+        'test_date': 'test_date debe ser una fecha ISO válida'
+    }
+
+    @field_validator('test_date', mode='before')
+    @classmethod
+    def parse_test_date(cls, value):
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+            except ValueError:
+                raise ValueError('test_date debe ser una fecha ISO válida')
+        # Las fechas con zona se guardan en UTC sin zona, para compararlas con las demás
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    @model_validator(mode='after')
+    def require_minimum_values(self):
+        if len(self.present_values()) < MIN_BLOOD_TEST_VALUES:
+            raise ValueError(f'Se requieren al menos {MIN_BLOOD_TEST_VALUES} valores de examen de sangre')
+        return self
+
+    def present_values(self) -> Dict[str, float]:
+        """Valores informados en la petición"""
+        return {
+            field: value for field, value in ((field, getattr(self, field)) for field in BLOOD_TEST_FIELDS)
+            if value is not None
+        }
+
+
+class CreateUserRequest(RequestSchema):
+    """Datos para crear un usuario"""
+
+    name: NonEmptyString
+    age: PositiveNumber
+    gender: str
+
+    field_messages: ClassVar[Dict[str, str]] = {
+        'name': 'name debe ser una cadena válida',
+        'age': 'La edad debe ser un número positivo',
+        'gender': 'Género debe ser male/female o masculino/femenino'
+    }
+
+    @field_validator('gender')
+    @classmethod
+    def normalize_gender(cls, value: str) -> str:
+        gender = value.lower()
+        if gender not in VALID_GENDERS:
+            raise ValueError('Género debe ser male/female o masculino/femenino')
+        return gender
+
+
+class AnalyzeBloodTestRequest(BloodTestValues):
+    """Examen de sangre a analizar para un usuario"""
+
+    user_id: NonEmptyString
+
+    field_messages: ClassVar[Dict[str, str]] = {
+        **BloodTestValues.field_messages,
+        'user_id': 'user_id debe ser una cadena válida'
+    }
+
+
+class ChatMessageRequest(RequestSchema):
+    """Mensaje del usuario para el chatbot"""
+
+    message: str
+
+    field_messages: ClassVar[Dict[str, str]] = {
+        'message': 'message debe ser una cadena de texto'
+    }
+
+    @field_validator('message')
+    @classmethod
+    def require_content(cls, value: str) -> str:
+        if not value:
+            raise ValueError('El mensaje no puede estar vacío')
+        return value
+
+
+class BulkUserRecord(CreateUserRequest):
+    """Usuario a importar junto con sus exámenes previos"""
+
+    blood_tests: List[BloodTestValues] = Field(default_factory=list)
+
+
+class BulkImportRequest(RequestSchema):
+    """Importación masiva de usuarios y exámenes de sangre"""
+
+    users: Annotated[List[BulkUserRecord], Field(min_length=1, max_length=MAX_BULK_RECORDS)]
+
+    field_messages: ClassVar[Dict[str, str]] = {
+        'users': f'users debe ser una lista de 1 a {MAX_BULK_RECORDS} registros'
+    }
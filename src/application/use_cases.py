@@ -1,9 +1,19 @@
-from typing import Dict, Any, Optional
-from datetime import datetime
+from typing import Dict, Any, Optional, Tuple, Iterator, Iterable, List, Callable
+from dataclasses import dataclass, replace
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from .schemas import CreateUserRequest, AnalyzeBloodTestRequest, ChatMessageRequest, BulkImportRequest, BLOOD_TEST_FIELDS
 from ..domain.entities import User, BloodTest, ChatConversation, ChatMessage
-from ..domain.services import BloodTestAnalysisService
-from ..infrastructure.repositories import UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository
+from ..domain.services import BloodTestAnalysisService, TrendAnalysisService
+from ..domain.value_objects import BloodTestAnalysis, PatientRiskSnapshot, RiskLevel, AnalyteTrend
+from ..infrastructure.repositories import (
+    UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository, CohortRiskRepository,
+    AnalyteTrendRepository, MessageSearchRepository, ConversationArchiveRepository, RetentionRepository
+)
 from ..infrastructure.gemini_service import GeminiService
+from ..infrastructure.metrics import track_step
+from ..infrastructure.columnar_export import BLOOD_TEST_EXPORT_COLUMNS, ParquetPartitionWriter, ExportWatermarkStore
 
 class CreateUserUseCase:
     """Caso de uso para crear un usuario"""
@@ -11,16 +21,17 @@ class CreateUserUseCase:
     def __init__(self, user_repository: UserRepository):
         self.user_repository = user_repository
     
-    def execute(self, user_data: Dict[str, Any]) -> Dict[str, Any]:
+    def execute(self, user_request: CreateUserRequest) -> Dict[str, Any]:
         # Crear nuevo usuario (sin verificar email duplicado)
         user = User.create(
-            name=user_data['name'],
-            age=user_data['age'],
-            gender=user_data['gender']
+            name=user_request.name,
+            age=user_request.age,
+            gender=user_request.gender
         )
         
         # Guardar usuario
-        saved_user = self.user_repository.save(user)
+        with track_step('create_user', 'save_user'):
+            saved_user = self.user_repository.save(user)
         
         return {
             'id': str(saved_user.id),
@@ -38,33 +49,57 @@ class AnalyzeBloodTestUseCase:
                  blood_test_repository: BloodTestRepository,
                  conversation_repository: ChatConversationRepository,
                  message_repository: ChatMessageRepository,
-                 gemini_service: GeminiService):
+                 gemini_service: GeminiService,
+                 trend_repository: Optional[AnalyteTrendRepository] = None,
+                 trend_window: int = 5,
+                 analysis_service: Optional[BloodTestAnalysisService] = None):
         self.user_repository = user_repository
         self.blood_test_repository = blood_test_repository
         self.conversation_repository = conversation_repository
         self.message_repository = message_repository
         self.gemini_service = gemini_service
-        self.analysis_service = BloodTestAnalysisService()
+        self.trend_repository = trend_repository
+        self.analysis_service = analysis_service or BloodTestAnalysisService()
+        self.trend_service = TrendAnalysisService(trend_window)
     
-    def execute(self, user_id: str, blood_test_data: Dict[str, Any]) -> Dict[str, Any]:
+    def execute(self, blood_test_request: AnalyzeBloodTestRequest) -> Dict[str, Any]:
+        user_id = blood_test_request.user_id
+        blood_test_data = blood_test_request.present_values()
+        
         # Obtener usuario
-        user = self.user_repository.get_by_id(user_id)
+        with track_step('analyze_blood_test', 'load_user'):
+            user = self.user_repository.get_by_id(user_id)
         if not user:
             raise ValueError("Usuario no encontrado")
         
         # Crear examen de sangre
-        test_date = datetime.fromisoformat(blood_test_data.get('test_date', datetime.now().isoformat()))
+        test_date = blood_test_request.test_date or datetime.utcnow()
         blood_test = BloodTest.create(
             user_id=user_id,
             test_data=blood_test_data,
             test_date=test_date
         )
         
-        # Guardar examen
-        saved_test = self.blood_test_repository.save(blood_test)
-        
         # Realizar análisis
-        analysis = self.analysis_service.analyze_blood_test(saved_test, user)
+        with track_step('analyze_blood_test', 'rule_analysis'):
+            analysis = self.analysis_service.analyze_blood_test(blood_test, user)
+        
+        # Actualizar en O(1) las tendencias del paciente con los valores informados
+        trends = {}
+        updated_trends = {}
+        if self.trend_repository is not None:
+            with track_step('analyze_blood_test', 'update_trends'):
+                trends = {trend.analyte: trend
+                          for trend in self.trend_repository.get_by_user_id(user_id, for_update=True)}
+                updated_trends = self.trend_service.update_trends(trends, user_id, blood_test_data, test_date)
+                trends.update(updated_trends)
+        
+        # Guardar examen junto con sus tendencias y su aporte a los agregados de riesgo por cohorte
+        with track_step('analyze_blood_test', 'save_blood_test'):
+            saved_test = self.blood_test_repository.save(
+                blood_test, _risk_snapshot(user, blood_test, analysis), list(updated_trends.values())
+            )
+        trends = self.trend_service.summarize(list(trends.values()))
         
         # Generar explicación con IA
         user_data = {
@@ -73,13 +108,15 @@ class AnalyzeBloodTestUseCase:
             'gender': user.gender
         }
         
-        ai_explanation = self.gemini_service.analyze_blood_test_with_ai(
-            blood_test_data, user_data, analysis.to_dict()
-        )
+        with track_step('analyze_blood_test', 'ai_explanation'):
+            ai_explanation = self.gemini_service.analyze_blood_test_with_ai(
+                blood_test_data, user_data, analysis.to_dict(), trends
+            )
         
         # Crear conversación inicial
         conversation = ChatConversation.create(user_id=user_id, blood_test_id=saved_test.id)
-        saved_conversation = self.conversation_repository.save(conversation)
+        with track_step('analyze_blood_test', 'save_conversation'):
+            saved_conversation = self.conversation_repository.save(conversation)
         
         # Crear mensaje inicial del asistente
         initial_message = ChatMessage.create(
@@ -87,12 +124,14 @@ class AnalyzeBloodTestUseCase:
             content=ai_explanation,
             sender='assistant'
         )
-        self.message_repository.save(initial_message)
+        with track_step('analyze_blood_test', 'save_message'):
+            self.message_repository.save(initial_message)
         
         return {
             'blood_test_id': str(saved_test.id),
             'conversation_id': str(saved_conversation.id),
             'analysis': analysis.to_dict(),
+            'trends': trends,
             'ai_explanation': ai_explanation
         }
 
@@ -104,22 +143,56 @@ class ChatWithUserUseCase:
                  blood_test_repository: BloodTestRepository,
                  conversation_repository: ChatConversationRepository,
                  message_repository: ChatMessageRepository,
-                 gemini_service: GeminiService):
+                 gemini_service: GeminiService,
+                 analysis_service: Optional[BloodTestAnalysisService] = None):
         self.user_repository = user_repository
         self.blood_test_repository = blood_test_repository
         self.conversation_repository = conversation_repository
         self.message_repository = message_repository
         self.gemini_service = gemini_service
-        self.analysis_service = BloodTestAnalysisService()
+        self.analysis_service = analysis_service or BloodTestAnalysisService()
+    
+    def get_conversation_owner(self, conversation_id: str) -> Optional[str]:
+        """Usuario dueño de la conversación (para límites por usuario)"""
+        return self.conversation_repository.get_user_id(conversation_id)
+    
+    def execute(self, conversation_id: str, message_request: ChatMessageRequest) -> Dict[str, Any]:
+        context = self.load_context(conversation_id)
+        user_message = message_request.message
+        
+        # Guardar mensaje del usuario
+        self._save_message(context, user_message, 'user', 'save_user_message')
+        
+        # Generar respuesta con IA
+        with track_step('chat_with_user', 'ai_response'):
+            ai_response = self.gemini_service.chat_with_user(
+                user_message, context.blood_test_data, context.user_data, context.analysis_data
+            )
+        
+        # Guardar respuesta del asistente
+        assistant_msg = self._save_message(context, ai_response, 'assistant', 'save_assistant_message')
+        
+        return {
+            'user_message': user_message,
+            'assistant_response': ai_response,
+            'timestamp': assistant_msg.timestamp.isoformat()
+        }
     
-    def execute(self, conversation_id: str, user_message: str) -> Dict[str, Any]:
+    def open_session(self, conversation_id: str) -> 'ChatSession':
+        """Abre una sesión que reutiliza el contexto en varios turnos (WebSocket)"""
+        return ChatSession(self, self.load_context(conversation_id))
+    
+    def load_context(self, conversation_id: str) -> 'ChatContext':
+        """Carga conversación, usuario, último examen y su análisis"""
         # Obtener conversación
-        conversation = self.conversation_repository.get_by_id(conversation_id)
+        with track_step('chat_with_user', 'load_conversation'):
+            conversation = self.conversation_repository.get_by_id(conversation_id)
         if not conversation:
             raise ValueError("Conversación no encontrada")
         
         # Obtener usuario
-        user = self.user_repository.get_by_id(conversation.user_id)
+        with track_step('chat_with_user', 'load_user'):
+            user = self.user_repository.get_by_id(conversation.user_id)
         if not user:
             raise ValueError("Usuario no encontrado")
         
@@ -128,10 +201,11 @@ class ChatWithUserUseCase:
         blood_test_data = {}
         analysis_data = {}
         
-        if conversation.blood_test_id:
-            blood_test = self.blood_test_repository.get_by_id(conversation.blood_test_id)
-        else:
-            blood_test = self.blood_test_repository.get_latest_by_user_id(conversation.user_id)
+        with track_step('chat_with_user', 'load_blood_test'):
+            if conversation.blood_test_id:
+                blood_test = self.blood_test_repository.get_by_id(conversation.blood_test_id)
+            else:
+                blood_test = self.blood_test_repository.get_latest_by_user_id(conversation.user_id)
         
         if blood_test:
             blood_test_data = {
@@ -150,35 +224,69 @@ class ChatWithUserUseCase:
             }
             
             # Realizar análisis del examen
-            analysis = self.analysis_service.analyze_blood_test(blood_test, user)
-            analysis_data = analysis.to_dict()
-        
-        # Guardar mensaje del usuario
-        user_msg = ChatMessage.create(
-            conversation_id=conversation_id,
-            content=user_message,
-            sender='user'
-        )
-        self.message_repository.save(user_msg)
+            with track_step('chat_with_user', 'rule_analysis'):
+                analysis = self.analysis_service.analyze_blood_test(blood_test, user)
+                analysis_data = analysis.to_dict()
         
-        # Generar respuesta con IA
         user_data = {
             'name': user.name,
             'age': user.age,
             'gender': user.gender
         }
         
-        ai_response = self.gemini_service.chat_with_user(
-            user_message, blood_test_data, user_data, analysis_data
-        )
-        
-        # Guardar respuesta del asistente
-        assistant_msg = ChatMessage.create(
+        return ChatContext(
             conversation_id=conversation_id,
-            content=ai_response,
-            sender='assistant'
+            user_id=user.id,
+            user_data=user_data,
+            blood_test_data=blood_test_data,
+            analysis_data=analysis_data
+        )
+    
+    def _save_message(self, context: 'ChatContext', content: str, sender: str, step: str) -> ChatMessage:
+        message = ChatMessage.create(
+            conversation_id=context.conversation_id,
+            content=content,
+            sender=sender
         )
-        self.message_repository.save(assistant_msg)
+        with track_step('chat_with_user', step):
+            self.message_repository.save(message)
+        return message
+
+@dataclass(frozen=True)
+class ChatContext:
+    """Datos del paciente que se reutilizan en cada turno de una conversación"""
+    conversation_id: str
+    user_id: str
+    user_data: Dict[str, Any]
+    blood_test_data: Dict[str, Any]
+    analysis_data: Dict[str, Any]
+
+class ChatSession:
+    """Sesión de chat de larga duración: el contexto se carga una sola vez"""
+    
+    def __init__(self, use_case: ChatWithUserUseCase, context: ChatContext):
+        self.use_case = use_case
+        self.context = context
+    
+    def stream_reply(self, message_request: ChatMessageRequest) -> Iterator[str]:
+        """
+        Guarda el mensaje del usuario, emite la respuesta del asistente por fragmentos
+        y la guarda al completarse. Devuelve (StopIteration.value) el resultado del turno.
+        """
+        context = self.context
+        user_message = message_request.message
+        self.use_case._save_message(context, user_message, 'user', 'save_user_message')
+        
+        chunks = []
+        with track_step('chat_session', 'ai_stream'):
+            for chunk in self.use_case.gemini_service.stream_chat_with_user(
+                user_message, context.blood_test_data, context.user_data, context.analysis_data
+            ):
+                chunks.append(chunk)
+                yield chunk
+        
+        ai_response = ''.join(chunks)
+        assistant_msg = self.use_case._save_message(context, ai_response, 'assistant', 'save_assistant_message')
         
         return {
             'user_message': user_message,
@@ -186,28 +294,106 @@ class ChatWithUserUseCase:
             'timestamp': assistant_msg.timestamp.isoformat()
         }
 
+class BulkImportUseCase:
+    """Caso de uso para importar usuarios y exámenes de sangre en bloque"""
+    
+    def __init__(self,
+                 user_repository: UserRepository,
+                 blood_test_repository: BloodTestRepository,
+                 trend_window: int = 5,
+                 analysis_service: Optional[BloodTestAnalysisService] = None):
+        self.user_repository = user_repository
+        self.blood_test_repository = blood_test_repository
+        self.analysis_service = analysis_service or BloodTestAnalysisService()
+        self.trend_service = TrendAnalysisService(trend_window)
+    
+    def execute(self, import_request: BulkImportRequest) -> Dict[str, Any]:
+        users = []
+        blood_tests = []
+        now = datetime.utcnow()
+        
+        trends = []
+        
+        for record in import_request.users:
+            user = User.create(name=record.name, age=record.age, gender=record.gender)
+            users.append(user)
+            user_trends: Dict[str, AnalyteTrend] = {}
+            for values in sorted(record.blood_tests, key=lambda values: values.test_date or now):
+                blood_tests.append(BloodTest.create(
+                    user_id=user.id,
+                    test_data=values.present_values(),
+                    test_date=values.test_date or now
+                ))
+                user_trends.update(self.trend_service.update_trends(
+                    user_trends, user.id, values.present_values(), values.test_date or now
+                ))
+            trends.extend(user_trends.values())
+        
+        # Los usuarios son nuevos: su último examen importado es su riesgo actual
+        with track_step('bulk_import', 'rule_analysis'):
+            users_by_id = {user.id: user for user in users}
+            latest_tests = {}
+            for test in blood_tests:
+                latest = latest_tests.get(test.user_id)
+                if latest is None or (test.test_date, test.id) > (latest.test_date, latest.id):
+                    latest_tests[test.user_id] = test
+            risks = [
+                _risk_snapshot(users_by_id[user_id], test,
+                               self.analysis_service.analyze_blood_test(_with_defaults(test), users_by_id[user_id]))
+                for user_id, test in latest_tests.items()
+            ]
+        
+        # Guardar en una sola transacción por tipo de entidad; tendencias y agregados de cohortes, con los exámenes
+        with track_step('bulk_import', 'save_users'):
+            self.user_repository.save_all(users)
+        with track_step('bulk_import', 'save_blood_tests'):
+            self.blood_test_repository.save_all(blood_tests, risks, trends)
+        
+        return {
+            'imported_users': len(users),
+            'imported_blood_tests': len(blood_tests),
+            'user_ids': [str(user.id) for user in users]
+        }
+
 class GetUserHistoryUseCase:
     """Caso de uso para obtener el historial de un usuario"""
     
     def __init__(self,
                  user_repository: UserRepository,
                  blood_test_repository: BloodTestRepository,
-                 conversation_repository: ChatConversationRepository):
+                 conversation_repository: ChatConversationRepository,
+                 trend_repository: Optional[AnalyteTrendRepository] = None):
         self.user_repository = user_repository
         self.blood_test_repository = blood_test_repository
         self.conversation_repository = conversation_repository
+        self.trend_repository = trend_repository
+        self.trend_service = TrendAnalysisService()
+    
+    def get_version(self, user_id: str) -> Optional[Tuple[int, datetime]]:
+        """Versión del historial para validar cachés sin construir la respuesta"""
+        with track_step('get_user_history', 'load_version'):
+            return self.user_repository.get_history_version(user_id)
     
     def execute(self, user_id: str) -> Dict[str, Any]:
         # Verificar que el usuario existe
-        user = self.user_repository.get_by_id(user_id)
+        with track_step('get_user_history', 'load_user'):
+            user = self.user_repository.get_by_id(user_id)
         if not user:
             raise ValueError("Usuario no encontrado")
         
         # Obtener exámenes de sangre
-        blood_tests = self.blood_test_repository.get_by_user_id(user_id)
+        with track_step('get_user_history', 'load_blood_tests'):
+            blood_tests = self.blood_test_repository.get_panel_by_user_id(user_id)
         
         # Obtener conversaciones
-        conversations = self.conversation_repository.get_by_user_id(user_id)
+        with track_step('get_user_history', 'load_conversations'):
+            conversations = self.conversation_repository.list_by_user_id(user_id)
+        
+        # Obtener tendencias precalculadas
+        trends = []
+        if self.trend_repository is not None:
+            with track_step('get_user_history', 'load_trends'):
+                trends = self.trend_service.summarize(self.trend_repository.get_by_user_id(user_id))
         
         return {
             'user': {
@@ -218,19 +404,488 @@ class GetUserHistoryUseCase:
             },
             'blood_tests': [
                 {
-                    'id': str(test.id),
-                    'glucose': test.glucose,
-                    'cholesterol': test.cholesterol,
-                    'test_date': test.test_date.isoformat(),
-                    'created_at': test.created_at.isoformat()
-                } for test in blood_tests
+                    'id': str(blood_tests.ids[index]),
+                    'glucose': blood_tests.value('glucose', index),
+                    'cholesterol': blood_tests.value('cholesterol', index),
+                    'test_date': blood_tests.test_dates[index].isoformat(),
+                    'created_at': blood_tests.created_ats[index].isoformat()
+                } for index in range(len(blood_tests))
             ],
             'conversations': [
                 {
                     'id': str(conv.id),
                     'blood_test_id': str(conv.blood_test_id) if conv.blood_test_id else None,
                     'created_at': conv.created_at.isoformat(),
-                    'message_count': len(conv.messages)
+                    'message_count': conv.message_count,
+                    'last_message_at': conv.last_message_at.isoformat() if conv.last_message_at else None,
+                    'last_sender': conv.last_sender
                 } for conv in conversations
-            ]
+            ],
+            'trends': trends
+        }
+
+class ExportUserRecordsUseCase:
+    """
+    Caso de uso para exportar el expediente completo de usuarios (datos, exámenes,
+    conversaciones y mensajes) como una secuencia de registros, uno por fila
+    """
+    
+    def __init__(self,
+                 user_repository: UserRepository,
+                 blood_test_repository: BloodTestRepository,
+                 conversation_repository: ChatConversationRepository,
+                 message_repository: ChatMessageRepository,
+                 batch_size: int = 500):
+        self.user_repository = user_repository
+        self.blood_test_repository = blood_test_repository
+        self.conversation_repository = conversation_repository
+        self.message_repository = message_repository
+        self.batch_size = batch_size
+    
+    def execute(self, user_id: str) -> Iterator[Dict[str, Any]]:
+        # El usuario se valida antes de empezar a generar registros
+        with track_step('export_user_records', 'load_user'):
+            user = self.user_repository.get_by_id(user_id)
+        if not user:
+            raise ValueError("Usuario no encontrado")
+        
+        return self._user_records(user)
+    
+    def execute_all(self) -> Iterator[Dict[str, Any]]:
+        """Exporta todos los usuarios, uno tras otro"""
+        for user in self.user_repository.iter_all(self.batch_size):
+            yield from self._user_records(user)
+    
+    def _user_records(self, user: User) -> Iterator[Dict[str, Any]]:
+        yield {
+            'type': 'user',
+            'id': str(user.id),
+            'name': user.name,
+            'age': user.age,
+            'gender': user.gender,
+            'created_at': user.created_at.isoformat() if user.created_at else None
+        }
+        
+        for test in self.blood_test_repository.iter_by_user_id(user.id, self.batch_size):
+            yield {
+                'type': 'blood_test',
+                'id': str(test.id),
+                'user_id': str(test.user_id),
+                'glucose': test.glucose,
+                'cholesterol': test.cholesterol,
+                'hdl_cholesterol': test.hdl_cholesterol,
+                'ldl_cholesterol': test.ldl_cholesterol,
+                'triglycerides': test.triglycerides,
+                'hemoglobin': test.hemoglobin,
+                'hematocrit': test.hematocrit,
+                'white_blood_cells': test.white_blood_cells,
+                'red_blood_cells': test.red_blood_cells,
+                'platelets': test.platelets,
+                'creatinine': test.creatinine,
+                'urea': test.urea,
+                'test_date': test.test_date.isoformat(),
+                'created_at': test.created_at.isoformat() if test.created_at else None
+            }
+        
+        for conv in self.conversation_repository.iter_by_user_id(user.id, self.batch_size):
+            yield {
+                'type': 'conversation',
+                'id': str(conv.id),
+                'user_id': str(conv.user_id),
+                'blood_test_id': str(conv.blood_test_id) if conv.blood_test_id else None,
+                'created_at': conv.created_at.isoformat() if conv.created_at else None
+            }
+        
+        for msg in self.message_repository.iter_by_user_id(user.id, self.batch_size):
+            yield {
+                'type': 'message',
+                'id': str(msg.id),
+                'conversation_id': str(msg.conversation_id),
+                'sender': msg.sender,
+                'content': msg.content,
+                'timestamp': msg.timestamp.isoformat() if msg.timestamp else None
+            }
+
+class ExportBloodTestsToParquetUseCase:
+    """
+    Caso de uso para exportar los exámenes de sangre a Parquet particionado por mes,
+    con la clasificación de riesgo de las reglas de dominio. Por defecto solo exporta
+    los exámenes creados después de la última marca de agua.
+    """
+    
+    def __init__(self, blood_test_repository: BloodTestRepository, batch_size: int = 5000,
+                 analysis_service: Optional[BloodTestAnalysisService] = None):
+        self.blood_test_repository = blood_test_repository
+        self.batch_size = batch_size
+        self.analysis_service = analysis_service or BloodTestAnalysisService()
+    
+    def execute(self, output_dir: str, full: bool = False) -> Dict[str, Any]:
+        watermark_store = ExportWatermarkStore(output_dir)
+        writer = ParquetPartitionWriter(output_dir, run_id=datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+        # La exportación completa parte de cero, pero el dataset anterior y su marca de agua
+        # se conservan hasta que la nueva ejecución se publica
+        watermark = None if full else watermark_store.load()
+        rows = self.blood_test_repository.iter_with_users_since(watermark, self.batch_size)
+        last_test = None
+        exported = 0
+        try:
+            for chunk in _chunked(rows, self.batch_size):
+                with track_step('export_blood_tests', 'write_batch'):
+                    for partition, columns in self._to_columns(chunk).items():
+                        writer.write(partition, columns)
+                last_test = chunk[-1][0]
+                exported += len(chunk)
+        except Exception:
+            writer.abort()
+            raise
+        
+        partitions = writer.commit()
+        if last_test is not None:
+            watermark = (last_test.created_at, last_test.id)
+            watermark_store.save(watermark, exported)
+        elif full:
+            watermark_store.clear()
+        if full:
+            writer.remove_previous_runs()
+        
+        return {
+            'rows': exported,
+            'partitions': partitions,
+            'watermark': watermark[0].isoformat() if watermark else None
         }
+    
+    def _to_columns(self, chunk: List[Tuple[BloodTest, User]]) -> Dict[str, Dict[str, list]]:
+        """Agrupa el lote por mes de test_date y lo convierte a columnas"""
+        partitions: Dict[str, Dict[str, list]] = {}
+        for test, user in chunk:
+            partition = test.test_date.strftime('%Y-%m')
+            columns = partitions.get(partition)
+            if columns is None:
+                columns = partitions[partition] = {name: [] for name, _ in BLOOD_TEST_EXPORT_COLUMNS}
+            
+            analysis = self.analysis_service.analyze_blood_test(_with_defaults(test), user)
+            
+            columns['id'].append(test.id)
+            columns['user_id'].append(test.user_id)
+            columns['user_age'].append(user.age)
+            columns['user_gender'].append(user.gender)
+            for field in BLOOD_TEST_FIELDS:
+                columns[field].append(getattr(test, field))
+            columns['test_date'].append(test.test_date)
+            columns['created_at'].append(test.created_at)
+            columns['overall_risk'].append(analysis.overall_risk.value)
+            columns['needs_doctor_consultation'].append(analysis.needs_doctor_consultation)
+        return partitions
+
+class CohortAnalyticsUseCase:
+    """
+    Caso de uso del panel de riesgo por cohortes (banda de edad y género). Lee los
+    agregados materializados, cuyo tamaño no depende del número de pacientes.
+    """
+    
+    def __init__(self,
+                 cohort_repository: CohortRiskRepository,
+                 blood_test_repository: BloodTestRepository,
+                 batch_size: int = 500,
+                 analysis_service: Optional[BloodTestAnalysisService] = None):
+        self.cohort_repository = cohort_repository
+        self.blood_test_repository = blood_test_repository
+        self.batch_size = batch_size
+        self.analysis_service = analysis_service or BloodTestAnalysisService()
+    
+    def execute(self) -> Dict[str, Any]:
+        with track_step('cohort_analytics', 'load_aggregates'):
+            aggregates = self.cohort_repository.get_aggregates()
+        
+        cohorts: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        totals = {'risk_levels': {level.value: 0 for level in RiskLevel}, 'risk_factors': {}}
+        for age_band, gender, dimension, value, count in aggregates:
+            cohort = cohorts.get((age_band, gender))
+            if cohort is None:
+                cohort = cohorts[(age_band, gender)] = {
+                    'age_band': age_band,
+                    'gender': gender,
+                    'patients': 0,
+                    'risk_levels': {level.value: 0 for level in RiskLevel},
+                    'risk_factors': {}
+                }
+            if dimension == 'risk_level':
+                # Cada paciente aporta exactamente un nivel de riesgo
+                cohort['patients'] += count
+                cohort['risk_levels'][value] = count
+                totals['risk_levels'][value] += count
+            else:
+                cohort['risk_factors'][value] = count
+                totals['risk_factors'][value] = totals['risk_factors'].get(value, 0) + count
+        
+        return {
+            'total_patients': sum(totals['risk_levels'].values()),
+            'risk_levels': totals['risk_levels'],
+            'risk_factors': totals['risk_factors'],
+            'cohorts': [cohorts[key] for key in sorted(cohorts)]
+        }
+    
+    def rebuild(self) -> int:
+        """Recalcula los agregados con el último examen de cada paciente"""
+        def snapshots():
+            for test, user in self.blood_test_repository.iter_latest_with_users(self.batch_size):
+                yield _risk_snapshot(user, test, self.analysis_service.analyze_blood_test(_with_defaults(test), user))
+        
+        with track_step('cohort_analytics', 'rebuild'):
+            return self.cohort_repository.replace_all(snapshots())
+
+class RebuildAnalyteTrendsUseCase:
+    """Caso de uso para recalcular las tendencias de todos los pacientes desde su historial"""
+    
+    def __init__(self,
+                 user_repository: UserRepository,
+                 blood_test_repository: BloodTestRepository,
+                 trend_repository: AnalyteTrendRepository,
+                 trend_window: int = 5,
+                 batch_size: int = 500):
+        self.user_repository = user_repository
+        self.blood_test_repository = blood_test_repository
+        self.trend_repository = trend_repository
+        self.trend_service = TrendAnalysisService(trend_window)
+        self.batch_size = batch_size
+    
+    def execute(self) -> int:
+        """Devuelve el número de pacientes procesados"""
+        patients = 0
+        for user in self.user_repository.iter_all(self.batch_size):
+            trends: Dict[str, AnalyteTrend] = {}
+            with track_step('rebuild_trends', 'scan_history'):
+                for test in self.blood_test_repository.iter_by_user_id(user.id, self.batch_size):
+                    # Los valores no informados se guardan como 0: no forman parte de la tendencia
+                    values = {field: getattr(test, field) for field in BLOOD_TEST_FIELDS if getattr(test, field)}
+                    trends.update(self.trend_service.update_trends(trends, user.id, values, test.test_date))
+            with track_step('rebuild_trends', 'save_trends'):
+                self.trend_repository.replace_for_user(user.id, list(trends.values()))
+            patients += 1
+        return patients
+
+class PurgeExpiredDataUseCase:
+    """
+    Caso de uso para aplicar las políticas de retención: borra los mensajes (archivados y
+    vigentes) con más de message_max_days días y los usuarios sin actividad en
+    inactive_user_days días, con todos sus datos. Borra por lotes de chunk_size filas y se
+    detiene al agotar el presupuesto de tiempo o de filas; la siguiente ejecución continúa
+    donde quedó. Una política en None no se aplica.
+    """
+    
+    def __init__(self, retention_repository: RetentionRepository,
+                 message_max_days: Optional[int] = None,
+                 inactive_user_days: Optional[int] = None,
+                 chunk_size: int = 500,
+                 max_seconds: Optional[float] = 60.0,
+                 max_rows: Optional[int] = 100000):
+        self.retention_repository = retention_repository
+        self.message_max_days = message_max_days
+        self.inactive_user_days = inactive_user_days
+        self.chunk_size = chunk_size
+        self.max_seconds = max_seconds
+        self.max_rows = max_rows
+    
+    def execute(self, message_max_days: Optional[int] = None, inactive_user_days: Optional[int] = None,
+                max_seconds: Optional[float] = None, max_rows: Optional[int] = None,
+                on_progress: Optional[Callable[[str, int, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """on_progress(fase, filas del lote, informe acumulado) se llama tras cada lote"""
+        message_max_days = self.message_max_days if message_max_days is None else message_max_days
+        inactive_user_days = self.inactive_user_days if inactive_user_days is None else inactive_user_days
+        if message_max_days is None and inactive_user_days is None:
+            raise ValueError("No hay políticas de retención configuradas")
+        if any(days is not None and days < 0 for days in (message_max_days, inactive_user_days)):
+            raise ValueError("Los plazos de retención no pueden ser negativos")
+        
+        budget = _PurgeBudget(self.max_seconds if max_seconds is None else max_seconds,
+                              self.max_rows if max_rows is None else max_rows)
+        report = {'archived_conversations': 0, 'messages': 0, 'users': 0, 'user_rows': 0, 'rows': 0}
+        
+        def record(phase: str, rows: int) -> None:
+            report['rows'] += rows
+            budget.spend(rows)
+            if on_progress is not None:
+                on_progress(phase, rows, report)
+        
+        completed = True
+        if message_max_days is not None:
+            # Mismo reloj que las entidades, history_updated_at y los valores por defecto de las tablas (UTC)
+            cutoff = datetime.utcnow() - timedelta(days=message_max_days)
+            for phase, purge in (('archived_conversations', self.retention_repository.purge_archives_before),
+                                 ('messages', self.retention_repository.purge_messages_before)):
+                while completed:
+                    if budget.exhausted():
+                        completed = False
+                        break
+                    with track_step('purge_expired_data', phase):
+                        deleted = purge(cutoff, self.chunk_size)
+                    if not deleted:
+                        break
+                    report[phase] += deleted
+                    record(phase, deleted)
+        
+        if inactive_user_days is not None and completed:
+            inactive_since = datetime.utcnow() - timedelta(days=inactive_user_days)
+            while completed:
+                user_ids = self.retention_repository.find_inactive_users(inactive_since, self.chunk_size)
+                if not user_ids:
+                    break
+                for user_id in user_ids:
+                    done = False
+                    while not done:
+                        if budget.exhausted():
+                            completed = False
+                            break
+                        with track_step('purge_expired_data', 'users'):
+                            deleted, done = self.retention_repository.purge_user(user_id, self.chunk_size)
+                        report['user_rows'] += deleted
+                        report['users'] += done
+                        record('users', deleted)
+                    if not completed:
+                        break
+        
+        return {
+            'message_max_days': message_max_days,
+            'inactive_user_days': inactive_user_days,
+            **report,
+            'elapsed_seconds': round(budget.elapsed(), 3),
+            # False si se agotó el presupuesto antes de terminar
+            'completed': completed
+        }
+
+class _PurgeBudget:
+    """Presupuesto de una depuración; se comprueba entre lotes, así que un lote puede excederlo"""
+    
+    def __init__(self, max_seconds: Optional[float], max_rows: Optional[int]):
+        self.started = time.monotonic()
+        self.max_seconds = max_seconds
+        self.rows_left = max_rows
+    
+    def spend(self, rows: int) -> None:
+        if self.rows_left is not None:
+            self.rows_left -= rows
+    
+    def exhausted(self) -> bool:
+        if self.rows_left is not None and self.rows_left <= 0:
+            return True
+        return self.max_seconds is not None and self.elapsed() >= self.max_seconds
+    
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+class RepairConversationCountersUseCase:
+    """
+    Caso de uso para recalcular los contadores desnormalizados de las conversaciones (mensajes,
+    última actividad y último emisor): backfill tras actualizar y reparación ante desvíos
+    """
+    
+    def __init__(self, conversation_repository: ChatConversationRepository, batch_size: int = 500):
+        self.conversation_repository = conversation_repository
+        self.batch_size = batch_size
+    
+    def execute(self) -> Dict[str, int]:
+        with track_step('repair_conversation_counters', 'repair'):
+            checked, corrected = self.conversation_repository.repair_counters(self.batch_size)
+        return {'conversations': checked, 'corrected': corrected}
+
+class SearchMessagesUseCase:
+    """Caso de uso para buscar mensajes de chat por texto, con resultados paginados"""
+    
+    MAX_PER_PAGE = 100
+    
+    def __init__(self, search_repository: MessageSearchRepository):
+        self.search_repository = search_repository
+    
+    def execute(self, query: str, page: int = 1, per_page: int = 20,
+                user_id: Optional[str] = None) -> Dict[str, Any]:
+        query = (query or '').strip()
+        if not query:
+            raise ValueError("Indique el texto a buscar (parámetro q)")
+        if page < 1:
+            raise ValueError("La página debe ser mayor o igual a 1")
+        per_page = max(1, min(per_page, self.MAX_PER_PAGE))
+        
+        with track_step('search_messages', 'search'):
+            total, results = self.search_repository.search(
+                query, limit=per_page, offset=(page - 1) * per_page, user_id=user_id
+            )
+        
+        return {
+            'query': query,
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'pages': (total + per_page - 1) // per_page,
+            'backend': self.search_repository.backend,
+            'results': [result.to_dict() for result in results]
+        }
+    
+    def rebuild_index(self) -> int:
+        """Reindexa todos los mensajes existentes; devuelve cuántos quedaron indexados"""
+        return self.search_repository.rebuild()
+
+class ArchiveIdleConversationsUseCase:
+    """
+    Caso de uso para archivar las conversaciones sin mensajes nuevos en idle_days días: sus
+    mensajes salen de chat_messages y se guardan comprimidos, una conversación por fila. Avanza
+    en lotes pequeños (transacciones cortas) con una pausa entre lotes para no competir con el
+    tráfico; si se interrumpe, la siguiente ejecución retoma lo pendiente.
+    """
+    
+    def __init__(self, archive_repository: ConversationArchiveRepository, idle_days: int = 90,
+                 batch_size: int = 50, pause_seconds: float = 0.0):
+        self.archive_repository = archive_repository
+        self.idle_days = idle_days
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+    
+    def execute(self, idle_days: Optional[int] = None, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        idle_days = self.idle_days if idle_days is None else idle_days
+        if idle_days < 0:
+            raise ValueError("Los días de inactividad no pueden ser negativos")
+        # Las fechas de los mensajes están en UTC (ChatMessage.create usa datetime.utcnow)
+        idle_before = datetime.utcnow() - timedelta(days=idle_days)
+        
+        totals = {'batches': 0, 'conversations': 0, 'messages': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+        after_conversation_id = None
+        while max_batches is None or totals['batches'] < max_batches:
+            with track_step('archive_conversations', 'archive_batch'):
+                result = self.archive_repository.archive_batch(idle_before, self.batch_size, after_conversation_id)
+            if result.last_conversation_id is None:
+                break
+            totals['batches'] += 1
+            totals['conversations'] += result.conversations
+            totals['messages'] += result.messages
+            totals['raw_bytes'] += result.raw_bytes
+            totals['compressed_bytes'] += result.compressed_bytes
+            after_conversation_id = result.last_conversation_id
+            if self.pause_seconds > 0:
+                time.sleep(self.pause_seconds)
+        
+        return {'idle_before': idle_before.isoformat(), **totals}
+    
+    def stats(self) -> Dict[str, Any]:
+        return self.archive_repository.stats()
+
+def _risk_snapshot(user: User, blood_test: BloodTest, analysis: BloodTestAnalysis) -> PatientRiskSnapshot:
+    return PatientRiskSnapshot.create(
+        user_id=user.id,
+        age=user.age,
+        gender=user.gender,
+        blood_test_id=blood_test.id,
+        test_date=blood_test.test_date,
+        analysis=analysis
+    )
+
+def _with_defaults(blood_test: BloodTest) -> BloodTest:
+    """Las reglas de dominio esperan valores numéricos; los ausentes se evalúan como 0"""
+    missing = {field: 0.0 for field in BLOOD_TEST_FIELDS if getattr(blood_test, field) is None}
+    return replace(blood_test, **missing) if missing else blood_test
+
+def _chunked(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,11 +1,19 @@
+from array import array
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List
-import uuid
+from math import isnan
+from typing import Iterable, Iterator, Optional, List, Sequence
+from ..identifiers import new_id, routing_tag, id_routing_tag
+
+# Las entidades declaran __slots__ a mano (sin __dict__ por instancia): los trabajos masivos
+# y el historial materializan miles de ellas. Ningún campo tiene valor por defecto, requisito
+# para combinar __slots__ con @dataclass.
 
 @dataclass
 class User:
     """Entidad Usuario del dominio"""
+    __slots__ = ('id', 'name', 'age', 'gender', 'created_at')
+    
     id: str
     name: str
     age: int
@@ -15,16 +23,20 @@ class User:
     @classmethod
     def create(cls, name: str, age: int, gender: str) -> 'User':
         return cls(
-            id=str(uuid.uuid4()),
+            id=new_id(),
             name=name,
             age=age,
             gender=gender,
-            created_at=datetime.now()
+            created_at=datetime.utcnow()
         )
 
 @dataclass
 class BloodTest:
     """Entidad Examen de Sangre"""
+    __slots__ = ('id', 'user_id', 'glucose', 'cholesterol', 'hdl_cholesterol', 'ldl_cholesterol',
+                 'triglycerides', 'hemoglobin', 'hematocrit', 'white_blood_cells', 'red_blood_cells',
+                 'platelets', 'creatinine', 'urea', 'test_date', 'created_at')
+    
     id: str
     user_id: str
     glucose: float
@@ -45,7 +57,7 @@ class BloodTest:
     @classmethod
     def create(cls, user_id: str, test_data: dict, test_date: datetime) -> 'BloodTest':
         return cls(
-            id=str(uuid.uuid4()),
+            id=new_id(routing_tag(user_id)),
             user_id=user_id,
             glucose=test_data.get('glucose', 0.0),
             cholesterol=test_data.get('cholesterol', 0.0),
@@ -60,12 +72,14 @@ class BloodTest:
             creatinine=test_data.get('creatinine', 0.0),
             urea=test_data.get('urea', 0.0),
             test_date=test_date,
-            created_at=datetime.now()
+            created_at=datetime.utcnow()
         )
 
 @dataclass
 class ChatConversation:
     """Entidad Conversación de Chat"""
+    __slots__ = ('id', 'user_id', 'blood_test_id', 'messages', 'created_at')
+    
     id: str
     user_id: str
     blood_test_id: Optional[str]
@@ -75,11 +89,11 @@ class ChatConversation:
     @classmethod
     def create(cls, user_id: str, blood_test_id: Optional[str] = None) -> 'ChatConversation':
         return cls(
-            id=str(uuid.uuid4()),
+            id=new_id(routing_tag(user_id)),
             user_id=user_id,
             blood_test_id=blood_test_id,
             messages=[],
-            created_at=datetime.now()
+            created_at=datetime.utcnow()
         )
     
     def add_message(self, message: 'ChatMessage'):
@@ -88,6 +102,8 @@ class ChatConversation:
 @dataclass
 class ChatMessage:
     """Entidad Mensaje de Chat"""
+    __slots__ = ('id', 'conversation_id', 'content', 'sender', 'timestamp')
+    
     id: str
     conversation_id: str
     content: str
@@ -97,9 +113,88 @@ class ChatMessage:
     @classmethod
     def create(cls, conversation_id: str, content: str, sender: str) -> 'ChatMessage':
         return cls(
-            id=str(uuid.uuid4()),
+            id=new_id(id_routing_tag(conversation_id)),
             conversation_id=conversation_id,
             content=content,
             sender=sender,
-            timestamp=datetime.now()
+            timestamp=datetime.utcnow()
+        )
+
+class BloodTestPanel:
+    """
+    Lote de exámenes de sangre como estructura de arreglos: una columna array('d') por
+    analito (8 bytes por valor, sin objetos float) y listas para ids y fechas. Pensado para
+    historiales y trabajos masivos que recorren miles de exámenes; los valores ausentes
+    se guardan como NaN y se devuelven como None.
+    """
+    
+    ANALYTES = ('glucose', 'cholesterol', 'hdl_cholesterol', 'ldl_cholesterol', 'triglycerides',
+                'hemoglobin', 'hematocrit', 'white_blood_cells', 'red_blood_cells', 'platelets',
+                'creatinine', 'urea')
+    # Orden de las filas que acepta from_rows (el mismo que los campos de BloodTest)
+    ROW_FIELDS = ('id', 'user_id') + ANALYTES + ('test_date', 'created_at')
+    
+    __slots__ = ('ids', 'user_ids', 'test_dates', 'created_ats', 'columns')
+    
+    def __init__(self):
+        self.ids: List[str] = []
+        self.user_ids: List[str] = []
+        self.test_dates: List[datetime] = []
+        self.created_ats: List[datetime] = []
+        self.columns = {analyte: array('d') for analyte in self.ANALYTES}
+    
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence]) -> 'BloodTestPanel':
+        """Construye el lote desde filas (tuplas o filas de SQLAlchemy) en el orden de ROW_FIELDS"""
+        panel = cls()
+        for row in rows:
+            panel.append_row(row)
+        return panel
+    
+    @classmethod
+    def from_blood_tests(cls, blood_tests: Iterable[BloodTest]) -> 'BloodTestPanel':
+        panel = cls()
+        for blood_test in blood_tests:
+            panel.append(blood_test)
+        return panel
+    
+    def append_row(self, row: Sequence) -> None:
+        self.ids.append(row[0])
+        self.user_ids.append(row[1])
+        for position, analyte in enumerate(self.ANALYTES, start=2):
+            value = row[position]
+            self.columns[analyte].append(float('nan') if value is None else value)
+        self.test_dates.append(row[14])
+        self.created_ats.append(row[15])
+    
+    def append(self, blood_test: BloodTest) -> None:
+        self.append_row([getattr(blood_test, name) for name in self.ROW_FIELDS])
+    
+    def value(self, analyte: str, index: int) -> Optional[float]:
+        value = self.columns[analyte][index]
+        return None if isnan(value) else value
+    
+    def column(self, analyte: str) -> array:
+        """Columna completa del analito (NaN donde no fue informado)"""
+        return self.columns[analyte]
+    
+    def nbytes(self) -> int:
+        """Bytes ocupados por las columnas numéricas"""
+        return sum(column.itemsize * len(column) for column in self.columns.values())
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __getitem__(self, index: int) -> BloodTest:
+        """Materializa un examen como entidad"""
+        return BloodTest(
+            self.ids[index],
+            self.user_ids[index],
+            *(self.value(analyte, index) for analyte in self.ANALYTES),
+            self.test_dates[index],
+            self.created_ats[index]
         )
+    
+    def __iter__(self) -> Iterator[BloodTest]:
+        for index in range(len(self.ids)):
+            yield self[index]
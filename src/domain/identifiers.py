@@ -0,0 +1,89 @@
+"""
+Identificadores ordenados por tiempo (UUIDv7, RFC 9562) para las entidades del dominio.
+
+Los primeros 48 bits son el instante de creación en milisegundos: las inserciones caen al
+final del índice de la clave primaria en vez de dispersarse por todo el árbol, como ocurre
+con uuid4. Conservan el formato de texto de 36 caracteres, así que conviven con los
+identificadores uuid4 existentes.
+
+Los datos de un paciente (exámenes, conversaciones, mensajes) llevan en su último byte la
+etiqueta de enrutamiento del usuario: sabiendo solo el id de una conversación se puede
+saber en qué shard vive, sin consultar nada.
+"""
+import os
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+_COUNTER_BITS = 12
+_MAX_COUNTER = (1 << _COUNTER_BITS) - 1
+
+ROUTING_TAG_BITS = 8
+_ROUTING_TAG_MASK = (1 << ROUTING_TAG_BITS) - 1
+
+_lock = threading.Lock()
+_last_millis = 0
+_counter = 0
+
+
+def new_uuid7(tag: Optional[int] = None) -> uuid.UUID:
+    """
+    UUIDv7 monótono dentro del proceso: en el mismo milisegundo los 12 bits de rand_a se usan
+    como contador (método 1 de la RFC), de modo que los ids generados en orden se ordenan igual.
+    Con tag, los 8 bits finales de rand_b son la etiqueta de enrutamiento.
+    """
+    global _last_millis, _counter
+    with _lock:
+        millis = time.time_ns() // 1_000_000
+        if millis > _last_millis:
+            _last_millis = millis
+            _counter = int.from_bytes(os.urandom(2), 'big') & (_MAX_COUNTER >> 1)
+        else:
+            # Mismo milisegundo (o reloj hacia atrás): se avanza el contador sobre el último instante
+            _counter += 1
+            if _counter > _MAX_COUNTER:
+                _last_millis += 1
+                _counter = 0
+        millis, counter = _last_millis, _counter
+
+    random_bits = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    if tag is not None:
+        random_bits = (random_bits & ~_ROUTING_TAG_MASK) | (tag & _ROUTING_TAG_MASK)
+    value = (millis << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | random_bits
+    return uuid.UUID(int=value)
+
+
+def new_id(tag: Optional[int] = None) -> str:
+    """Nuevo identificador de entidad (UUIDv7 en texto), opcionalmente con etiqueta de enrutamiento"""
+    return str(new_uuid7(tag))
+
+
+def routing_tag(user_id: str) -> int:
+    """Etiqueta de enrutamiento de un usuario: hash estable (crc32) de su id, de 0 a 255"""
+    try:
+        key = uuid.UUID(str(user_id)).bytes
+    except ValueError:
+        key = str(user_id).encode('utf-8')
+    return zlib.crc32(key) & _ROUTING_TAG_MASK
+
+
+def id_routing_tag(identifier: str) -> Optional[int]:
+    """Etiqueta de enrutamiento guardada en el id de un dato del paciente; None si no es un UUID"""
+    try:
+        return uuid.UUID(str(identifier)).int & _ROUTING_TAG_MASK
+    except ValueError:
+        return None
+
+
+def id_created_at(identifier: str) -> Optional[datetime]:
+    """Instante (UTC) codificado en un UUIDv7; None para otras versiones, p. ej. uuid4"""
+    try:
+        value = uuid.UUID(identifier)
+    except ValueError:
+        return None
+    if value.version != 7:
+        return None
+    return datetime.fromtimestamp((value.int >> 80) / 1000, tz=timezone.utc)
@@ -1,238 +1,163 @@
-from typing import List
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
 from ..entities import BloodTest, User
-from ..value_objects import BloodTestAnalysis, RiskLevel, Recommendation, RecommendationType, BloodTestRanges
+from ..value_objects import (
+    BloodTestAnalysis, RiskLevel, PanelResult, PanelStatus, SECTION_RECOMMENDATIONS, AnalyteTrend
+)
+from ..value_objects.reference_ranges import ReferenceRuleset, default_ruleset, reference_sex
 
 class BloodTestAnalysisService:
-    """Servicio de dominio para analizar exámenes de sangre"""
+    """Servicio de dominio para analizar exámenes de sangre según un ruleset de rangos de referencia"""
     
-    def __init__(self):
-        self.ranges = BloodTestRanges()
+    def __init__(self, ruleset_provider: Optional[Callable[[], ReferenceRuleset]] = None):
+        # El proveedor permite recargar el ruleset en caliente sin recrear el servicio
+        self.ruleset_provider = ruleset_provider or default_ruleset
+    
+    @property
+    def ruleset_version(self) -> str:
+        return self.ruleset_provider().version
     
     def analyze_blood_test(self, blood_test: BloodTest, user: User) -> BloodTestAnalysis:
-        """Analiza un examen de sangre y retorna el análisis"""
-        
-        # Análisis de glucosa
-        glucose_status = self._analyze_glucose(blood_test.glucose)
-        
-        # Análisis de colesterol
-        cholesterol_status = self._analyze_cholesterol(blood_test)
-        
-        # Análisis de función renal
-        kidney_status = self._analyze_kidney_function(blood_test, user)
-        
-        # Análisis de hemograma
-        blood_count_status = self._analyze_blood_count(blood_test, user)
-        
-        # Evaluar riesgo general
-        overall_risk = self._calculate_overall_risk(
-            glucose_status, cholesterol_status, kidney_status, blood_count_status
-        )
-        
-        # Generar recomendaciones
-        recommendations = self._generate_recommendations(
-            blood_test, user, glucose_status, cholesterol_status, kidney_status, blood_count_status
-        )
-        
-        # Determinar si necesita consulta médica
-        needs_doctor = self._needs_doctor_consultation(overall_risk, recommendations)
+        """Analiza un examen de sangre y retorna el análisis codificado"""
+        ruleset = self.ruleset_provider()
+        sex = reference_sex(user.gender)
         
-        # Identificar factores de riesgo
-        risk_factors = self._identify_risk_factors(blood_test, user)
+        panels = []
+        risk_score = 0
+        risk_factor_mask = 0
+        recommendation_mask = 0
+        recommendation_count = 0
+        
+        for index, section in enumerate(ruleset.sections):
+            findings = 0
+            section_risk = 0
+            recommend = False
+            evaluated = False
+            for analyte in section.analytes:
+                value = self._value_for(analyte, blood_test, user)
+                if value is None:
+                    continue
+                band = ruleset.classify(analyte, value, sex, user.age)
+                if band is None:
+                    continue
+                evaluated = True
+                findings |= band.finding_mask
+                risk_factor_mask |= band.risk_factor_mask
+                section_risk = max(section_risk, band.risk)
+                recommend = recommend or band.recommend
+            
+            risk_score += section_risk
+            if not evaluated:
+                panels.append(PanelResult(PanelStatus.NOT_EVALUATED))
+            else:
+                panels.append(PanelResult(PanelStatus.ALTERED if findings else PanelStatus.NORMAL, findings))
+            if recommend:
+                recommendation_mask |= 1 << index
+                recommendation_count += len(SECTION_RECOMMENDATIONS.get(section.name, ()))
+        
+        overall_risk = RiskLevel(ruleset.risk_level(risk_score))
         
         return BloodTestAnalysis(
             overall_risk=overall_risk,
-            glucose_status=glucose_status,
-            cholesterol_status=cholesterol_status,
-            kidney_function_status=kidney_status,
-            blood_count_status=blood_count_status,
-            recommendations=[rec.to_dict() for rec in recommendations],
-            needs_doctor_consultation=needs_doctor,
-            risk_factors=risk_factors
+            panels=tuple(panels),
+            risk_factor_mask=risk_factor_mask,
+            recommendation_mask=recommendation_mask,
+            needs_doctor_consultation=self._needs_doctor_consultation(overall_risk, recommendation_count),
+            ruleset=ruleset
         )
     
-    def _analyze_glucose(self, glucose: float) -> str:
-        """Analiza los niveles de glucosa"""
-        if glucose < 70:
-            return "Hipoglucemia - Nivel bajo de glucosa"
-        elif glucose <= 100:
-            return "Normal - Nivel de glucosa en ayunas normal"
-        elif glucose <= 125:
-            return "Prediabetes - Glucosa alterada en ayunas"
-        else:
-            return "Diabetes - Nivel elevado de glucosa"
+    def _value_for(self, analyte: str, blood_test: BloodTest, user: User) -> Optional[float]:
+        """Valor del analito en el examen, o un dato del paciente (p. ej. la edad)"""
+        value = getattr(blood_test, analyte, None)
+        return value if value is not None else getattr(user, analyte, None)
     
-    def _analyze_cholesterol(self, blood_test: BloodTest) -> str:
-        """Analiza los niveles de colesterol"""
-        issues = []
-        
-        if blood_test.cholesterol > self.ranges.cholesterol_max:
-            issues.append("colesterol total elevado")
-        
-        if blood_test.ldl_cholesterol > self.ranges.ldl_cholesterol_max:
-            issues.append("LDL (colesterol malo) elevado")
-        
-        if blood_test.triglycerides > self.ranges.triglycerides_max:
-            issues.append("triglicéridos elevados")
-        
-        if not issues:
-            return "Normal - Perfil lipídico dentro de rangos normales"
-        else:
-            return f"Alterado - {', '.join(issues)}"
+    def _needs_doctor_consultation(self, overall_risk: RiskLevel, recommendation_count: int) -> bool:
+        """Determina si se necesita consulta médica"""
+        return overall_risk in (RiskLevel.HIGH, RiskLevel.CRITICAL) or recommendation_count >= 4
+
+class TrendAnalysisService:
+    """Servicio de dominio para analizar la evolución de los exámenes de un paciente"""
     
-    def _analyze_kidney_function(self, blood_test: BloodTest, user: User) -> str:
-        """Analiza la función renal"""
-        creatinine_max = (self.ranges.creatinine_max_men if user.gender.lower() == 'male' 
-                         else self.ranges.creatinine_max_women)
-        
-        if blood_test.creatinine > creatinine_max:
-            return "Alterada - Creatinina elevada, posible disfunción renal"
-        elif blood_test.urea > 50:  # Valor de referencia típico
-            return "Alterada - Urea elevada"
-        else:
-            return "Normal - Función renal dentro de parámetros normales"
+    ANALYTE_LABELS = {
+        'glucose': 'Glucosa',
+        'cholesterol': 'Colesterol total',
+        'hdl_cholesterol': 'HDL',
+        'ldl_cholesterol': 'LDL',
+        'triglycerides': 'Triglicéridos',
+        'hemoglobin': 'Hemoglobina',
+        'hematocrit': 'Hematocrito',
+        'white_blood_cells': 'Glóbulos blancos',
+        'red_blood_cells': 'Glóbulos rojos',
+        'platelets': 'Plaquetas',
+        'creatinine': 'Creatinina',
+        'urea': 'Urea'
+    }
     
-    def _analyze_blood_count(self, blood_test: BloodTest, user: User) -> str:
-        """Analiza el hemograma"""
-        issues = []
-        
-        # Analizar hemoglobina según género
-        if user.gender.lower() == 'male':
-            if blood_test.hemoglobin < self.ranges.hemoglobin_min_men:
-                issues.append("hemoglobina baja (anemia)")
-        else:
-            if blood_test.hemoglobin < self.ranges.hemoglobin_min_women:
-                issues.append("hemoglobina baja (anemia)")
-        
-        # Analizar otros parámetros
-        if blood_test.white_blood_cells > 11000:
-            issues.append("glóbulos blancos elevados")
-        elif blood_test.white_blood_cells < 4000:
-            issues.append("glóbulos blancos bajos")
-        
-        if blood_test.platelets > 450000:
-            issues.append("plaquetas elevadas")
-        elif blood_test.platelets < 150000:
-            issues.append("plaquetas bajas")
-        
-        if not issues:
-            return "Normal - Hemograma completo dentro de rangos normales"
-        else:
-            return f"Alterado - {', '.join(issues)}"
+    # Variación entre exámenes consecutivos (%) a partir de la cual se alerta
+    CHANGE_ALERT_PERCENT = {
+        'glucose': 15.0,
+        'cholesterol': 15.0,
+        'ldl_cholesterol': 15.0,
+        'triglycerides': 25.0,
+        'hemoglobin': 10.0,
+        'creatinine': 20.0,
+        'urea': 25.0
+    }
+    DEFAULT_CHANGE_ALERT_PERCENT = 20.0
     
-    def _calculate_overall_risk(self, glucose_status: str, cholesterol_status: str, 
-                              kidney_status: str, blood_count_status: str) -> RiskLevel:
-        """Calcula el riesgo general basado en todos los análisis"""
-        risk_score = 0
-        
-        # Evaluar glucosa
-        if "Diabetes" in glucose_status:
-            risk_score += 3
-        elif "Prediabetes" in glucose_status:
-            risk_score += 2
-        elif "Hipoglucemia" in glucose_status:
-            risk_score += 2
-        
-        # Evaluar colesterol
-        if "Alterado" in cholesterol_status:
-            risk_score += 2
-        
-        # Evaluar función renal
-        if "Alterada" in kidney_status:
-            risk_score += 3
-        
-        # Evaluar hemograma
-        if "Alterado" in blood_count_status:
-            risk_score += 1
-        
-        # Determinar nivel de riesgo
-        if risk_score >= 6:
-            return RiskLevel.CRITICAL
-        elif risk_score >= 4:
-            return RiskLevel.HIGH
-        elif risk_score >= 2:
-            return RiskLevel.MODERATE
-        else:
-            return RiskLevel.LOW
+    # Desviaciones estándar respecto a la media histórica del paciente para alertar
+    DEVIATION_ALERT_SIGMAS = 2.0
+    MIN_TESTS_FOR_DEVIATION = 3
     
-    def _generate_recommendations(self, blood_test: BloodTest, user: User, 
-                                glucose_status: str, cholesterol_status: str,
-                                kidney_status: str, blood_count_status: str) -> List[Recommendation]:
-        """Genera recomendaciones basadas en el análisis"""
-        recommendations = []
-        
-        # Recomendaciones para glucosa
-        if "Diabetes" in glucose_status or "Prediabetes" in glucose_status:
-            recommendations.extend([
-                Recommendation(
-                    type=RecommendationType.DIETARY,
-                    title="Dieta baja en carbohidratos",
-                    description="Reducir el consumo de azúcares y carbohidratos refinados. Incluir más vegetales y proteínas magras.",
-                    priority=5
-                ),
-                Recommendation(
-                    type=RecommendationType.EXERCISE,
-                    title="Ejercicio regular",
-                    description="Realizar al menos 150 minutos de actividad física moderada por semana.",
-                    priority=4
-                )
-            ])
-        
-        # Recomendaciones para colesterol
-        if "Alterado" in cholesterol_status:
-            recommendations.extend([
-                Recommendation(
-                    type=RecommendationType.DIETARY,
-                    title="Dieta baja en grasas saturadas",
-                    description="Reducir carnes rojas, productos lácteos enteros y frituras. Incluir más pescado y nueces.",
-                    priority=4
-                ),
-                Recommendation(
-                    type=RecommendationType.LIFESTYLE,
-                    title="Control de peso",
-                    description="Mantener un peso saludable mediante dieta equilibrada y ejercicio.",
-                    priority=3
-                )
-            ])
-        
-        # Recomendaciones para función renal
-        if "Alterada" in kidney_status:
-            recommendations.extend([
-                Recommendation(
-                    type=RecommendationType.DIETARY,
-                    title="Reducir sal y proteínas",
-                    description="Limitar el consumo de sal y moderar la ingesta de proteínas.",
-                    priority=5
-                ),
-                Recommendation(
-                    type=RecommendationType.LIFESTYLE,
-                    title="Hidratación adecuada",
-                    description="Mantener una hidratación adecuada, aproximadamente 2 litros de agua al día.",
-                    priority=4
-                )
-            ])
-        
-        return recommendations
+    def __init__(self, window: int = 5):
+        self.window = window
     
-    def _needs_doctor_consultation(self, overall_risk: RiskLevel, recommendations: List[Recommendation]) -> bool:
-        """Determina si se necesita consulta médica"""
-        return overall_risk in [RiskLevel.HIGH, RiskLevel.CRITICAL] or len(recommendations) >= 4
+    def update_trends(self, trends: Dict[str, AnalyteTrend], user_id: str,
+                      values: Dict[str, float], test_date: datetime) -> Dict[str, AnalyteTrend]:
+        """Incorpora los valores informados de un examen; devuelve solo las tendencias cambiadas"""
+        updated = {}
+        for analyte, value in values.items():
+            if analyte not in self.ANALYTE_LABELS or value is None:
+                continue
+            current = trends.get(analyte) or AnalyteTrend.empty(user_id, analyte)
+            updated[analyte] = current.record(value, test_date, self.window)
+        return updated
     
-    def _identify_risk_factors(self, blood_test: BloodTest, user: User) -> List[str]:
-        """Identifica factores de riesgo específicos"""
-        risk_factors = []
-        
-        if blood_test.glucose > 125:
-            risk_factors.append("Diabetes mellitus")
-        elif blood_test.glucose > 100:
-            risk_factors.append("Prediabetes")
-        
-        if blood_test.cholesterol > 240:
-            risk_factors.append("Colesterol alto")
-        
-        if blood_test.ldl_cholesterol > 130:
-            risk_factors.append("LDL elevado")
-        
-        if user.age > 45:
-            risk_factors.append("Edad de riesgo cardiovascular")
-        
-        return risk_factors
+    def alerts(self, trend: AnalyteTrend) -> List[str]:
+        """Alertas por variación brusca o por salir del rango habitual del paciente"""
+        label = self.ANALYTE_LABELS.get(trend.analyte, trend.analyte)
+        alerts = []
+        
+        change = trend.change_percent
+        threshold = self.CHANGE_ALERT_PERCENT.get(trend.analyte, self.DEFAULT_CHANGE_ALERT_PERCENT)
+        if change is not None and abs(change) >= threshold:
+            direction = "aumentó" if change > 0 else "disminuyó"
+            alerts.append(f"{label} {direction} {abs(change):.0f}% respecto al examen anterior")
+        
+        if trend.count >= self.MIN_TESTS_FOR_DEVIATION and trend.std_dev > 0:
+            deviation = (trend.last_value - trend.mean) / trend.std_dev
+            if abs(deviation) >= self.DEVIATION_ALERT_SIGMAS:
+                position = "por encima" if deviation > 0 else "por debajo"
+                alerts.append(f"{label} está {position} de su rango habitual")
+        
+        return alerts
+    
+    def summarize(self, trends: List[AnalyteTrend]) -> List[Dict]:
+        """Resumen serializable de las tendencias, en el orden de los analitos"""
+        order = list(self.ANALYTE_LABELS)
+        summary = []
+        for trend in sorted(trends, key=lambda item: order.index(item.analyte) if item.analyte in order else len(order)):
+            slope = trend.slope_per_month
+            change = trend.change_percent
+            summary.append({
+                'analyte': trend.analyte,
+                'label': self.ANALYTE_LABELS.get(trend.analyte, trend.analyte),
+                'tests': trend.count,
+                'mean': round(trend.mean, 2),
+                'std_dev': round(trend.std_dev, 2),
+                'last_value': trend.last_value,
+                'change_percent': round(change, 1) if change is not None else None,
+                'slope_per_month': round(slope, 2) if slope is not None else None,
+                'alerts': self.alerts(trend)
+            })
+        return summary
@@ -1,6 +1,9 @@
-from dataclasses import dataclass
-from enum import Enum
-from typing import Dict, Any
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum, IntEnum
+from math import sqrt
+from typing import Dict, Any, NamedTuple, Optional, Tuple
+from .reference_ranges import ReferenceRuleset
 
 class RiskLevel(Enum):
     """Nivel de riesgo médico"""
@@ -17,17 +20,80 @@ class RecommendationType(Enum):
     MEDICAL_CONSULTATION = "medical_consultation"
     LIFESTYLE = "lifestyle"
 
+class PanelStatus(IntEnum):
+    """Estado de un panel del análisis (glucosa, perfil lipídico, función renal, hemograma)"""
+    NORMAL = 0
+    ALTERED = 1
+    NOT_EVALUATED = 2  # ningún analito del panel fue informado
+
+class PanelResult(NamedTuple):
+    """Resultado codificado de un panel: estado y máscara de bits de sus hallazgos"""
+    status: PanelStatus
+    findings: int = 0
+
 @dataclass(frozen=True)
 class BloodTestAnalysis:
-    """Análisis de examen de sangre - Value Object"""
+    """
+    Análisis de examen de sangre - Value Object.
+    Guarda solo códigos (niveles, estados y máscaras de bits); los textos de estados,
+    factores de riesgo y recomendaciones se generan al leerlos o serializarlos.
+    """
     overall_risk: RiskLevel
-    glucose_status: str
-    cholesterol_status: str
-    kidney_function_status: str
-    blood_count_status: str
-    recommendations: list
+    panels: Tuple[PanelResult, ...]  # alineados con ruleset.sections
+    risk_factor_mask: int
+    recommendation_mask: int  # bit i: la sección i del ruleset activa sus recomendaciones
     needs_doctor_consultation: bool
-    risk_factors: list
+    ruleset: ReferenceRuleset = field(repr=False, compare=False)
+    
+    @property
+    def ranges_version(self) -> str:
+        return self.ruleset.version
+    
+    def panel(self, name: str) -> Optional[PanelResult]:
+        index = self.ruleset.section_index(name)
+        return self.panels[index] if index is not None else None
+    
+    def is_altered(self, name: str) -> bool:
+        panel = self.panel(name)
+        return panel is not None and panel.status == PanelStatus.ALTERED
+    
+    @property
+    def glucose_status(self) -> str:
+        return self._render_panel('glucose')
+    
+    @property
+    def cholesterol_status(self) -> str:
+        return self._render_panel('cholesterol')
+    
+    @property
+    def kidney_function_status(self) -> str:
+        return self._render_panel('kidney_function')
+    
+    @property
+    def blood_count_status(self) -> str:
+        return self._render_panel('blood_count')
+    
+    @property
+    def risk_factors(self) -> list:
+        return self.ruleset.render_risk_factors(self.risk_factor_mask)
+    
+    @property
+    def recommendations(self) -> list:
+        return [
+            dict(recommendation)
+            for index, section in enumerate(self.ruleset.sections)
+            if self.recommendation_mask >> index & 1
+            for recommendation in _SECTION_RECOMMENDATION_DICTS.get(section.name, ())
+        ]
+    
+    def _render_panel(self, name: str) -> str:
+        index = self.ruleset.section_index(name)
+        if index is None:
+            return ''
+        panel = self.panels[index]
+        if panel.status == PanelStatus.NOT_EVALUATED:
+            return 'No evaluado'
+        return self.ruleset.render_section(index, panel.findings)
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -38,7 +104,8 @@ class BloodTestAnalysis:
             'blood_count_status': self.blood_count_status,
             'recommendations': self.recommendations,
             'needs_doctor_consultation': self.needs_doctor_consultation,
-            'risk_factors': self.risk_factors
+            'risk_factors': self.risk_factors,
+            'reference_ranges_version': self.ranges_version
         }
 
 @dataclass(frozen=True)
@@ -57,21 +124,197 @@ class Recommendation:
             'priority': self.priority
         }
 
+# Recomendaciones que activa cada sección del ruleset cuando alguna de sus bandas lo indica
+SECTION_RECOMMENDATIONS = {
+    'glucose': (
+        Recommendation(
+            type=RecommendationType.DIETARY,
+            title="Dieta baja en carbohidratos",
+            description="Reducir el consumo de azúcares y carbohidratos refinados. Incluir más vegetales y proteínas magras.",
+            priority=5
+        ),
+        Recommendation(
+            type=RecommendationType.EXERCISE,
+            title="Ejercicio regular",
+            description="Realizar al menos 150 minutos de actividad física moderada por semana.",
+            priority=4
+        )
+    ),
+    'cholesterol': (
+        Recommendation(
+            type=RecommendationType.DIETARY,
+            title="Dieta baja en grasas saturadas",
+            description="Reducir carnes rojas, productos lácteos enteros y frituras. Incluir más pescado y nueces.",
+            priority=4
+        ),
+        Recommendation(
+            type=RecommendationType.LIFESTYLE,
+            title="Control de peso",
+            description="Mantener un peso saludable mediante dieta equilibrada y ejercicio.",
+            priority=3
+        )
+    ),
+    'kidney_function': (
+        Recommendation(
+            type=RecommendationType.DIETARY,
+            title="Reducir sal y proteínas",
+            description="Limitar el consumo de sal y moderar la ingesta de proteínas.",
+            priority=5
+        ),
+        Recommendation(
+            type=RecommendationType.LIFESTYLE,
+            title="Hidratación adecuada",
+            description="Mantener una hidratación adecuada, aproximadamente 2 litros de agua al día.",
+            priority=4
+        )
+    )
+}
+
+_SECTION_RECOMMENDATION_DICTS = {
+    name: tuple(recommendation.to_dict() for recommendation in recommendations)
+    for name, recommendations in SECTION_RECOMMENDATIONS.items()
+}
+
 @dataclass(frozen=True)
-class BloodTestRanges:
-    """Rangos normales para exámenes de sangre - Value Object"""
-    glucose_min: float = 70.0
-    glucose_max: float = 100.0
-    cholesterol_max: float = 200.0
-    hdl_cholesterol_min: float = 40.0  # hombres
-    hdl_cholesterol_min_women: float = 50.0  # mujeres
-    ldl_cholesterol_max: float = 100.0
-    triglycerides_max: float = 150.0
-    hemoglobin_min_men: float = 13.5
-    hemoglobin_max_men: float = 17.5
-    hemoglobin_min_women: float = 12.0
-    hemoglobin_max_women: float = 15.5
-    creatinine_min_men: float = 0.74
-    creatinine_max_men: float = 1.35
-    creatinine_min_women: float = 0.59
-    creatinine_max_women: float = 1.04
+class MessageSearchResult:
+    """Mensaje encontrado por la búsqueda de texto - Value Object"""
+    message_id: str
+    conversation_id: str
+    user_id: str
+    sender: str
+    timestamp: datetime
+    snippet: str  # fragmento con los términos resaltados entre **
+    score: float  # relevancia: mayor es mejor
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'message_id': self.message_id,
+            'conversation_id': self.conversation_id,
+            'user_id': self.user_id,
+            'sender': self.sender,
+            'timestamp': self.timestamp.isoformat(),
+            'snippet': self.snippet,
+            'score': self.score
+        }
+
+@dataclass(frozen=True)
+class ConversationSummary:
+    """Conversación sin sus mensajes, con los contadores desnormalizados - Value Object"""
+    id: str
+    blood_test_id: Optional[str]
+    created_at: datetime
+    message_count: int
+    last_message_at: Optional[datetime]
+    last_sender: Optional[str]
+
+# Bandas de edad de las cohortes (límite inferior, etiqueta)
+AGE_BANDS = ((0, '0-17'), (18, '18-29'), (30, '30-39'), (40, '40-49'), (50, '50-59'), (60, '60-69'), (70, '70+'))
+
+def age_band_for(age: int) -> str:
+    """Banda de edad de la cohorte a la que pertenece un paciente"""
+    label = AGE_BANDS[0][1]
+    for lower_bound, band in AGE_BANDS:
+        if age < lower_bound:
+            break
+        label = band
+    return label
+
+def cohort_gender(gender: str) -> str:
+    """Género normalizado para agrupar cohortes (male/female)"""
+    gender = (gender or '').lower()
+    if gender in ('male', 'masculino'):
+        return 'male'
+    if gender in ('female', 'femenino'):
+        return 'female'
+    return 'other'
+
+@dataclass(frozen=True)
+class PatientRiskSnapshot:
+    """Riesgo del último examen de un paciente y la cohorte a la que aporta - Value Object"""
+    user_id: str
+    blood_test_id: str
+    test_date: datetime
+    age_band: str
+    gender: str
+    overall_risk: RiskLevel
+    risk_factors: Tuple[str, ...]
+    
+    @classmethod
+    def create(cls, user_id: str, age: int, gender: str, blood_test_id: str,
+               test_date: datetime, analysis: BloodTestAnalysis) -> 'PatientRiskSnapshot':
+        return cls(
+            user_id=user_id,
+            blood_test_id=blood_test_id,
+            test_date=test_date,
+            age_band=age_band_for(age),
+            gender=cohort_gender(gender),
+            overall_risk=analysis.overall_risk,
+            risk_factors=tuple(analysis.risk_factors)
+        )
+    
+    def is_newer_than(self, test_date: datetime, blood_test_id: str) -> bool:
+        """Indica si este examen reemplaza al último examen conocido del paciente"""
+        return (self.test_date, self.blood_test_id) >= (test_date, blood_test_id)
+
+@dataclass(frozen=True)
+class AnalyteTrend:
+    """
+    Estadísticas acumuladas de un analito para un paciente - Value Object.
+    Media y varianza por el método de Welford (sin guardar el historial) y una ventana
+    con los últimos valores por fecha para la pendiente y la variación reciente.
+    """
+    user_id: str
+    analyte: str
+    count: int
+    mean: float
+    m2: float  # suma de cuadrados de las diferencias respecto a la media (Welford)
+    recent: Tuple[Tuple[datetime, float], ...]  # (fecha, valor) ordenados por fecha
+    
+    @classmethod
+    def empty(cls, user_id: str, analyte: str) -> 'AnalyteTrend':
+        return cls(user_id=user_id, analyte=analyte, count=0, mean=0.0, m2=0.0, recent=())
+    
+    def record(self, value: float, test_date: datetime, window: int) -> 'AnalyteTrend':
+        """Nuevo estado tras incorporar un valor, en O(1) respecto al historial"""
+        count = self.count + 1
+        delta = value - self.mean
+        mean = self.mean + delta / count
+        m2 = self.m2 + delta * (value - mean)
+        # Un examen cargado con fecha antigua entra en la ventana solo si le corresponde
+        recent = tuple(sorted(self.recent + ((test_date, value),), key=lambda point: point[0]))[-window:]
+        return AnalyteTrend(self.user_id, self.analyte, count, mean, m2, recent)
+    
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+    
+    @property
+    def std_dev(self) -> float:
+        return sqrt(self.variance)
+    
+    @property
+    def last_value(self) -> Optional[float]:
+        return self.recent[-1][1] if self.recent else None
+    
+    @property
+    def change_percent(self) -> Optional[float]:
+        """Variación porcentual entre los dos últimos exámenes"""
+        if len(self.recent) < 2 or self.recent[-2][1] == 0:
+            return None
+        previous, last = self.recent[-2][1], self.recent[-1][1]
+        return (last - previous) / abs(previous) * 100
+    
+    @property
+    def slope_per_month(self) -> Optional[float]:
+        """Pendiente por mínimos cuadrados de la ventana reciente, en unidades cada 30 días"""
+        if len(self.recent) < 2:
+            return None
+        origin = self.recent[0][0]
+        xs = [(test_date - origin).total_seconds() / 86400 / 30 for test_date, _ in self.recent]
+        ys = [value for _, value in self.recent]
+        x_mean = sum(xs) / len(xs)
+        y_mean = sum(ys) / len(ys)
+        denominator = sum((x - x_mean) ** 2 for x in xs)
+        if denominator == 0:
+            return None
+        return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / denominator
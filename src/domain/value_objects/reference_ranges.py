@@ -0,0 +1,239 @@
+"""
+Rangos de referencia versionados por analito, sexo y edad, compilados en un índice de
+intervalos: la banda de edad y la banda de valores se ubican con búsqueda binaria.
+Los hallazgos y factores de riesgo se compilan a bits; sus textos solo se generan al serializar.
+"""
+import json
+import os
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_RULESET_PATH = os.path.join(os.path.dirname(__file__), 'reference_ranges.json')
+
+VALID_SEXES = ('male', 'female', 'any')
+VALID_COMBINE_MODES = ('first', 'all')
+
+# Clave de búsqueda entre un límite exclusivo (valor, 0) y uno inclusivo (valor, 1)
+_QUERY_SIDE = 0.5
+
+
+def reference_sex(gender: str) -> str:
+    """Sexo usado para elegir rangos; como hasta ahora, se usan los femeninos salvo para hombres"""
+    return 'male' if (gender or '').lower() in ('male', 'masculino') else 'female'
+
+
+@dataclass(frozen=True)
+class ReferenceBand:
+    """Banda de valores de un analito y lo que implica para el análisis"""
+    finding_mask: int = 0  # bit del hallazgo dentro de su sección (0 si es normal)
+    risk: int = 0  # puntos de riesgo que aporta a su sección
+    risk_factor_mask: int = 0  # bit del factor de riesgo en ReferenceRuleset.risk_factors
+    recommend: bool = False  # activa las recomendaciones de la sección
+
+
+@dataclass(frozen=True)
+class ReferenceSection:
+    """Grupo de analitos que produce un estado del análisis (p. ej. función renal)"""
+    name: str
+    analytes: Tuple[str, ...]
+    combine: str  # 'first': primer hallazgo; 'all': todos separados por comas
+    abnormal_prefix: str
+    normal: str
+    findings: Tuple[str, ...] = ()  # textos de los hallazgos, en el orden de sus bits
+
+    def render(self, findings_mask: int) -> str:
+        """Texto del estado de la sección a partir de la máscara de hallazgos"""
+        if not findings_mask:
+            return self.normal
+        findings = _names_for(self.findings, findings_mask)
+        if self.combine == 'first':
+            return f"{self.abnormal_prefix}{findings[0]}"
+        return f"{self.abnormal_prefix}{', '.join(findings)}"
+
+
+class _CompiledRange:
+    """Bandas de un analito para un sexo y edad, ordenadas por su límite superior"""
+
+    __slots__ = ('cut_keys', 'bands')
+
+    def __init__(self, cut_keys: List[Tuple[float, int]], bands: List[ReferenceBand]):
+        self.cut_keys = cut_keys
+        self.bands = bands
+
+    def band_for(self, value: float) -> ReferenceBand:
+        return self.bands[bisect_left(self.cut_keys, (value, _QUERY_SIDE))]
+
+
+class ReferenceRuleset:
+    """Conjunto versionado e inmutable de rangos de referencia ya compilado"""
+
+    def __init__(self, version: str, sections: Tuple[ReferenceSection, ...],
+                 risk_factors: Tuple[str, ...],
+                 risk_levels: Tuple[Tuple[int, str], ...],
+                 index: Dict[Tuple[str, str], Tuple[List[int], List[_CompiledRange]]]):
+        self.version = version
+        self.sections = sections
+        self.risk_factors = risk_factors
+        self._section_indexes = {section.name: position for position, section in enumerate(sections)}
+        # Textos ya generados por (sección, máscara) y por máscara de factores de riesgo
+        self._status_texts: Dict[Tuple[int, int], str] = {}
+        self._risk_factor_names: Dict[int, Tuple[str, ...]] = {}
+        self._risk_scores = [score for score, _ in risk_levels]
+        self._risk_levels = [level for _, level in risk_levels]
+        self._index = index
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ReferenceRuleset':
+        """Valida y compila un ruleset; lanza ValueError si no es coherente"""
+        version = data.get('version')
+        if not isinstance(version, str) or not version:
+            raise ValueError('El ruleset debe tener una versión')
+
+        rules_by_analyte: Dict[str, List[Dict[str, Any]]] = {}
+        for rule in data.get('ranges', []):
+            rules_by_analyte.setdefault(rule['analyte'], []).append(rule)
+
+        # Bits de hallazgos (por sección) y de factores de riesgo (globales) en el orden de
+        # sección, analito y banda: así el orden de los textos no cambia al serializar
+        sections = []
+        risk_factor_bits: Dict[str, int] = {}
+        finding_bits_by_analyte: Dict[str, Dict[str, int]] = {}
+        for section in data.get('sections', []):
+            finding_bits: Dict[str, int] = {}
+            for analyte in section['analytes']:
+                if analyte in finding_bits_by_analyte:
+                    raise ValueError(f'{analyte}: el analito pertenece a más de una sección')
+                finding_bits_by_analyte[analyte] = finding_bits
+                for rule in rules_by_analyte.get(analyte, []):
+                    for band in rule['bands']:
+                        if band.get('finding'):
+                            finding_bits.setdefault(band['finding'], len(finding_bits))
+                        if band.get('risk_factor'):
+                            risk_factor_bits.setdefault(band['risk_factor'], len(risk_factor_bits))
+            sections.append(ReferenceSection(
+                name=section['name'],
+                analytes=tuple(section['analytes']),
+                combine=section.get('combine', 'all'),
+                abnormal_prefix=section.get('abnormal_prefix', ''),
+                normal=section.get('normal', ''),
+                findings=tuple(finding_bits)
+            ))
+        for section in sections:
+            if section.combine not in VALID_COMBINE_MODES:
+                raise ValueError(f'Sección {section.name}: combine debe ser first o all')
+
+        risk_levels = tuple(sorted(
+            ((int(level['min_score']), level['level']) for level in data.get('risk_levels', [])),
+            key=lambda level: level[0]
+        ))
+        if not risk_levels or risk_levels[0][0] > 0:
+            raise ValueError('risk_levels debe cubrir desde la puntuación 0')
+
+        by_key: Dict[Tuple[str, str], List[Tuple[int, _CompiledRange]]] = {}
+        for rule in data.get('ranges', []):
+            analyte, sex = rule['analyte'], rule.get('sex', 'any')
+            if sex not in VALID_SEXES:
+                raise ValueError(f'{analyte}: sexo inválido {sex!r}')
+            if analyte not in finding_bits_by_analyte:
+                raise ValueError(f'{analyte}: el analito no pertenece a ninguna sección')
+            compiled = _compile_bands(analyte, rule['bands'], finding_bits_by_analyte[analyte], risk_factor_bits)
+            by_key.setdefault((analyte, sex), []).append((int(rule.get('age_from', 0)), compiled))
+
+        index = {}
+        for key, rules in by_key.items():
+            rules.sort(key=lambda rule: rule[0])
+            age_froms = [age_from for age_from, _ in rules]
+            if len(set(age_froms)) != len(age_froms):
+                raise ValueError(f'{key[0]} ({key[1]}): bandas de edad duplicadas')
+            index[key] = (age_froms, [compiled for _, compiled in rules])
+
+        # Cada sexo concreto hereda los rangos 'any' del analito si no tiene propios
+        for analyte, sex in list(index):
+            if sex == 'any':
+                for concrete_sex in ('male', 'female'):
+                    index.setdefault((analyte, concrete_sex), index[(analyte, 'any')])
+
+        analytes = {analyte for analyte, _ in index}
+        for section in sections:
+            missing = [analyte for analyte in section.analytes if analyte not in analytes]
+            if missing:
+                raise ValueError(f'Sección {section.name}: sin rangos para {", ".join(missing)}')
+
+        return cls(version, tuple(sections), tuple(risk_factor_bits), risk_levels, index)
+
+    def classify(self, analyte: str, value: float, sex: str, age: int) -> Optional[ReferenceBand]:
+        """Banda del valor según el sexo y la edad; None si no hay rango aplicable"""
+        entry = self._index.get((analyte, sex))
+        if entry is None:
+            return None
+        age_froms, ranges = entry
+        position = bisect_right(age_froms, age) - 1
+        if position < 0:
+            return None
+        return ranges[position].band_for(value)
+
+    def risk_level(self, score: int) -> str:
+        return self._risk_levels[bisect_right(self._risk_scores, score) - 1]
+
+    def section_index(self, name: str) -> Optional[int]:
+        return self._section_indexes.get(name)
+
+    def render_section(self, index: int, findings_mask: int) -> str:
+        key = (index, findings_mask)
+        text = self._status_texts.get(key)
+        if text is None:
+            text = self._status_texts[key] = self.sections[index].render(findings_mask)
+        return text
+
+    def render_risk_factors(self, risk_factor_mask: int) -> List[str]:
+        names = self._risk_factor_names.get(risk_factor_mask)
+        if names is None:
+            names = self._risk_factor_names[risk_factor_mask] = tuple(_names_for(self.risk_factors, risk_factor_mask))
+        return list(names)
+
+
+def _names_for(names: Tuple[str, ...], mask: int) -> List[str]:
+    return [name for bit, name in enumerate(names) if mask >> bit & 1]
+
+
+def _compile_bands(analyte: str, bands: List[Dict[str, Any]], finding_bits: Dict[str, int],
+                   risk_factor_bits: Dict[str, int]) -> _CompiledRange:
+    cut_keys = []
+    compiled = []
+    for position, band in enumerate(bands):
+        is_last = position == len(bands) - 1
+        if 'below' in band:
+            cut_key = (float(band['below']), 0)
+        elif 'up_to' in band:
+            cut_key = (float(band['up_to']), 1)
+        elif is_last:
+            cut_key = (float('inf'), 1)
+        else:
+            raise ValueError(f'{analyte}: solo la última banda puede no tener límite superior')
+        if is_last and cut_key[0] != float('inf'):
+            raise ValueError(f'{analyte}: la última banda no debe tener límite superior')
+        if cut_keys and cut_key <= cut_keys[-1]:
+            raise ValueError(f'{analyte}: las bandas deben estar ordenadas por su límite superior')
+        cut_keys.append(cut_key)
+        compiled.append(ReferenceBand(
+            finding_mask=1 << finding_bits[band['finding']] if band.get('finding') else 0,
+            risk=int(band.get('risk', 0)),
+            risk_factor_mask=1 << risk_factor_bits[band['risk_factor']] if band.get('risk_factor') else 0,
+            recommend=bool(band.get('recommend', False))
+        ))
+    if not compiled:
+        raise ValueError(f'{analyte}: el rango no tiene bandas')
+    return _CompiledRange(cut_keys, compiled)
+
+
+def load_ruleset(path: str) -> ReferenceRuleset:
+    with open(path, encoding='utf-8') as ruleset_file:
+        return ReferenceRuleset.from_dict(json.load(ruleset_file))
+
+
+@lru_cache(maxsize=1)
+def default_ruleset() -> ReferenceRuleset:
+    """Ruleset incluido con la aplicación"""
+    return load_ruleset(DEFAULT_RULESET_PATH)
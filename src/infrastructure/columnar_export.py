@@ -0,0 +1,167 @@
+"""
+Exportación columnar de exámenes de sangre: lotes de Apache Arrow escritos como
+Parquet particionado por mes de test_date (estructura test_month=YYYY-MM/)
+"""
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# Columnas exportadas, en orden; las particiones aportan test_month desde la ruta
+BLOOD_TEST_EXPORT_COLUMNS = (
+    ('id', 'string'),
+    ('user_id', 'string'),
+    ('user_age', 'int32'),
+    ('user_gender', 'string'),
+    ('glucose', 'float64'),
+    ('cholesterol', 'float64'),
+    ('hdl_cholesterol', 'float64'),
+    ('ldl_cholesterol', 'float64'),
+    ('triglycerides', 'float64'),
+    ('hemoglobin', 'float64'),
+    ('hematocrit', 'float64'),
+    ('white_blood_cells', 'float64'),
+    ('red_blood_cells', 'float64'),
+    ('platelets', 'float64'),
+    ('creatinine', 'float64'),
+    ('urea', 'float64'),
+    ('test_date', 'timestamp'),
+    ('created_at', 'timestamp'),
+    ('overall_risk', 'string'),  # Parquet ya lo codifica como diccionario en disco
+    ('needs_doctor_consultation', 'bool'),
+)
+
+PARTITION_PREFIX = 'test_month='
+
+Watermark = Tuple[datetime, str]
+
+
+def _load_pyarrow():
+    # pyarrow es opcional: solo lo necesita este comando de exportación
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('La exportación a Parquet requiere el paquete pyarrow (pip install pyarrow)')
+    return pyarrow, pyarrow.parquet
+
+
+def _arrow_schema(pa):
+    types = {
+        'string': pa.string(),
+        'int32': pa.int32(),
+        'float64': pa.float64(),
+        'timestamp': pa.timestamp('us'),
+        'bool': pa.bool_(),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in BLOOD_TEST_EXPORT_COLUMNS])
+
+
+class ParquetPartitionWriter:
+    """
+    Escribe lotes columnares en un archivo Parquet por mes y ejecución. Los archivos se
+    escriben con un nombre temporal y solo se publican al confirmar la exportación, de
+    modo que una ejecución fallida no deja datos a medias en el dataset.
+    """
+
+    def __init__(self, output_dir: str, run_id: str, compression: str = 'zstd'):
+        self.pa, self.pq = _load_pyarrow()
+        self.schema = _arrow_schema(self.pa)
+        self.output_dir = output_dir
+        self.run_id = run_id
+        self.compression = compression
+        self._writers: Dict[str, Any] = {}
+        self._rows_by_partition: Dict[str, int] = {}
+
+    def write(self, partition: str, columns: Dict[str, List[Any]]) -> None:
+        """Agrega un lote (columnas del mismo mes) a la partición indicada"""
+        batch = self.pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        writer = self._writers.get(partition)
+        if writer is None:
+            directory = os.path.join(self.output_dir, f'{PARTITION_PREFIX}{partition}')
+            os.makedirs(directory, exist_ok=True)
+            writer = self.pq.ParquetWriter(self._temporary_path(partition), self.schema,
+                                           compression=self.compression)
+            self._writers[partition] = writer
+        writer.write_batch(batch)
+        self._rows_by_partition[partition] = self._rows_by_partition.get(partition, 0) + batch.num_rows
+
+    def commit(self) -> Dict[str, int]:
+        """Cierra los archivos y los publica; devuelve las filas escritas por partición"""
+        for partition, writer in self._writers.items():
+            writer.close()
+            os.replace(self._temporary_path(partition), self._final_path(partition))
+        self._writers.clear()
+        return dict(self._rows_by_partition)
+
+    def abort(self) -> None:
+        """Descarta los archivos de la ejecución"""
+        for partition, writer in self._writers.items():
+            writer.close()
+            try:
+                os.remove(self._temporary_path(partition))
+            except FileNotFoundError:
+                pass
+        self._writers.clear()
+
+    def remove_previous_runs(self) -> None:
+        """
+        Elimina los archivos publicados por otras ejecuciones (exportación completa). Se llama
+        después de commit(), para que el dataset anterior siga entero si la exportación falla
+        """
+        if not os.path.isdir(self.output_dir):
+            return
+        current = f'part-{self.run_id}.parquet'
+        for entry in os.listdir(self.output_dir):
+            if not entry.startswith(PARTITION_PREFIX):
+                continue
+            directory = os.path.join(self.output_dir, entry)
+            if current not in os.listdir(directory):
+                # Mes sin exámenes en esta ejecución
+                shutil.rmtree(directory)
+                continue
+            for name in os.listdir(directory):
+                if name.startswith('part-') and name != current:
+                    os.remove(os.path.join(directory, name))
+
+    def _final_path(self, partition: str) -> str:
+        return os.path.join(self.output_dir, f'{PARTITION_PREFIX}{partition}', f'part-{self.run_id}.parquet')
+
+    def _temporary_path(self, partition: str) -> str:
+        return os.path.join(self.output_dir, f'{PARTITION_PREFIX}{partition}', f'.part-{self.run_id}.parquet.tmp')
+
+
+class ExportWatermarkStore:
+    """Marca de agua (created_at, id) del último examen exportado, guardada junto al dataset"""
+
+    FILE_NAME = '_watermark.json'
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, self.FILE_NAME)
+
+    def load(self) -> Optional[Watermark]:
+        try:
+            with open(self.path, encoding='utf-8') as watermark_file:
+                data = json.load(watermark_file)
+        except FileNotFoundError:
+            return None
+        return datetime.fromisoformat(data['created_at']), data['id']
+
+    def save(self, watermark: Watermark, rows: int) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as watermark_file:
+            json.dump({
+                'created_at': watermark[0].isoformat(),
+                'id': watermark[1],
+                'rows': rows,
+                'exported_at': datetime.now().isoformat()
+            }, watermark_file)
+        os.replace(temporary_path, self.path)
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,67 @@
+"""
+Formato de los mensajes archivados: todos los mensajes de una conversación en un solo blob
+JSON comprimido con zstd (paquete zstandard, opcional) o zlib
+"""
+import json
+import zlib
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from ..domain.entities import ChatMessage
+
+try:
+    import zstandard
+except ImportError:  # zstandard es opcional; sin él se comprime con zlib
+    zstandard = None
+
+ARCHIVE_CODECS = ('zstd', 'zlib')
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 9
+
+
+def default_codec() -> str:
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def resolve_codec(codec: Optional[str]) -> str:
+    """Códec pedido (o el mejor disponible), comprobando que se pueda usar"""
+    codec = codec or default_codec()
+    if codec not in ARCHIVE_CODECS:
+        raise ValueError(f"ARCHIVE_CODEC debe ser uno de: {', '.join(ARCHIVE_CODECS)}")
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError("ARCHIVE_CODEC=zstd requiere el paquete zstandard")
+    return codec
+
+
+def encode_messages(messages: List[ChatMessage], codec: str) -> Tuple[bytes, int]:
+    """Blob comprimido y tamaño en bytes del JSON sin comprimir"""
+    # Sin conversation_id (es la clave de la fila) ni claves repetidas: [id, emisor, fecha, texto]
+    rows = [
+        [message.id, message.sender, message.timestamp.isoformat() if message.timestamp else None, message.content]
+        for message in messages
+    ]
+    raw = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), len(raw)
+    return zlib.compress(raw, ZLIB_LEVEL), len(raw)
+
+
+def decode_messages(conversation_id: str, codec: str, payload: bytes) -> List[ChatMessage]:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Hay conversaciones archivadas con zstd: instala el paquete zstandard para leerlas")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == 'zlib':
+        raw = zlib.decompress(payload)
+    else:
+        raise ValueError(f"Códec de archivo desconocido: {codec}")
+    return [
+        ChatMessage(
+            id=message_id,
+            conversation_id=conversation_id,
+            content=content,
+            sender=sender,
+            timestamp=datetime.fromisoformat(timestamp) if timestamp else None
+        )
+        for message_id, sender, timestamp, content in json.loads(raw)
+    ]
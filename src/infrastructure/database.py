@@ -1,19 +1,146 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
+import random
+from typing import Dict, Iterator, Optional
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, String, Float, DateTime, Boolean, ForeignKey, Text, Integer
+from flask_sqlalchemy.session import Session
+from sqlalchemy import (
+    Column, String, Float, DateTime, Boolean, ForeignKey, Text, Integer, LargeBinary, MetaData, Table, Index,
+    Select, inspect, select, text
+)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.dialects import mysql
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 import uuid
+from ..domain.identifiers import new_id
 
-db = SQLAlchemy()
+# Shard de los datos de pacientes sobre el que trabaja la sesión (ver sharding.py). El shard 0
+# es la base principal (DATABASE_URL); los demás son binds 'shard_<n>' (SHARD_DATABASE_URLS).
+_active_shard: ContextVar[Optional[int]] = ContextVar('active_shard', default=None)
+
+# Réplicas de lectura de cada shard (binds 'replica_<shard>_<n>', ver replicas.py). Dentro de
+# use_replica el valor es un número al azar que elige la réplica de todo el bloque.
+_replica_counts: Dict[int, int] = {}
+_read_replica: ContextVar[Optional[int]] = ContextVar('read_replica', default=None)
+
+def shard_bind_key(index: int) -> Optional[str]:
+    return None if index == 0 else f'shard_{index}'
+
+def replica_bind_key(shard: int, index: int) -> str:
+    return f'replica_{shard}_{index}'
+
+def configure_replicas(counts: Dict[int, int]) -> None:
+    """Número de réplicas de lectura de cada shard"""
+    _replica_counts.clear()
+    _replica_counts.update({shard: count for shard, count in counts.items() if count})
+
+@contextmanager
+def use_shard(index: int) -> Iterator[None]:
+    """Dirige al shard indicado las consultas de db.session dentro del bloque"""
+    token = _active_shard.set(index)
+    try:
+        yield
+    finally:
+        _active_shard.reset(token)
+
+@contextmanager
+def use_replica() -> Iterator[None]:
+    """Dirige a una réplica las consultas de solo lectura de db.session dentro del bloque"""
+    token = _read_replica.set(random.getrandbits(16))
+    try:
+        yield
+    finally:
+        _read_replica.reset(token)
+
+def dispose_engines(close: bool = True) -> None:
+    """
+    Descarta las conexiones del pool de todos los motores. Antes de hacer fork se cierran; en el
+    proceso hijo se olvidan sin cerrarlas (close=False), porque los sockets son del padre.
+    """
+    for engine in db.engines.values():
+        engine.dispose(close=close)
+
+class RoutingSession(Session):
+    """
+    Sesión que ejecuta cada consulta en el motor del shard activo (use_shard) y, dentro de
+    use_replica, los SELECT sin bloqueo en una réplica de ese shard
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            shard = _active_shard.get() or 0
+            replica = _read_replica.get()
+            if replica is not None and shard in _replica_counts and self._is_plain_read(clause):
+                return self._db.engines[replica_bind_key(shard, replica % _replica_counts[shard])]
+            if shard:
+                return self._db.engines[shard_bind_key(shard)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+    
+    def _is_plain_read(self, clause) -> bool:
+        # Las escrituras (flush, DML) y los SELECT ... FOR UPDATE van siempre al primario
+        return not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+ID_STORAGE_MODES = ('string', 'binary')
+
+class EntityId(TypeDecorator):
+    """
+    Identificador de entidad. Por defecto es texto de 36 caracteres; con ID_STORAGE=binary
+    se guarda como BINARY(16) (índices y claves foráneas de menos de la mitad de tamaño).
+    El dominio siempre recibe y entrega el texto.
+    """
+    impl = String(36)
+    cache_ok = True
+    
+    # Lo fija configure_id_storage antes de crear las tablas
+    binary = False
+    
+    def load_dialect_impl(self, dialect):
+        if not EntityId.binary:
+            return dialect.type_descriptor(String(36))
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.BINARY(16))
+        return dialect.type_descriptor(LargeBinary(16))
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or not EntityId.binary:
+            return value
+        try:
+            return uuid.UUID(str(value)).bytes
+        except ValueError:
+            # Un id mal formado no coincide con ninguna fila (como con la columna de texto)
+            return b''
+    
+    def process_result_value(self, value, dialect):
+        if value is None or not EntityId.binary:
+            return value
+        return str(uuid.UUID(bytes=bytes(value)))
+
+def configure_id_storage(mode: str) -> None:
+    """Elige cómo se guardan los identificadores: 'string' (CHAR 36) o 'binary' (BINARY 16)"""
+    if mode not in ID_STORAGE_MODES:
+        raise ValueError(f"ID_STORAGE debe ser uno de: {', '.join(ID_STORAGE_MODES)}")
+    EntityId.binary = mode == 'binary'
 
 class UserModel(db.Model):
     __tablename__ = 'users'
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(EntityId(), primary_key=True, default=new_id)
     name = Column(String(100), nullable=False)
     age = Column(Integer, nullable=False)
     gender = Column(String(10), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    # Versión del historial: aumenta con cada examen, conversación o mensaje nuevo y con cada
+    # corrección o depuración de sus datos; history_modified_at (UTC) es su Last-Modified
+    history_version = Column(Integer, nullable=False, default=0, server_default='0')
+    history_modified_at = Column(DateTime, nullable=True)
+    # Última actividad del usuario (UTC), para la retención: solo cambia con sus escrituras
+    history_updated_at = Column(DateTime, nullable=True)
+    
     # Relaciones
     blood_tests = db.relationship("BloodTestModel", back_populates="user", cascade="all, delete-orphan")
     conversations = db.relationship("ChatConversationModel", back_populates="user", cascade="all, delete-orphan")
@@ -21,8 +148,8 @@ class UserModel(db.Model):
 class BloodTestModel(db.Model):
     __tablename__ = 'blood_tests'
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String(36), ForeignKey('users.id'), nullable=False)
+    id = Column(EntityId(), primary_key=True, default=new_id)
+    user_id = Column(EntityId(), ForeignKey('users.id'), nullable=False)
     glucose = Column(Float, nullable=True)
     cholesterol = Column(Float, nullable=True)
     hdl_cholesterol = Column(Float, nullable=True)
@@ -45,24 +172,242 @@ class BloodTestModel(db.Model):
 class ChatConversationModel(db.Model):
     __tablename__ = 'chat_conversations'
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String(36), ForeignKey('users.id'), nullable=False)
-    blood_test_id = Column(String(36), ForeignKey('blood_tests.id'), nullable=True)
+    id = Column(EntityId(), primary_key=True, default=new_id)
+    user_id = Column(EntityId(), ForeignKey('users.id'), nullable=False)
+    blood_test_id = Column(EntityId(), ForeignKey('blood_tests.id'), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    # Contadores desnormalizados: se actualizan en la misma transacción que guarda cada mensaje
+    # (incluyen los mensajes archivados); repair-conversation-counters los recalcula
+    message_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_message_at = Column(DateTime, nullable=True)
+    last_sender = Column(String(20), nullable=True)
+    
     # Relaciones
     user = db.relationship("UserModel", back_populates="conversations")
     blood_test = db.relationship("BloodTestModel", back_populates="conversations")
     messages = db.relationship("ChatMessageModel", back_populates="conversation", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        # Listado de las conversaciones de un usuario sin ordenar en memoria
+        Index('ix_chat_conversations_user_created', 'user_id', 'created_at'),
+    )
 
 class ChatMessageModel(db.Model):
     __tablename__ = 'chat_messages'
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    conversation_id = Column(String(36), ForeignKey('chat_conversations.id'), nullable=False)
+    id = Column(EntityId(), primary_key=True, default=new_id)
+    conversation_id = Column(EntityId(), ForeignKey('chat_conversations.id'), nullable=False)
     content = Column(Text, nullable=False)
     sender = Column(String(20), nullable=False)  # 'user' o 'assistant'
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     # Relaciones
     conversation = db.relationship("ChatConversationModel", back_populates="messages")
+    
+    __table_args__ = (
+        # Mensajes de una conversación en orden y última actividad por conversación (archivo)
+        Index('ix_chat_messages_conversation_timestamp', 'conversation_id', 'timestamp'),
+        # Mensajes más antiguos que el plazo de retención
+        Index('ix_chat_messages_timestamp', 'timestamp'),
+    )
+
+class ChatConversationArchiveModel(db.Model):
+    """
+    Mensajes archivados de una conversación inactiva: salen de chat_messages y se guardan
+    juntos en un blob comprimido (ver conversation_archive)
+    """
+    __tablename__ = 'chat_conversation_archives'
+    
+    conversation_id = Column(EntityId(), ForeignKey('chat_conversations.id'), primary_key=True)
+    codec = Column(String(10), nullable=False)  # 'zstd' o 'zlib'
+    payload = Column(LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=False)
+    message_count = Column(Integer, nullable=False)
+    raw_size = Column(Integer, nullable=False)  # bytes del texto de los mensajes sin comprimir
+    first_message_at = Column(DateTime, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_chat_conversation_archives_last_message', 'last_message_at'),
+    )
+
+class UserLatestRiskModel(db.Model):
+    """Riesgo del último examen de cada usuario: su aporte actual a los agregados de cohortes"""
+    __tablename__ = 'user_latest_risk'
+    
+    user_id = Column(EntityId(), ForeignKey('users.id'), primary_key=True)
+    blood_test_id = Column(EntityId(), nullable=False)
+    test_date = Column(DateTime, nullable=False)
+    age_band = Column(String(10), nullable=False)
+    gender = Column(String(10), nullable=False)
+    overall_risk = Column(String(20), nullable=False)
+    risk_factors = Column(Text, nullable=False, default='[]')  # lista JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CohortRiskAggregateModel(db.Model):
+    """Pacientes por cohorte (banda de edad y género) y nivel de riesgo o factor de riesgo"""
+    __tablename__ = 'cohort_risk_aggregates'
+    
+    age_band = Column(String(10), primary_key=True)
+    gender = Column(String(10), primary_key=True)
+    dimension = Column(String(20), primary_key=True)  # 'risk_level' o 'risk_factor'
+    value = Column(String(100), primary_key=True)
+    patient_count = Column(Integer, nullable=False, default=0)
+
+class AnalyteTrendModel(db.Model):
+    """Estadísticas acumuladas por usuario y analito (Welford y ventana de valores recientes)"""
+    __tablename__ = 'analyte_trends'
+    
+    user_id = Column(EntityId(), ForeignKey('users.id'), primary_key=True)
+    analyte = Column(String(30), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    mean = Column(Float, nullable=False, default=0.0)
+    m2 = Column(Float, nullable=False, default=0.0)
+    recent_values = Column(Text, nullable=False, default='[]')  # lista JSON de [fecha ISO, valor]
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Índice de texto completo de los mensajes en SQLite (tabla virtual FTS5). No forma parte de
+# db.metadata porque create_all no sabe crear tablas virtuales: la crea ensure_search_index.
+# Su rowid es el rowid del mensaje en chat_messages, para poder borrar entradas sin recorrerla.
+MESSAGE_SEARCH_TABLE = Table(
+    'chat_messages_fts', MetaData(),
+    Column('rowid', Integer, primary_key=True),
+    Column('content', Text),
+    Column('message_id', EntityId())
+)
+
+SEARCH_BACKENDS = ('fts5', 'fulltext', 'like')
+
+def ensure_search_index(engine=None) -> str:
+    """
+    Prepara el índice de búsqueda de mensajes y devuelve el motor disponible: 'fts5' (SQLite),
+    'fulltext' (índice FULLTEXT de MySQL) o 'like' (recorrido sin índice)
+    """
+    engine = engine or db.engine
+    dialect = engine.dialect.name
+    if dialect == 'sqlite':
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {MESSAGE_SEARCH_TABLE.name} "
+                    "USING fts5(content, message_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')"
+                ))
+            return 'fts5'
+        except OperationalError:
+            # SQLite compilado sin FTS5
+            return 'like'
+    if dialect == 'mysql':
+        indexes = inspect(engine).get_indexes(ChatMessageModel.__tablename__)
+        if not any(index['name'] == 'ft_chat_messages_content' for index in indexes):
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {ChatMessageModel.__tablename__} "
+                    "ADD FULLTEXT INDEX ft_chat_messages_content (content)"
+                ))
+        return 'fulltext'
+    return 'like'
+
+# Versión del esquema aplicada a cada base. En el arranque diferido (LAZY_INIT) se compara con la
+# de los modelos y, si coincide, no se repiten create_all, la migración aditiva ni el índice de búsqueda
+SCHEMA_STATE_TABLE = Table(
+    'app_schema_state', MetaData(),
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('version', String(64), nullable=False),
+    Column('search_backend', String(16), nullable=False),
+    Column('updated_at', DateTime, nullable=False)
+)
+
+def schema_version(dialect) -> str:
+    """Huella de las tablas, columnas e índices de los modelos tal como se crean en el dialecto"""
+    digest = hashlib.sha256()
+    for table in db.metadata.sorted_tables:
+        digest.update(f'table {table.name}\n'.encode())
+        for column in table.columns:
+            server_default = getattr(column.server_default, 'arg', None)
+            digest.update(
+                f'{column.name} {column.type.compile(dialect=dialect)} {column.nullable} '
+                f'{column.primary_key} {getattr(server_default, "text", server_default)}\n'.encode()
+            )
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(f'index {index.name} {[column.name for column in index.columns]}\n'.encode())
+    digest.update(f'search {[column.name for column in MESSAGE_SEARCH_TABLE.columns]}'.encode())
+    return digest.hexdigest()
+
+def prepare_schema(engine=None, use_cache: bool = False) -> str:
+    """
+    Crea las tablas, agrega las columnas e índices nuevos y prepara el índice de búsqueda;
+    devuelve el motor de búsqueda. Con use_cache se omite todo si la base ya tiene esta versión
+    """
+    engine = engine or db.engine
+    version = schema_version(engine.dialect)
+    if use_cache:
+        state = _stored_schema_state(engine)
+        if state is not None and state.version == version:
+            return state.search_backend
+    db.metadata.create_all(engine)
+    upgrade_schema(engine)
+    search_backend = ensure_search_index(engine)
+    SCHEMA_STATE_TABLE.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(SCHEMA_STATE_TABLE.delete())
+        connection.execute(SCHEMA_STATE_TABLE.insert().values(
+            id=1, version=version, search_backend=search_backend, updated_at=datetime.now()
+        ))
+    return search_backend
+
+def _stored_schema_state(engine):
+    try:
+        with engine.connect() as connection:
+            return connection.execute(
+                select(SCHEMA_STATE_TABLE.c.version, SCHEMA_STATE_TABLE.c.search_backend)
+            ).first()
+    except (OperationalError, ProgrammingError):
+        # Base nueva o creada antes de la tabla de estado
+        return None
+
+def upgrade_schema(engine=None):
+    """Agrega a las tablas existentes las columnas e índices nuevos de los modelos (migración aditiva)"""
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    _check_id_storage(inspector, existing_tables)
+    
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {_default_literal(column.server_default.arg)}'
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                connection.execute(text(ddl))
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+
+def _check_id_storage(inspector, existing_tables) -> None:
+    """El modo de ID_STORAGE no puede cambiar sobre tablas ya creadas con el otro formato"""
+    if 'users' not in existing_tables:
+        return
+    id_column = next(column for column in inspector.get_columns('users') if column['name'] == 'id')
+    stored_as_binary = isinstance(id_column['type'], (LargeBinary, mysql.BINARY))
+    if stored_as_binary != EntityId.binary:
+        stored = 'binary' if stored_as_binary else 'string'
+        raise RuntimeError(
+            f"La base de datos guarda los identificadores como '{stored}' pero ID_STORAGE="
+            f"'{'binary' if EntityId.binary else 'string'}'; el modo solo se puede elegir al crear la base"
+        )
+
+def _default_literal(value) -> str:
+    value = getattr(value, 'text', value)
+    if isinstance(value, str) and not value.lstrip('-').replace('.', '', 1).isdigit():
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
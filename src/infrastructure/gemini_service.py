@@ -1,39 +1,61 @@
-import google.generativeai as genai
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Optional
 import json
 import os
+from threading import Lock
+from time import perf_counter
 from dotenv import load_dotenv
+from .metrics import gemini_request_duration, gemini_prompt_size, gemini_response_size
+from .tracing import tracer
 
 load_dotenv()
 
 class GeminiService:
     """Servicio para interactuar con Google Gemini AI"""
     
-    def __init__(self):
+    def __init__(self, lazy: bool = False):
         self.api_key = os.getenv('GEMINI_API_KEY')
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY no está configurada en las variables de entorno")
         
-        genai.configure(api_key=self.api_key)
-        
         # Usar el modelo más avanzado disponible
         # Opciones: 'gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-pro'
-        model_name = os.getenv('GEMINI_MODEL', 'gemini-1.5-pro')
-        self.model = genai.GenerativeModel(model_name)
+        self.model_name = os.getenv('GEMINI_MODEL', 'gemini-1.5-pro')
         
-        print(f"🤖 Usando modelo Gemini: {model_name}")
+        # google.generativeai tarda medio segundo en importarse: en modo diferido el cliente se
+        # configura con la primera llamada al modelo y no al arrancar el proceso
+        self._model = None
+        self._model_lock = Lock()
+        if not lazy:
+            self._load_model()
+    
+    @property
+    def model(self):
+        return self._model if self._model is not None else self._load_model()
+    
+    @model.setter
+    def model(self, model):
+        self._model = model
+    
+    def _load_model(self):
+        with self._model_lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+                print(f"🤖 Usando modelo Gemini: {self.model_name}")
+            return self._model
     
     def analyze_blood_test_with_ai(self, blood_test_data: Dict[str, Any], 
                                   user_data: Dict[str, Any], 
-                                  analysis: Dict[str, Any]) -> str:
+                                  analysis: Dict[str, Any],
+                                  trends: Optional[List[Dict[str, Any]]] = None) -> str:
         """
         Usa Gemini para generar una explicación detallada del análisis de sangre
         """
-        prompt = self._create_analysis_prompt(blood_test_data, user_data, analysis)
+        prompt = self._create_analysis_prompt(blood_test_data, user_data, analysis, trends)
         
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            return self._generate('analyze_blood_test', prompt)
         except Exception as e:
             return f"Error al generar análisis con IA: {str(e)}"
     
@@ -45,14 +67,61 @@ class GeminiService:
         prompt = self._create_chat_prompt(user_message, blood_test_data, user_data, analysis)
         
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            return self._generate('chat', prompt)
         except Exception as e:
             return "Lo siento, hubo un error al procesar tu consulta. Por favor intenta de nuevo."
     
+    def stream_chat_with_user(self, user_message: str, blood_test_data: Dict[str, Any],
+                              user_data: Dict[str, Any], analysis: Dict[str, Any]) -> Iterator[str]:
+        """
+        Igual que chat_with_user pero emite la respuesta por fragmentos a medida que llega
+        """
+        prompt = self._create_chat_prompt(user_message, blood_test_data, user_data, analysis)
+        operation = 'chat_stream'
+        gemini_prompt_size.observe(len(prompt), model=self.model_name, operation=operation)
+        start = perf_counter()
+        outcome = 'error'
+        response_chars = 0
+        
+        with tracer.span('gemini.generate_content', model=self.model_name, operation=operation,
+                         prompt_chars=len(prompt)):
+            try:
+                for chunk in self.model.generate_content(prompt, stream=True):
+                    text = chunk.text
+                    if text:
+                        response_chars += len(text)
+                        yield text
+                outcome = 'success'
+            except Exception:
+                if response_chars == 0:
+                    yield "Lo siento, hubo un error al procesar tu consulta. Por favor intenta de nuevo."
+            finally:
+                gemini_request_duration.observe(perf_counter() - start, model=self.model_name,
+                                                operation=operation, outcome=outcome)
+        gemini_response_size.observe(response_chars, model=self.model_name, operation=operation)
+    
+    def _generate(self, operation: str, prompt: str) -> str:
+        """Llama a Gemini registrando latencia y tamaño de prompt/respuesta"""
+        gemini_prompt_size.observe(len(prompt), model=self.model_name, operation=operation)
+        start = perf_counter()
+        outcome = 'error'
+        with tracer.span('gemini.generate_content', model=self.model_name, operation=operation,
+                         prompt_chars=len(prompt)) as span:
+            try:
+                text = self.model.generate_content(prompt).text
+                outcome = 'success'
+            finally:
+                gemini_request_duration.observe(perf_counter() - start, model=self.model_name,
+                                                operation=operation, outcome=outcome)
+            if span is not None:
+                span.set_attribute('response_chars', len(text))
+        gemini_response_size.observe(len(text), model=self.model_name, operation=operation)
+        return text
+    
     def _create_analysis_prompt(self, blood_test_data: Dict[str, Any], 
                                user_data: Dict[str, Any], 
-                               analysis: Dict[str, Any]) -> str:
+                               analysis: Dict[str, Any],
+                               trends: Optional[List[Dict[str, Any]]] = None) -> str:
         """Crea el prompt para análisis de examen de sangre"""
         
         return f"""
@@ -76,7 +145,7 @@ ANÁLISIS:
 - Glucosa: {analysis.get('glucose_status')}
 - Colesterol: {analysis.get('cholesterol_status')}
 - Función renal: {analysis.get('kidney_function_status')}
-
+{self._format_trends(trends)}
 INSTRUCCIONES:
 1. Respuesta máximo 4 párrafos cortos
 2. Enfócate solo en valores alterados
@@ -84,10 +153,27 @@ INSTRUCCIONES:
 4. Usa lenguaje simple y directo
 5. Incluye 2-3 recomendaciones específicas
 6. Responde en español
+7. Si hay alertas de tendencia, coméntalas brevemente
 
 Proporciona un análisis breve y directo.
 """
 
+    def _format_trends(self, trends: Optional[List[Dict[str, Any]]]) -> str:
+        """Sección de tendencias del prompt (solo analitos con exámenes anteriores)"""
+        lines = []
+        for trend in trends or []:
+            if trend['tests'] < 2:
+                continue
+            line = f"- {trend['label']}: media {trend['mean']} en {trend['tests']} exámenes"
+            if trend['change_percent'] is not None:
+                line += f", variación {trend['change_percent']:+}% respecto al anterior"
+            if trend['alerts']:
+                line += f" (ALERTA: {'; '.join(trend['alerts'])})"
+            lines.append(line)
+        if not lines:
+            return ''
+        return '\nTENDENCIAS (exámenes anteriores):\n' + '\n'.join(lines) + '\n'
+    
     def _create_chat_prompt(self, user_message: str, blood_test_data: Dict[str, Any], 
                            user_data: Dict[str, Any], analysis: Dict[str, Any]) -> str:
         """Crea el prompt para conversación del chatbot"""
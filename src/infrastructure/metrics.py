@@ -0,0 +1,274 @@
+"""
+Métricas de latencia y contadores en formato de texto de Prometheus
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from inspect import isgeneratorfunction
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Tuple, Sequence, List
+from .tracing import tracer
+
+# Buckets por defecto en segundos: cubren desde consultas SQL rápidas hasta llamadas a Gemini
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Buckets para tamaños de prompts y respuestas (caracteres)
+DEFAULT_SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Contador monotónico con etiquetas"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}'
+            for key, value in items
+        ]
+
+
+class _HistogramChild:
+    """Serie de un histograma para una combinación concreta de etiquetas"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, bucket_count: int):
+        self.counts = [0] * bucket_count
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Histograma con buckets fijos; observar es una búsqueda binaria y tres sumas"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children: Dict[Tuple[str, ...], _HistogramChild] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = _HistogramChild(len(self.buckets) + 1)
+            child.counts[index] += 1
+            child.sum += value
+            child.count += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted(
+                (key, list(child.counts), child.sum, child.count)
+                for key, child in self._children.items()
+            )
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_number(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Registro de métricas del proceso"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        """Exporta todas las métricas en formato de texto de Prometheus"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+# === MÉTRICAS DE LA APLICACIÓN ===
+
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds',
+    'Duración de las peticiones HTTP por endpoint',
+    ('method', 'route', 'status')
+)
+http_requests_total = registry.counter(
+    'http_requests_total',
+    'Total de peticiones HTTP por endpoint',
+    ('method', 'route', 'status')
+)
+http_requests_rejected_total = registry.counter(
+    'http_requests_rejected_total',
+    'Peticiones rechazadas por límite de tasa o por sobrecarga',
+    ('route', 'reason')
+)
+repository_duration = registry.histogram(
+    'repository_operation_duration_seconds',
+    'Duración de las operaciones de los repositorios',
+    ('repository', 'method')
+)
+repository_errors_total = registry.counter(
+    'repository_operation_errors_total',
+    'Total de errores en operaciones de los repositorios',
+    ('repository', 'method')
+)
+repository_reads_total = registry.counter(
+    'repository_reads_total',
+    'Lecturas de los repositorios por destino (replica, primary) y motivo',
+    ('target', 'reason')
+)
+use_case_step_duration = registry.histogram(
+    'use_case_step_duration_seconds',
+    'Duración de cada paso de los casos de uso',
+    ('use_case', 'step')
+)
+gemini_request_duration = registry.histogram(
+    'gemini_request_duration_seconds',
+    'Duración de las llamadas a Gemini',
+    ('model', 'operation', 'outcome')
+)
+gemini_prompt_size = registry.histogram(
+    'gemini_prompt_size_chars',
+    'Tamaño de los prompts enviados a Gemini (caracteres)',
+    ('model', 'operation'),
+    DEFAULT_SIZE_BUCKETS
+)
+gemini_response_size = registry.histogram(
+    'gemini_response_size_chars',
+    'Tamaño de las respuestas de Gemini (caracteres)',
+    ('model', 'operation'),
+    DEFAULT_SIZE_BUCKETS
+)
+
+
+@contextmanager
+def track_step(use_case: str, step: str):
+    """Mide la duración de un paso de un caso de uso y lo registra como span"""
+    with tracer.span(f'{use_case}.{step}', use_case=use_case, step=step):
+        with use_case_step_duration.time(use_case=use_case, step=step):
+            yield
+
+
+def instrument_repository(cls):
+    """Decorador de clase que mide cada método público de un repositorio"""
+    repository_name = cls.__name__
+    for attribute, value in list(vars(cls).items()):
+        if attribute.startswith('_') or not callable(value):
+            continue
+        setattr(cls, attribute, _timed_method(value, repository_name, attribute))
+    return cls
+
+
+def _timed_method(method, repository_name: str, method_name: str):
+    if isgeneratorfunction(method):
+        return _timed_generator(method, repository_name, method_name)
+    span_name = f'{repository_name}.{method_name}'
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        span, token = tracer.start_span(span_name)
+        start = perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as error:
+            repository_errors_total.inc(repository=repository_name, method=method_name)
+            tracer.end_span(span, token, error)
+            raise
+        finally:
+            repository_duration.observe(perf_counter() - start,
+                                        repository=repository_name, method=method_name)
+        tracer.end_span(span, token)
+        return result
+    return wrapper
+
+
+def _timed_generator(method, repository_name: str, method_name: str):
+    # Los recorridos por lotes se consumen mientras se envía la respuesta, a menudo
+    # después de cerrar la traza: se mide el recorrido completo sin abrir un span
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            yield from method(*args, **kwargs)
+        except Exception:
+            repository_errors_total.inc(repository=repository_name, method=method_name)
+            raise
+        finally:
+            repository_duration.observe(perf_counter() - start,
+                                        repository=repository_name, method=method_name)
+    return wrapper
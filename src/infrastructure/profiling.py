@@ -0,0 +1,103 @@
+"""
+Perfilado bajo demanda de peticiones individuales con cProfile
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+from datetime import datetime
+from random import getrandbits, random
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+
+
+class ProfileStore:
+    """Guarda perfiles en formato pstats junto a un archivo JSON con sus metadatos"""
+
+    def __init__(self, directory: str, max_profiles: int = 50):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, profile: cProfile.Profile, metadata: Dict[str, Any]) -> str:
+        profile_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{getrandbits(32):08x}"
+        profile.dump_stats(self._stats_path(profile_id))
+        with open(self._metadata_path(profile_id), 'w', encoding='utf-8') as metadata_file:
+            json.dump({'id': profile_id, **metadata}, metadata_file, ensure_ascii=False)
+        self._enforce_limit()
+        return profile_id
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Perfiles guardados, del más reciente al más antiguo"""
+        profiles = []
+        for profile_id in self._profile_ids(newest_first=True):
+            try:
+                with open(self._metadata_path(profile_id), encoding='utf-8') as metadata_file:
+                    profiles.append(json.load(metadata_file))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def stats_path(self, profile_id: str) -> Optional[str]:
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = self._stats_path(profile_id)
+        return path if os.path.exists(path) else None
+
+    def summary(self, profile_id: str, limit: int = 40, sort_by: str = 'cumulative') -> Optional[str]:
+        """Resumen legible con las funciones más costosas"""
+        path = self.stats_path(profile_id)
+        if path is None:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(path, stream=output)
+        stats.strip_dirs().sort_stats(sort_by).print_stats(limit)
+        return output.getvalue()
+
+    def _profile_ids(self, newest_first: bool = False) -> List[str]:
+        ids = [
+            name[:-len('.pstats')] for name in os.listdir(self.directory)
+            if name.endswith('.pstats') and PROFILE_ID_PATTERN.match(name[:-len('.pstats')])
+        ]
+        return sorted(ids, reverse=newest_first)
+
+    def _enforce_limit(self) -> None:
+        with self._lock:
+            ids = self._profile_ids()
+            for profile_id in ids[:max(0, len(ids) - self.max_profiles)]:
+                for path in (self._stats_path(profile_id), self._metadata_path(profile_id)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _stats_path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f'{profile_id}.pstats')
+
+    def _metadata_path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f'{profile_id}.json')
+
+
+class RequestProfiler:
+    """Decide qué peticiones perfilar y guarda el resultado en el ProfileStore"""
+
+    def __init__(self, store: ProfileStore, sample_rate: float = 0.0):
+        self.store = store
+        self.sample_rate = sample_rate
+
+    def should_profile(self, forced: bool = False) -> bool:
+        return forced or (self.sample_rate > 0 and random() < self.sample_rate)
+
+    def start(self) -> cProfile.Profile:
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, metadata: Dict[str, Any]) -> str:
+        profile.disable()
+        return self.store.save(profile, metadata)
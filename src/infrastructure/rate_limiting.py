@@ -0,0 +1,191 @@
+"""
+Límites de tasa por ventana deslizante y control de admisión de peticiones costosas
+"""
+import os
+from abc import ABC, abstractmethod
+from math import ceil
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from .shared_state import SharedStateStore
+
+
+class RateLimitStore(ABC):
+    """Almacén de contadores por ventana fija, base de la ventana deslizante"""
+
+    @abstractmethod
+    def increment(self, key: str, window_index: int, ttl_seconds: int) -> Tuple[int, int]:
+        """Incrementa el contador de la ventana actual; devuelve (actual, anterior)"""
+        pass
+
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """Contadores en memoria del proceso (un registro por clave)"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._counters: Dict[str, List[int]] = {}  # clave -> [ventana, actual, anterior]
+        self._lock = Lock()
+
+    def increment(self, key: str, window_index: int, ttl_seconds: int) -> Tuple[int, int]:
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                if len(self._counters) >= self.max_keys:
+                    self._evict(window_index)
+                counter = self._counters[key] = [window_index, 0, 0]
+            elif counter[0] != window_index:
+                previous = counter[1] if counter[0] == window_index - 1 else 0
+                counter[0], counter[1], counter[2] = window_index, 0, previous
+            counter[1] += 1
+            return counter[1], counter[2]
+
+    def _evict(self, window_index: int) -> None:
+        # Descarta las claves sin actividad en las dos últimas ventanas
+        stale = [key for key, counter in self._counters.items() if counter[0] < window_index - 1]
+        for key in stale:
+            del self._counters[key]
+        if len(self._counters) >= self.max_keys:
+            self._counters.clear()
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """Contadores compartidos entre procesos y servidores en Redis (dependencia opcional)"""
+
+    def __init__(self, url: str, prefix: str = 'ratelimit'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def increment(self, key: str, window_index: int, ttl_seconds: int) -> Tuple[int, int]:
+        current_key = f'{self.prefix}:{key}:{window_index}'
+        previous_key = f'{self.prefix}:{key}:{window_index - 1}'
+        pipeline = self.client.pipeline()
+        pipeline.incr(current_key)
+        pipeline.expire(current_key, ttl_seconds)
+        pipeline.get(previous_key)
+        current, _, previous = pipeline.execute()
+        return int(current), int(previous or 0)
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Contadores compartidos por los workers de un servidor en un archivo SQLite local"""
+
+    # Cada cuántos incrementos se borran las claves sin actividad reciente
+    PRUNE_EVERY = 1000
+
+    def __init__(self, shared_state: SharedStateStore):
+        self.shared_state = shared_state
+        self._increments = 0
+
+    def increment(self, key: str, window_index: int, ttl_seconds: int) -> Tuple[int, int]:
+        with self.shared_state.transaction() as connection:
+            row = connection.execute(
+                'SELECT window_index, current, previous FROM rate_limit_counters WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                current, previous = 1, 0
+            elif row[0] == window_index:
+                current, previous = row[1] + 1, row[2]
+            else:
+                current, previous = 1, row[1] if row[0] == window_index - 1 else 0
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit_counters (key, window_index, current, previous) VALUES (?, ?, ?, ?)',
+                (key, window_index, current, previous)
+            )
+            self._increments += 1
+            if self._increments % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM rate_limit_counters WHERE window_index < ?', (window_index - 1,))
+        return current, previous
+
+
+class SlidingWindowRateLimiter:
+    """
+    Ventana deslizante aproximada: pondera la ventana anterior según cuánto se
+    solapa con la actual. Usa memoria constante por clave.
+    """
+
+    def __init__(self, store: RateLimitStore, limit: int, window_seconds: int = 60):
+        self.store = store
+        self.limit = limit
+        self.window_seconds = window_seconds
+
+    def hit(self, key: str) -> Tuple[bool, int]:
+        """Registra una petición; devuelve (permitida, segundos sugeridos para reintentar)"""
+        now = time()
+        window_index = int(now // self.window_seconds)
+        elapsed = now - window_index * self.window_seconds
+        current, previous = self.store.increment(key, window_index, self.window_seconds * 2)
+        weight = 1 - elapsed / self.window_seconds
+        if current + previous * weight <= self.limit:
+            return True, 0
+        return False, max(1, ceil(self.window_seconds - elapsed))
+
+
+class AdmissionController:
+    """Limita las peticiones concurrentes que dependen del LLM y descarta el exceso"""
+
+    def __init__(self, max_in_flight: int, retry_after_seconds: int = 5):
+        self.max_in_flight = max_in_flight
+        self.retry_after_seconds = retry_after_seconds
+        self._in_flight = 0
+        self._lock = Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+
+class SharedAdmissionController(AdmissionController):
+    """Control de admisión con el límite de peticiones en curso común a todos los workers"""
+
+    def __init__(self, shared_state: SharedStateStore, max_in_flight: int, retry_after_seconds: int = 5):
+        super().__init__(max_in_flight, retry_after_seconds)
+        self.shared_state = shared_state
+
+    @property
+    def in_flight(self) -> int:
+        row = self.shared_state.connection().execute(
+            'SELECT COALESCE(SUM(in_flight), 0) FROM admission_slots'
+        ).fetchone()
+        return row[0]
+
+    def try_acquire(self) -> bool:
+        with self.shared_state.transaction() as connection:
+            in_flight = connection.execute('SELECT COALESCE(SUM(in_flight), 0) FROM admission_slots').fetchone()[0]
+            if in_flight >= self.max_in_flight:
+                return False
+            connection.execute(
+                'INSERT INTO admission_slots (pid, in_flight) VALUES (?, 1) '
+                'ON CONFLICT (pid) DO UPDATE SET in_flight = in_flight + 1',
+                (os.getpid(),)
+            )
+            return True
+
+    def release(self) -> None:
+        with self.shared_state.transaction() as connection:
+            connection.execute(
+                'UPDATE admission_slots SET in_flight = MAX(in_flight - 1, 0) WHERE pid = ?', (os.getpid(),)
+            )
+
+
+def create_rate_limit_store(storage_url: Optional[str],
+                            shared_state: Optional[SharedStateStore] = None) -> RateLimitStore:
+    """Almacén en Redis (RATE_LIMIT_STORAGE_URL), en el estado compartido de los workers o en memoria"""
+    if storage_url and storage_url.startswith(('redis://', 'rediss://')):
+        return RedisRateLimitStore(storage_url)
+    if shared_state is not None:
+        return SQLiteRateLimitStore(shared_state)
+    return InMemoryRateLimitStore()
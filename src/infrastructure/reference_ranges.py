@@ -0,0 +1,78 @@
+"""
+Registro de rangos de referencia: carga el ruleset desde un archivo JSON y lo recarga
+en caliente cuando el archivo cambia, sin reiniciar la aplicación
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from ..domain.value_objects.reference_ranges import DEFAULT_RULESET_PATH, ReferenceRuleset, load_ruleset
+
+
+class ReferenceRangeRegistry:
+    """
+    Mantiene el ruleset vigente. Como máximo cada check_interval segundos compara la fecha
+    de modificación del archivo; si cambió, lo compila y lo publica de forma atómica. Un
+    archivo inválido no reemplaza al ruleset vigente.
+    """
+
+    def __init__(self, path: Optional[str] = None, check_interval: float = 5.0):
+        self.path = path or DEFAULT_RULESET_PATH
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # El ruleset inicial debe ser válido: sin él no se puede analizar ningún examen
+        self._signature = self._file_signature()
+        self._ruleset = load_ruleset(self.path)
+        self._loaded_at = datetime.now()
+        self._last_error: Optional[str] = None
+        self._next_check = time.monotonic() + check_interval
+
+    def current(self) -> ReferenceRuleset:
+        """Ruleset vigente, revisando antes si el archivo cambió"""
+        if self.check_interval >= 0 and time.monotonic() >= self._next_check:
+            self.reload()
+        return self._ruleset
+
+    def reload(self, force: bool = False) -> bool:
+        """Recarga el archivo si cambió (o siempre con force); indica si se publicó un ruleset nuevo"""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                signature = self._file_signature()
+            except OSError as e:
+                self._last_error = str(e)
+                return False
+            if signature == self._signature and not force:
+                return False
+
+            try:
+                ruleset = load_ruleset(self.path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # json.JSONDecodeError es un ValueError
+                self._signature = signature
+                self._last_error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ Rangos de referencia inválidos en {self.path}, se mantiene la versión "
+                      f"{self._ruleset.version}: {self._last_error}")
+                return False
+
+            self._signature = signature
+            self._ruleset = ruleset
+            self._loaded_at = datetime.now()
+            self._last_error = None
+        print(f"🔄 Rangos de referencia recargados: versión {ruleset.version}")
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'version': self._ruleset.version,
+            'path': self.path,
+            'loaded_at': self._loaded_at.isoformat(),
+            'check_interval_seconds': self.check_interval,
+            'last_error': self._last_error
+        }
+
+    def _file_signature(self) -> Tuple[int, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
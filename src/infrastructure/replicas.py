@@ -0,0 +1,322 @@
+"""
+Lecturas desde réplicas de la base de datos con consistencia "leer lo que uno escribió".
+
+Las réplicas se configuran con REPLICA_DATABASE_URLS (y SHARD_REPLICA_DATABASE_URLS para los
+shards). Los repositorios Replica* envían a una réplica las lecturas de historial y de
+conversaciones; las escrituras van siempre al primario y dejan marcados, durante unos segundos,
+el usuario y los ids escritos. Mientras la marca dura, las lecturas de esas claves se hacen en
+el primario, de modo que el paciente ve sus propios cambios aunque la réplica vaya retrasada.
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime
+from functools import lru_cache
+from threading import Lock
+from time import monotonic, time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.exc import OperationalError
+
+from .database import db, use_replica
+from .metrics import repository_reads_total
+from .shared_state import SharedStateStore
+from .repositories import (
+    UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository,
+    AnalyteTrendRepository
+)
+from ..domain.entities import User, BloodTest, BloodTestPanel, ChatConversation, ChatMessage
+from ..domain.value_objects import PatientRiskSnapshot, AnalyteTrend, ConversationSummary
+
+T = TypeVar('T')
+
+
+class StickinessStore(ABC):
+    """Marcas temporales de las claves escritas recientemente"""
+
+    @abstractmethod
+    def mark(self, keys: Iterable[str], seconds: float) -> None:
+        pass
+
+    @abstractmethod
+    def is_marked(self, key: str) -> bool:
+        pass
+
+
+class InMemoryStickinessStore(StickinessStore):
+    """Marcas en memoria del proceso"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._deadlines: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def mark(self, keys: Iterable[str], seconds: float) -> None:
+        deadline = monotonic() + seconds
+        with self._lock:
+            for key in keys:
+                if key not in self._deadlines and len(self._deadlines) >= self.max_keys:
+                    self._evict()
+                self._deadlines[key] = deadline
+
+    def is_marked(self, key: str) -> bool:
+        with self._lock:
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                return False
+            if deadline <= monotonic():
+                del self._deadlines[key]
+                return False
+            return True
+
+    def _evict(self) -> None:
+        now = monotonic()
+        expired = [key for key, deadline in self._deadlines.items() if deadline <= now]
+        for key in expired:
+            del self._deadlines[key]
+        if len(self._deadlines) >= self.max_keys:
+            self._deadlines.clear()
+
+
+class RedisStickinessStore(StickinessStore):
+    """Marcas compartidas entre procesos y servidores en Redis (dependencia opcional)"""
+
+    def __init__(self, url: str, prefix: str = 'sticky'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def mark(self, keys: Iterable[str], seconds: float) -> None:
+        milliseconds = max(1, int(seconds * 1000))
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.set(f'{self.prefix}:{key}', 1, px=milliseconds)
+        pipeline.execute()
+
+    def is_marked(self, key: str) -> bool:
+        return bool(self.client.exists(f'{self.prefix}:{key}'))
+
+
+class SQLiteStickinessStore(StickinessStore):
+    """Marcas compartidas por los workers de un servidor en un archivo SQLite local"""
+
+    # Cada cuántas marcas se borran las vencidas
+    PRUNE_EVERY = 1000
+
+    def __init__(self, shared_state: SharedStateStore):
+        self.shared_state = shared_state
+        self._marks = 0
+
+    def mark(self, keys: Iterable[str], seconds: float) -> None:
+        now = time()
+        with self.shared_state.transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO stickiness_marks (key, expires_at) VALUES (?, ?)',
+                [(key, now + seconds) for key in keys]
+            )
+            self._marks += 1
+            if self._marks % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM stickiness_marks WHERE expires_at <= ?', (now,))
+
+    def is_marked(self, key: str) -> bool:
+        row = self.shared_state.connection().execute(
+            'SELECT 1 FROM stickiness_marks WHERE key = ? AND expires_at > ?', (key, time())
+        ).fetchone()
+        return row is not None
+
+
+def create_stickiness_store(storage_url: Optional[str],
+                            shared_state: Optional[SharedStateStore] = None) -> StickinessStore:
+    """Almacén en Redis (REPLICA_STICKY_STORAGE_URL), en el estado compartido de los workers o en memoria"""
+    if storage_url and storage_url.startswith(('redis://', 'rediss://')):
+        return RedisStickinessStore(storage_url)
+    if shared_state is not None:
+        return SQLiteStickinessStore(shared_state)
+    return InMemoryStickinessStore()
+
+
+class ReplicaReadRouter:
+    """Decide si cada lectura va a una réplica o al primario"""
+
+    def __init__(self, store: StickinessStore, sticky_seconds: float = 5.0):
+        self.store = store
+        self.sticky_seconds = sticky_seconds
+
+    def wrote(self, *keys: Optional[str]) -> None:
+        """Marca las claves escritas para leerlas del primario durante sticky_seconds"""
+        keys = [key for key in keys if key]
+        if keys:
+            self.store.mark(keys, self.sticky_seconds)
+
+    def read(self, key: Optional[str], call: Callable[[], T]) -> T:
+        if key is not None and self.store.is_marked(key):
+            repository_reads_total.inc(target='primary', reason='sticky')
+            return call()
+        try:
+            with use_replica():
+                result = call()
+        except OperationalError:
+            # Réplica caída o inalcanzable: se repite la lectura en el primario
+            db.session.rollback()
+            repository_reads_total.inc(target='primary', reason='fallback')
+            return call()
+        repository_reads_total.inc(target='replica', reason='default')
+        return result
+
+    def iterate(self, key: Optional[str], make_iterator: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """Recorrido perezoso en una réplica (o en el primario si la clave está marcada)"""
+        if key is not None and self.store.is_marked(key):
+            repository_reads_total.inc(target='primary', reason='sticky')
+            yield from make_iterator()
+            return
+        repository_reads_total.inc(target='replica', reason='default')
+        iterator = None
+        while True:
+            with use_replica():
+                if iterator is None:
+                    iterator = make_iterator()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+class ReplicaUserRepository(UserRepository):
+    def __init__(self, inner: UserRepository, router: ReplicaReadRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, user: User) -> User:
+        saved = self.inner.save(user)
+        self.router.wrote(user.id)
+        return saved
+
+    def save_all(self, users: List[User]) -> List[User]:
+        saved = self.inner.save_all(users)
+        self.router.wrote(*(user.id for user in users))
+        return saved
+
+    def get_by_id(self, user_id: str) -> Optional[User]:
+        return self.router.read(user_id, lambda: self.inner.get_by_id(user_id))
+
+    def get_all(self) -> List[User]:
+        return self.router.read(None, self.inner.get_all)
+
+    def get_history_version(self, user_id: str) -> Optional[Tuple[int, datetime]]:
+        # El ETag del historial debe cambiar en cuanto el paciente escribe
+        return self.router.read(user_id, lambda: self.inner.get_history_version(user_id))
+
+    def iter_all(self, batch_size: int) -> Iterator[User]:
+        # Recorrido de las reconstrucciones, que deben ver a todos los pacientes
+        return self.inner.iter_all(batch_size)
+
+
+class ReplicaBloodTestRepository(BloodTestRepository):
+    """Las lecturas por paciente van a réplicas; los recorridos de los trabajos masivos, al primario"""
+
+    def __init__(self, inner: BloodTestRepository, router: ReplicaReadRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, blood_test: BloodTest, risk: Optional[PatientRiskSnapshot] = None,
+             trends: Optional[List[AnalyteTrend]] = None) -> BloodTest:
+        saved = self.inner.save(blood_test, risk, trends)
+        self.router.wrote(blood_test.user_id, blood_test.id)
+        return saved
+
+    def save_all(self, blood_tests: List[BloodTest], risks: Optional[List[PatientRiskSnapshot]] = None,
+                 trends: Optional[List[AnalyteTrend]] = None) -> List[BloodTest]:
+        saved = self.inner.save_all(blood_tests, risks, trends)
+        self.router.wrote(*{key for blood_test in blood_tests for key in (blood_test.user_id, blood_test.id)})
+        return saved
+
+    def get_by_id(self, test_id: str) -> Optional[BloodTest]:
+        return self.router.read(test_id, lambda: self.inner.get_by_id(test_id))
+
+    def get_by_user_id(self, user_id: str) -> List[BloodTest]:
+        return self.router.read(user_id, lambda: self.inner.get_by_user_id(user_id))
+
+    def get_panel_by_user_id(self, user_id: str) -> BloodTestPanel:
+        return self.router.read(user_id, lambda: self.inner.get_panel_by_user_id(user_id))
+
+    def get_latest_by_user_id(self, user_id: str) -> Optional[BloodTest]:
+        return self.router.read(user_id, lambda: self.inner.get_latest_by_user_id(user_id))
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[BloodTest]:
+        return self.router.iterate(user_id, lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+    def iter_with_users_since(self, watermark: Optional[Tuple[datetime, str]],
+                              batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        # La exportación incremental avanza una marca de agua: en una réplica retrasada se saltaría filas
+        return self.inner.iter_with_users_since(watermark, batch_size)
+
+    def iter_latest_with_users(self, batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        # Alimenta la reconstrucción de los agregados de cohortes, que se escriben en el primario
+        return self.inner.iter_latest_with_users(batch_size)
+
+
+class ReplicaChatConversationRepository(ChatConversationRepository):
+    def __init__(self, inner: ChatConversationRepository, router: ReplicaReadRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, conversation: ChatConversation) -> ChatConversation:
+        saved = self.inner.save(conversation)
+        self.router.wrote(conversation.user_id, conversation.id)
+        return saved
+
+    def get_by_id(self, conversation_id: str) -> Optional[ChatConversation]:
+        return self.router.read(conversation_id, lambda: self.inner.get_by_id(conversation_id))
+
+    def get_by_user_id(self, user_id: str) -> List[ChatConversation]:
+        return self.router.read(user_id, lambda: self.inner.get_by_user_id(user_id))
+
+    def list_by_user_id(self, user_id: str) -> List[ConversationSummary]:
+        return self.router.read(user_id, lambda: self.inner.list_by_user_id(user_id))
+
+    def get_user_id(self, conversation_id: str) -> Optional[str]:
+        return self.router.read(conversation_id, lambda: self.inner.get_user_id(conversation_id))
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatConversation]:
+        return self.router.iterate(user_id, lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+    def repair_counters(self, batch_size: int) -> Tuple[int, int]:
+        return self.inner.repair_counters(batch_size)
+
+
+class ReplicaChatMessageRepository(ChatMessageRepository):
+    """
+    Un mensaje nuevo marca su conversación y también al paciente dueño (los contadores del
+    historial cambian); el dueño se consulta una vez en el primario y queda en caché
+    """
+
+    def __init__(self, inner: ChatMessageRepository, router: ReplicaReadRouter,
+                 conversation_repository: ChatConversationRepository, owner_cache_size: int = 10_000):
+        self.inner = inner
+        self.router = router
+        self._owner = lru_cache(maxsize=owner_cache_size)(conversation_repository.get_user_id)
+
+    def save(self, message: ChatMessage) -> ChatMessage:
+        saved = self.inner.save(message)
+        self.router.wrote(message.conversation_id, self._owner(message.conversation_id))
+        return saved
+
+    def get_by_conversation_id(self, conversation_id: str) -> List[ChatMessage]:
+        return self.router.read(conversation_id, lambda: self.inner.get_by_conversation_id(conversation_id))
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatMessage]:
+        return self.router.iterate(user_id, lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+
+class ReplicaAnalyteTrendRepository(AnalyteTrendRepository):
+    def __init__(self, inner: AnalyteTrendRepository, router: ReplicaReadRouter):
+        self.inner = inner
+        self.router = router
+
+    def get_by_user_id(self, user_id: str, for_update: bool = False) -> List[AnalyteTrend]:
+        if for_update:
+            return self.inner.get_by_user_id(user_id, for_update)
+        return self.router.read(user_id, lambda: self.inner.get_by_user_id(user_id))
+
+    def replace_for_user(self, user_id: str, trends: List[AnalyteTrend]) -> None:
+        self.inner.replace_for_user(user_id, trends)
+        self.router.wrote(user_id)
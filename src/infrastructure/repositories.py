@@ -1,6 +1,19 @@
 from abc import ABC, abstractmethod
-from typing import Optional, List
-from ..domain.entities import User, BloodTest, ChatConversation, ChatMessage
+from typing import Optional, List, Tuple, Iterator, Iterable, NamedTuple
+from datetime import datetime
+from ..domain.entities import User, BloodTest, BloodTestPanel, ChatConversation, ChatMessage
+from ..domain.value_objects import PatientRiskSnapshot, AnalyteTrend, MessageSearchResult, ConversationSummary
+
+# (banda de edad, género, dimensión, valor, pacientes)
+CohortAggregate = Tuple[str, str, str, str, int]
+
+class ArchiveBatchResult(NamedTuple):
+    """Resultado de archivar un lote de conversaciones inactivas"""
+    conversations: int
+    messages: int
+    raw_bytes: int
+    compressed_bytes: int
+    last_conversation_id: Optional[str]  # punto de partida del siguiente lote
 
 class UserRepository(ABC):
     """Repositorio abstracto para usuarios"""
@@ -9,6 +22,10 @@ class UserRepository(ABC):
     def save(self, user: User) -> User:
         pass
     
+    @abstractmethod
+    def save_all(self, users: List[User]) -> List[User]:
+        pass
+    
     @abstractmethod
     def get_by_id(self, user_id: str) -> Optional[User]:
         pass
@@ -16,12 +33,34 @@ class UserRepository(ABC):
     @abstractmethod
     def get_all(self) -> List[User]:
         pass
+    
+    @abstractmethod
+    def get_history_version(self, user_id: str) -> Optional[Tuple[int, datetime]]:
+        """Versión del historial y fecha de su último cambio, sin cargar el historial"""
+        pass
+    
+    @abstractmethod
+    def iter_all(self, batch_size: int) -> Iterator[User]:
+        """Recorre todos los usuarios por lotes, sin cargarlos a la vez en memoria"""
+        pass
 
 class BloodTestRepository(ABC):
     """Repositorio abstracto para exámenes de sangre"""
     
     @abstractmethod
-    def save(self, blood_test: BloodTest) -> BloodTest:
+    def save(self, blood_test: BloodTest, risk: Optional[PatientRiskSnapshot] = None,
+             trends: Optional[List[AnalyteTrend]] = None) -> BloodTest:
+        """
+        Guarda el examen y, en la misma transacción, las tendencias del paciente que actualiza y,
+        con risk, los agregados de riesgo por cohorte (el paciente deja de aportar con su examen
+        anterior si este es más reciente)
+        """
+        pass
+    
+    @abstractmethod
+    def save_all(self, blood_tests: List[BloodTest], risks: Optional[List[PatientRiskSnapshot]] = None,
+                 trends: Optional[List[AnalyteTrend]] = None) -> List[BloodTest]:
+        """Guarda los exámenes y, en la misma transacción, el riesgo y las tendencias de los pacientes"""
         pass
     
     @abstractmethod
@@ -32,9 +71,33 @@ class BloodTestRepository(ABC):
     def get_by_user_id(self, user_id: str) -> List[BloodTest]:
         pass
     
+    @abstractmethod
+    def get_panel_by_user_id(self, user_id: str) -> BloodTestPanel:
+        """Exámenes del usuario (más recientes primero) como lote columnar compacto"""
+        pass
+    
     @abstractmethod
     def get_latest_by_user_id(self, user_id: str) -> Optional[BloodTest]:
         pass
+    
+    @abstractmethod
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[BloodTest]:
+        """Recorre los exámenes del usuario por lotes con un cursor en el servidor"""
+        pass
+    
+    @abstractmethod
+    def iter_with_users_since(self, watermark: Optional[Tuple[datetime, str]],
+                              batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        """
+        Recorre por lotes los exámenes (con su usuario) creados después de la marca de
+        agua (created_at, id), en ese orden
+        """
+        pass
+    
+    @abstractmethod
+    def iter_latest_with_users(self, batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        """Recorre por lotes el examen más reciente de cada usuario, junto con el usuario"""
+        pass
 
 class ChatConversationRepository(ABC):
     """Repositorio abstracto para conversaciones de chat"""
@@ -50,6 +113,29 @@ class ChatConversationRepository(ABC):
     @abstractmethod
     def get_by_user_id(self, user_id: str) -> List[ChatConversation]:
         pass
+    
+    @abstractmethod
+    def list_by_user_id(self, user_id: str) -> List[ConversationSummary]:
+        """Conversaciones del usuario (más recientes primero) con sus contadores, sin mensajes"""
+        pass
+    
+    @abstractmethod
+    def get_user_id(self, conversation_id: str) -> Optional[str]:
+        """Dueño de la conversación, sin cargar sus mensajes"""
+        pass
+    
+    @abstractmethod
+    def repair_counters(self, batch_size: int) -> Tuple[int, int]:
+        """
+        Recalcula message_count, last_message_at y last_sender desde los mensajes (vigentes y
+        archivados); devuelve las conversaciones revisadas y las corregidas
+        """
+        pass
+    
+    @abstractmethod
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatConversation]:
+        """Recorre las conversaciones del usuario por lotes, sin sus mensajes"""
+        pass
 
 class ChatMessageRepository(ABC):
     """Repositorio abstracto para mensajes de chat"""
@@ -61,3 +147,106 @@ class ChatMessageRepository(ABC):
     @abstractmethod
     def get_by_conversation_id(self, conversation_id: str) -> List[ChatMessage]:
         pass
+    
+    @abstractmethod
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatMessage]:
+        """Recorre los mensajes de todas las conversaciones del usuario por lotes"""
+        pass
+
+class MessageSearchRepository(ABC):
+    """Repositorio abstracto del índice de búsqueda de texto de los mensajes"""
+    
+    backend: str
+    
+    @abstractmethod
+    def index(self, messages: List[ChatMessage]) -> None:
+        """Agrega los mensajes al índice dentro de la transacción en curso"""
+        pass
+    
+    @abstractmethod
+    def search(self, query: str, limit: int, offset: int,
+               user_id: Optional[str] = None) -> Tuple[int, List[MessageSearchResult]]:
+        """Total de coincidencias y la página pedida, de la más relevante a la menos"""
+        pass
+    
+    @abstractmethod
+    def remove(self, message_ids: List[str]) -> None:
+        """Quita los mensajes del índice dentro de la transacción en curso, antes de borrarlos"""
+        pass
+    
+    @abstractmethod
+    def rebuild(self) -> int:
+        """Reconstruye el índice con todos los mensajes; devuelve los mensajes indexados"""
+        pass
+
+class ConversationArchiveRepository(ABC):
+    """Repositorio abstracto del archivo comprimido de conversaciones inactivas"""
+    
+    @abstractmethod
+    def archive_batch(self, idle_before: datetime, batch_size: int,
+                      after_conversation_id: Optional[str] = None) -> ArchiveBatchResult:
+        """
+        Archiva, en una transacción corta, hasta batch_size conversaciones cuyo último mensaje
+        es anterior a idle_before, recorriéndolas por id a partir de after_conversation_id
+        """
+        pass
+    
+    @abstractmethod
+    def stats(self) -> dict:
+        """Conversaciones y mensajes archivados, y bytes antes y después de comprimir"""
+        pass
+
+class RetentionRepository(ABC):
+    """
+    Repositorio abstracto de la depuración por retención: borrados por lotes de ids, sin
+    cargar entidades, que mantienen consistentes el índice de búsqueda, los contadores de
+    las conversaciones y los agregados de cohortes. Cada llamada es una transacción.
+    """
+    
+    @abstractmethod
+    def purge_archives_before(self, cutoff: datetime, limit: int) -> int:
+        """Borra hasta limit archivos de conversación cuyo último mensaje es anterior al corte"""
+        pass
+    
+    @abstractmethod
+    def purge_messages_before(self, cutoff: datetime, limit: int) -> int:
+        """Borra hasta limit mensajes anteriores al corte; devuelve los borrados"""
+        pass
+    
+    @abstractmethod
+    def find_inactive_users(self, inactive_since: datetime, limit: int) -> List[str]:
+        """Usuarios sin actividad (exámenes, conversaciones ni mensajes) desde la fecha"""
+        pass
+    
+    @abstractmethod
+    def purge_user(self, user_id: str, limit: int) -> Tuple[int, bool]:
+        """
+        Borra hasta limit filas de los datos del usuario, de las tablas dependientes hacia el
+        usuario; devuelve las filas borradas y si el usuario quedó eliminado
+        """
+        pass
+
+class CohortRiskRepository(ABC):
+    """Repositorio abstracto de los agregados materializados de riesgo por cohorte"""
+    
+    @abstractmethod
+    def replace_all(self, snapshots: Iterable[PatientRiskSnapshot]) -> int:
+        """Reconstruye los agregados desde cero; devuelve los pacientes incluidos"""
+        pass
+    
+    @abstractmethod
+    def get_aggregates(self) -> List[CohortAggregate]:
+        pass
+
+class AnalyteTrendRepository(ABC):
+    """Repositorio abstracto de las tendencias por usuario y analito"""
+    
+    @abstractmethod
+    def get_by_user_id(self, user_id: str, for_update: bool = False) -> List[AnalyteTrend]:
+        """Tendencias del usuario; con for_update se bloquean hasta guardar los cambios"""
+        pass
+    
+    @abstractmethod
+    def replace_for_user(self, user_id: str, trends: List[AnalyteTrend]) -> None:
+        """Reemplaza todas las tendencias del usuario (reconstrucción)"""
+        pass
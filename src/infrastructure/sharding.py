@@ -0,0 +1,384 @@
+"""
+Particionado horizontal (sharding) de los datos de pacientes por user_id.
+
+Cada shard es una base completa con el mismo esquema: el shard 0 es DATABASE_URL y los demás
+vienen de SHARD_DATABASE_URLS. Un usuario vive en el shard routing_tag(user_id) % N, y con él
+sus exámenes, conversaciones, mensajes, tendencias y su aporte a los agregados de cohortes;
+los ids de esos datos llevan la misma etiqueta, así que basta el id de una conversación para
+saber su shard.
+
+Los repositorios Sharded* envuelven a los de SQLAlchemy: activan el shard de cada llamada
+(use_shard, que la sesión usa para elegir el motor) o recorren todos los shards y combinan
+los resultados (scatter-gather) en las operaciones globales y de administración.
+"""
+import heapq
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from .database import db, use_shard, shard_bind_key, prepare_schema
+from .repositories import (
+    UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository,
+    MessageSearchRepository, CohortRiskRepository, CohortAggregate, AnalyteTrendRepository,
+    ConversationArchiveRepository, ArchiveBatchResult, RetentionRepository
+)
+from ..domain.entities import User, BloodTest, BloodTestPanel, ChatConversation, ChatMessage
+from ..domain.identifiers import routing_tag, id_routing_tag
+from ..domain.value_objects import PatientRiskSnapshot, AnalyteTrend, MessageSearchResult, ConversationSummary
+
+T = TypeVar('T')
+
+
+class ShardRouter:
+    """Decide el shard de cada usuario o dato y ejecuta código en uno o en todos los shards"""
+
+    def __init__(self, shard_count: int):
+        if shard_count < 1:
+            raise ValueError("Debe haber al menos un shard")
+        self.shard_count = shard_count
+
+    def shard_for_user(self, user_id: str) -> int:
+        return routing_tag(user_id) % self.shard_count
+
+    def shard_for_id(self, entity_id: str) -> int:
+        """Shard de un examen, conversación o mensaje según la etiqueta de su id"""
+        tag = id_routing_tag(entity_id)
+        return 0 if tag is None else tag % self.shard_count
+
+    def for_user(self, user_id: str):
+        return use_shard(self.shard_for_user(user_id))
+
+    def for_id(self, entity_id: str):
+        return use_shard(self.shard_for_id(entity_id))
+
+    def shards(self) -> range:
+        return range(self.shard_count)
+
+    def gather(self, call: Callable[[], T]) -> List[T]:
+        """Ejecuta call en cada shard y devuelve los resultados en orden de shard"""
+        results = []
+        for shard in self.shards():
+            with use_shard(shard):
+                results.append(call())
+        return results
+
+    def group(self, items: Iterable[T], shard_of: Callable[[T], int]) -> Dict[int, List[T]]:
+        groups = defaultdict(list)
+        for item in items:
+            groups[shard_of(item)].append(item)
+        return groups
+
+    def iterate(self, shard: int, make_iterator: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """
+        Recorre un iterador perezoso del repositorio con su shard activo en cada paso: la
+        consulta se ejecuta al pedir elementos, no al crear el generador
+        """
+        iterator = None
+        while True:
+            with use_shard(shard):
+                if iterator is None:
+                    iterator = make_iterator()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def chain(self, make_iterator: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """Recorre el iterador en cada shard, uno tras otro"""
+        for shard in self.shards():
+            yield from self.iterate(shard, make_iterator)
+
+
+def prepare_shards(router: ShardRouter, use_cache: bool = False) -> str:
+    """Crea o actualiza el esquema en cada shard y devuelve el motor de búsqueda (común a todos)"""
+    backends = set()
+    for shard in router.shards():
+        backends.add(prepare_schema(db.engines[shard_bind_key(shard)], use_cache))
+    if len(backends) > 1:
+        raise RuntimeError(f"Los shards deben usar el mismo tipo de base de datos (motores de búsqueda: {backends})")
+    return backends.pop()
+
+
+class ShardedUserRepository(UserRepository):
+    def __init__(self, inner: UserRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, user: User) -> User:
+        with self.router.for_user(user.id):
+            return self.inner.save(user)
+
+    def save_all(self, users: List[User]) -> List[User]:
+        for shard, group in self.router.group(users, lambda user: self.router.shard_for_user(user.id)).items():
+            with use_shard(shard):
+                self.inner.save_all(group)
+        return users
+
+    def get_by_id(self, user_id: str) -> Optional[User]:
+        with self.router.for_user(user_id):
+            return self.inner.get_by_id(user_id)
+
+    def get_all(self) -> List[User]:
+        return [user for users in self.router.gather(self.inner.get_all) for user in users]
+
+    def get_history_version(self, user_id: str) -> Optional[Tuple[int, datetime]]:
+        with self.router.for_user(user_id):
+            return self.inner.get_history_version(user_id)
+
+    def iter_all(self, batch_size: int) -> Iterator[User]:
+        return self.router.chain(lambda: self.inner.iter_all(batch_size))
+
+
+class ShardedBloodTestRepository(BloodTestRepository):
+    def __init__(self, inner: BloodTestRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, blood_test: BloodTest, risk: Optional[PatientRiskSnapshot] = None,
+             trends: Optional[List[AnalyteTrend]] = None) -> BloodTest:
+        with self.router.for_user(blood_test.user_id):
+            return self.inner.save(blood_test, risk, trends)
+
+    def save_all(self, blood_tests: List[BloodTest], risks: Optional[List[PatientRiskSnapshot]] = None,
+                 trends: Optional[List[AnalyteTrend]] = None) -> List[BloodTest]:
+        # Los agregados de cohortes y las tendencias de cada paciente viven en su shard, junto a sus exámenes
+        groups = self.router.group(blood_tests, lambda blood_test: self.router.shard_for_user(blood_test.user_id))
+        risk_groups = self.router.group(risks or [], lambda risk: self.router.shard_for_user(risk.user_id))
+        trend_groups = self.router.group(trends or [], lambda trend: self.router.shard_for_user(trend.user_id))
+        for shard, group in groups.items():
+            with use_shard(shard):
+                self.inner.save_all(group, risk_groups.get(shard), trend_groups.get(shard))
+        return blood_tests
+
+    def get_by_id(self, test_id: str) -> Optional[BloodTest]:
+        with self.router.for_id(test_id):
+            return self.inner.get_by_id(test_id)
+
+    def get_by_user_id(self, user_id: str) -> List[BloodTest]:
+        with self.router.for_user(user_id):
+            return self.inner.get_by_user_id(user_id)
+
+    def get_panel_by_user_id(self, user_id: str) -> BloodTestPanel:
+        with self.router.for_user(user_id):
+            return self.inner.get_panel_by_user_id(user_id)
+
+    def get_latest_by_user_id(self, user_id: str) -> Optional[BloodTest]:
+        with self.router.for_user(user_id):
+            return self.inner.get_latest_by_user_id(user_id)
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[BloodTest]:
+        return self.router.iterate(self.router.shard_for_user(user_id),
+                                   lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+    def iter_with_users_since(self, watermark: Optional[Tuple[datetime, str]],
+                              batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        # Mezcla ordenada por (created_at, id) de todos los shards: la marca de agua sigue siendo válida
+        streams = [
+            self.router.iterate(shard, lambda: self.inner.iter_with_users_since(watermark, batch_size))
+            for shard in self.router.shards()
+        ]
+        return heapq.merge(*streams, key=lambda pair: (pair[0].created_at, pair[0].id))
+
+    def iter_latest_with_users(self, batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        return self.router.chain(lambda: self.inner.iter_latest_with_users(batch_size))
+
+
+class ShardedChatConversationRepository(ChatConversationRepository):
+    def __init__(self, inner: ChatConversationRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, conversation: ChatConversation) -> ChatConversation:
+        with self.router.for_user(conversation.user_id):
+            return self.inner.save(conversation)
+
+    def get_by_id(self, conversation_id: str) -> Optional[ChatConversation]:
+        with self.router.for_id(conversation_id):
+            return self.inner.get_by_id(conversation_id)
+
+    def get_by_user_id(self, user_id: str) -> List[ChatConversation]:
+        with self.router.for_user(user_id):
+            return self.inner.get_by_user_id(user_id)
+
+    def list_by_user_id(self, user_id: str) -> List[ConversationSummary]:
+        with self.router.for_user(user_id):
+            return self.inner.list_by_user_id(user_id)
+
+    def get_user_id(self, conversation_id: str) -> Optional[str]:
+        with self.router.for_id(conversation_id):
+            return self.inner.get_user_id(conversation_id)
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatConversation]:
+        return self.router.iterate(self.router.shard_for_user(user_id),
+                                   lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+    def repair_counters(self, batch_size: int) -> Tuple[int, int]:
+        results = self.router.gather(lambda: self.inner.repair_counters(batch_size))
+        return sum(checked for checked, _ in results), sum(corrected for _, corrected in results)
+
+
+class ShardedChatMessageRepository(ChatMessageRepository):
+    def __init__(self, inner: ChatMessageRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def save(self, message: ChatMessage) -> ChatMessage:
+        with self.router.for_id(message.conversation_id):
+            return self.inner.save(message)
+
+    def get_by_conversation_id(self, conversation_id: str) -> List[ChatMessage]:
+        with self.router.for_id(conversation_id):
+            return self.inner.get_by_conversation_id(conversation_id)
+
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatMessage]:
+        return self.router.iterate(self.router.shard_for_user(user_id),
+                                   lambda: self.inner.iter_by_user_id(user_id, batch_size))
+
+
+class ShardedMessageSearchRepository(MessageSearchRepository):
+    """Cada shard indexa sus mensajes; la búsqueda global combina los mejores de cada shard"""
+
+    def __init__(self, inner: MessageSearchRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+        self.backend = inner.backend
+
+    def index(self, messages: List[ChatMessage]) -> None:
+        for shard, group in self.router.group(messages, lambda message: self.router.shard_for_id(message.id)).items():
+            with use_shard(shard):
+                self.inner.index(group)
+
+    def remove(self, message_ids: List[str]) -> None:
+        for shard, group in self.router.group(message_ids, self.router.shard_for_id).items():
+            with use_shard(shard):
+                self.inner.remove(group)
+
+    def search(self, query: str, limit: int, offset: int,
+               user_id: Optional[str] = None) -> Tuple[int, List[MessageSearchResult]]:
+        if user_id is not None:
+            with self.router.for_user(user_id):
+                return self.inner.search(query, limit, offset, user_id)
+        # Cada shard aporta sus offset + limit mejores; la página sale de la mezcla ordenada
+        pages = self.router.gather(lambda: self.inner.search(query, offset + limit, 0))
+        total = sum(shard_total for shard_total, _ in pages)
+        merged = heapq.merge(*[results for _, results in pages],
+                             key=lambda result: (-result.score, -result.timestamp.timestamp()))
+        return total, list(merged)[offset:offset + limit]
+
+    def rebuild(self) -> int:
+        return sum(self.router.gather(self.inner.rebuild))
+
+
+class ShardedCohortRiskRepository(CohortRiskRepository):
+    """Cada shard mantiene los agregados de sus pacientes; la consulta los suma"""
+
+    def __init__(self, inner: CohortRiskRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def replace_all(self, snapshots: Iterable[PatientRiskSnapshot]) -> int:
+        # Los pacientes llegan agrupados por shard (los recorridos encadenan los shards); cada
+        # tramo reemplaza los agregados de su shard, y los shards sin pacientes quedan vacíos
+        patients = 0
+        pending = set(self.router.shards())
+        for shard, group in groupby(snapshots, lambda snapshot: self.router.shard_for_user(snapshot.user_id)):
+            if shard not in pending:
+                raise RuntimeError("Los pacientes de la reconstrucción deben llegar agrupados por shard")
+            pending.discard(shard)
+            with use_shard(shard):
+                patients += self.inner.replace_all(group)
+        for shard in pending:
+            with use_shard(shard):
+                self.inner.replace_all([])
+        return patients
+
+    def get_aggregates(self) -> List[CohortAggregate]:
+        totals = Counter()
+        for aggregates in self.router.gather(self.inner.get_aggregates):
+            for age_band, gender, dimension, value, patient_count in aggregates:
+                totals[(age_band, gender, dimension, value)] += patient_count
+        return [(*key, patient_count) for key, patient_count in totals.items()]
+
+
+class ShardedAnalyteTrendRepository(AnalyteTrendRepository):
+    def __init__(self, inner: AnalyteTrendRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def get_by_user_id(self, user_id: str, for_update: bool = False) -> List[AnalyteTrend]:
+        with self.router.for_user(user_id):
+            return self.inner.get_by_user_id(user_id, for_update)
+
+    def replace_for_user(self, user_id: str, trends: List[AnalyteTrend]) -> None:
+        with self.router.for_user(user_id):
+            self.inner.replace_for_user(user_id, trends)
+
+
+class ShardedConversationArchiveRepository(ConversationArchiveRepository):
+    """Archiva shard por shard; el id de la última conversación indica en qué shard seguir"""
+
+    def __init__(self, inner: ConversationArchiveRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def archive_batch(self, idle_before: datetime, batch_size: int,
+                      after_conversation_id: Optional[str] = None) -> ArchiveBatchResult:
+        shard = 0 if after_conversation_id is None else self.router.shard_for_id(after_conversation_id)
+        while shard < self.router.shard_count:
+            with use_shard(shard):
+                result = self.inner.archive_batch(idle_before, batch_size, after_conversation_id)
+            if result.last_conversation_id is not None:
+                return result
+            shard += 1
+            after_conversation_id = None
+        return ArchiveBatchResult(0, 0, 0, 0, None)
+
+    def stats(self) -> dict:
+        totals = Counter()
+        for stats in self.router.gather(self.inner.stats):
+            totals.update({key: value for key, value in stats.items() if key != 'compression_ratio'})
+        compressed = totals['compressed_bytes']
+        return {
+            'conversations': totals['conversations'],
+            'messages': totals['messages'],
+            'raw_bytes': totals['raw_bytes'],
+            'compressed_bytes': compressed,
+            'compression_ratio': round(totals['raw_bytes'] / compressed, 2) if compressed else None
+        }
+
+
+class ShardedRetentionRepository(RetentionRepository):
+    """Depura shard por shard: cada lote sale del primer shard que aún tiene datos vencidos"""
+
+    def __init__(self, inner: RetentionRepository, router: ShardRouter):
+        self.inner = inner
+        self.router = router
+
+    def purge_archives_before(self, cutoff: datetime, limit: int) -> int:
+        return self._first_shard_with_rows(lambda: self.inner.purge_archives_before(cutoff, limit))
+
+    def purge_messages_before(self, cutoff: datetime, limit: int) -> int:
+        return self._first_shard_with_rows(lambda: self.inner.purge_messages_before(cutoff, limit))
+
+    def find_inactive_users(self, inactive_since: datetime, limit: int) -> List[str]:
+        user_ids = []
+        for shard in self.router.shards():
+            with use_shard(shard):
+                user_ids.extend(self.inner.find_inactive_users(inactive_since, limit - len(user_ids)))
+            if len(user_ids) >= limit:
+                break
+        return user_ids
+
+    def purge_user(self, user_id: str, limit: int) -> Tuple[int, bool]:
+        with self.router.for_user(user_id):
+            return self.inner.purge_user(user_id, limit)
+
+    def _first_shard_with_rows(self, purge: Callable[[], int]) -> int:
+        for shard in self.router.shards():
+            with use_shard(shard):
+                deleted = purge()
+            if deleted:
+                return deleted
+        return 0
@@ -0,0 +1,67 @@
+"""
+Estado compartido entre los workers de un mismo servidor (flask --app app serve) en un archivo
+SQLite local: contadores de los límites de tasa, peticiones al LLM en curso y marcas de lectura
+del primario. Sin él cada worker llevaría sus propios límites y el total permitido se
+multiplicaría por el número de workers.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS rate_limit_counters ('
+    ' key TEXT PRIMARY KEY, window_index INTEGER NOT NULL, current INTEGER NOT NULL, previous INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS admission_slots (pid INTEGER PRIMARY KEY, in_flight INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS stickiness_marks (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)',
+)
+
+
+class SharedStateStore:
+    """
+    Archivo SQLite en modo WAL. Cada hilo de cada proceso abre su propia conexión: una conexión
+    heredada por fork no se puede usar en el proceso hijo.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.transaction() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Transacción con bloqueo de escritura desde el inicio (lectura y escritura atómicas)"""
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def forget_process(self, pid: int) -> None:
+        """Libera los cupos del LLM que tenía un worker que terminó (incluso si murió a mitad de una petición)"""
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM admission_slots WHERE pid = ?', (pid,))
+
+    def reset_admission(self) -> None:
+        """Descarta los cupos que quedaron de una ejecución anterior del servidor"""
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM admission_slots')
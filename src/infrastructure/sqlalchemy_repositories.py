@@ -1,24 +1,153 @@
-from typing import Optional, List
-from datetime import datetime
-from .repositories import UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository
-from .database import db, UserModel, BloodTestModel, ChatConversationModel, ChatMessageModel
-from ..domain.entities import User, BloodTest, ChatConversation, ChatMessage
+import json
+from collections import Counter, defaultdict
+from typing import Optional, List, Dict, Tuple, Iterator, Iterable
+from datetime import datetime, timezone
+from sqlalchemy import select, update, delete, insert, and_, or_, case, func, literal_column, text
+from .repositories import (
+    UserRepository, BloodTestRepository, ChatConversationRepository, ChatMessageRepository,
+    CohortRiskRepository, CohortAggregate, AnalyteTrendRepository, MessageSearchRepository,
+    ConversationArchiveRepository, ArchiveBatchResult, RetentionRepository
+)
+from .database import (
+    db, UserModel, BloodTestModel, ChatConversationModel, ChatMessageModel,
+    UserLatestRiskModel, CohortRiskAggregateModel, AnalyteTrendModel, ChatConversationArchiveModel,
+    MESSAGE_SEARCH_TABLE, SEARCH_BACKENDS
+)
+from .conversation_archive import encode_messages, decode_messages
+from .metrics import instrument_repository
+from .text_search import (
+    HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_ELLIPSIS, SNIPPET_TOKENS,
+    parse_terms, fts5_expression, mysql_boolean_expression, like_pattern, make_snippet
+)
+from ..domain.entities import User, BloodTest, BloodTestPanel, ChatConversation, ChatMessage
+from ..domain.value_objects import PatientRiskSnapshot, AnalyteTrend, MessageSearchResult, ConversationSummary
 
+def _bump_history_version(user_id) -> None:
+    """Invalida el ETag del historial del usuario y registra su actividad, dentro de la transacción en curso"""
+    now = datetime.utcnow()
+    db.session.execute(
+        update(UserModel)
+        .where(UserModel.id == user_id)
+        .values(history_version=UserModel.history_version + 1, history_modified_at=now, history_updated_at=now)
+    )
+
+def _invalidate_history(user_ids) -> None:
+    """
+    Invalida el ETag y el Last-Modified del historial de los usuarios sin tocar history_updated_at:
+    las correcciones, reconstrucciones y depuraciones no son actividad del usuario ni reinician
+    su plazo de inactividad
+    """
+    db.session.execute(
+        update(UserModel)
+        .where(UserModel.id.in_(user_ids))
+        .values(history_version=UserModel.history_version + 1, history_modified_at=datetime.utcnow())
+    )
+
+def _bump_owners_history_version(conversation_ids: List[str]) -> None:
+    """_invalidate_history de los dueños de las conversaciones"""
+    _invalidate_history(select(ChatConversationModel.user_id).where(ChatConversationModel.id.in_(conversation_ids)))
+
+def _save_trends(trends: Iterable[AnalyteTrend]) -> None:
+    """Guarda las tendencias dentro de la transacción en curso"""
+    for trend in trends:
+        db.session.merge(_trend_to_model(trend))
+
+def _conversation_owner(conversation_id: str):
+    return select(ChatConversationModel.user_id).where(ChatConversationModel.id == conversation_id).scalar_subquery()
+
+def _count_message(message: ChatMessage) -> None:
+    """Suma el mensaje a los contadores de su conversación dentro de la transacción en curso"""
+    conversation = ChatConversationModel
+    # Un UPDATE atómico (sin leer antes): los mensajes simultáneos no se pisan. La última
+    # actividad solo avanza, aunque el mensaje llegue con una fecha anterior
+    newer = or_(conversation.last_message_at.is_(None), conversation.last_message_at <= message.timestamp)
+    db.session.execute(
+        update(conversation)
+        .where(conversation.id == message.conversation_id)
+        .values(
+            message_count=conversation.message_count + 1,
+            last_message_at=case((newer, message.timestamp), else_=conversation.last_message_at),
+            last_sender=case((newer, message.sender), else_=conversation.last_sender)
+        )
+    )
+
+def _user_to_entity(model: UserModel) -> User:
+    return User(
+        id=model.id,
+        name=model.name,
+        age=model.age,
+        gender=model.gender,
+        created_at=model.created_at
+    )
+
+# Columnas de chat_messages en el orden de los campos de ChatMessage
+_MESSAGE_ROW_COLUMNS = (
+    ChatMessageModel.id, ChatMessageModel.conversation_id, ChatMessageModel.content,
+    ChatMessageModel.sender, ChatMessageModel.timestamp
+)
+
+# Conversaciones por página al recorrer los mensajes de un usuario (con todos sus mensajes)
+_CONVERSATIONS_PER_PAGE = 50
+
+def _message_to_entity(model: ChatMessageModel) -> ChatMessage:
+    return ChatMessage(
+        id=model.id,
+        conversation_id=model.conversation_id,
+        content=model.content,
+        sender=model.sender,
+        timestamp=model.timestamp
+    )
+
+def _archived_messages(*conditions) -> Dict[str, List[ChatMessage]]:
+    """Mensajes archivados (descomprimidos) de las conversaciones que cumplen las condiciones"""
+    archive = ChatConversationArchiveModel
+    rows = db.session.execute(
+        select(archive.conversation_id, archive.codec, archive.payload)
+        .join(ChatConversationModel, ChatConversationModel.id == archive.conversation_id)
+        .where(*conditions)
+    )
+    return {
+        conversation_id: decode_messages(conversation_id, codec, payload)
+        for conversation_id, codec, payload in rows
+    }
+
+def _merge_messages(archived: List[ChatMessage], hot: List[ChatMessage]) -> List[ChatMessage]:
+    """Mensajes archivados y vigentes de una conversación, en orden cronológico"""
+    if not archived:
+        return hot
+    if not hot:
+        return archived
+    # Casi siempre el archivo es anterior a lo vigente: el ordenamiento estable recorre dos tramos ya ordenados
+    return sorted(archived + hot, key=lambda message: message.timestamp or datetime.min)
+
+# Columnas de blood_tests en el orden de BloodTestPanel.ROW_FIELDS (y de los campos de BloodTest):
+# consultar filas en vez de modelos evita el mapa de identidad del ORM en lecturas masivas
+_BLOOD_TEST_ROW_COLUMNS = tuple(getattr(BloodTestModel, name) for name in BloodTestPanel.ROW_FIELDS)
+
+def _blood_test_from_row(row) -> BloodTest:
+    return BloodTest(*row)
+
+def _stream(statement, batch_size: int):
+    """
+    Ejecuta la consulta con un cursor en el servidor (yield_per activa stream_results):
+    las filas llegan por lotes y la memoria no crece con el tamaño del resultado
+    """
+    return db.session.scalars(statement.execution_options(yield_per=batch_size))
+
+@instrument_repository
 class SQLAlchemyUserRepository(UserRepository):
     """Implementación SQLAlchemy del repositorio de usuarios"""
     
     def save(self, user: User) -> User:
-        user_model = UserModel(
-            id=user.id,
-            name=user.name,
-            age=user.age,
-            gender=user.gender,
-            created_at=user.created_at
-        )
-        db.session.add(user_model)
+        db.session.add(self._entity_to_model(user))
         db.session.commit()
         return user
     
+    def save_all(self, users: List[User]) -> List[User]:
+        db.session.add_all([self._entity_to_model(user) for user in users])
+        db.session.commit()
+        return users
+    
     def get_by_id(self, user_id: str) -> Optional[User]:
         user_model = UserModel.query.filter_by(id=user_id).first()
         if user_model:
@@ -42,12 +171,150 @@ class SQLAlchemyUserRepository(UserRepository):
                 created_at=user_model.created_at
             ) for user_model in user_models
         ]
+    
+    def get_history_version(self, user_id: str) -> Optional[Tuple[int, datetime]]:
+        row = db.session.execute(
+            select(UserModel.history_version, UserModel.history_modified_at, UserModel.history_updated_at,
+                   UserModel.created_at)
+            .where(UserModel.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        if row.history_modified_at or row.history_updated_at:
+            return row.history_version, row.history_modified_at or row.history_updated_at
+        # Usuarios sin cambios desde que se agregaron las columnas: su alta, guardada en hora
+        # local antes de que las entidades usaran UTC, pasada a UTC como el resto del Last-Modified
+        return row.history_version, row.created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    def iter_all(self, batch_size: int) -> Iterator[User]:
+        # Paginación por clave en lugar de un cursor abierto: entre lote y lote quien
+        # consume puede recorrer con cursores en el servidor los datos de cada usuario
+        # (MySQL no admite otra consulta mientras un cursor sin búfer sigue abierto)
+        last_id = None
+        while True:
+            statement = select(UserModel).order_by(UserModel.id).limit(batch_size)
+            if last_id is not None:
+                statement = statement.where(UserModel.id > last_id)
+            user_models = db.session.scalars(statement).all()
+            for user_model in user_models:
+                yield _user_to_entity(user_model)
+            if len(user_models) < batch_size:
+                return
+            last_id = user_models[-1].id
+    
+    def _entity_to_model(self, user: User) -> UserModel:
+        return UserModel(
+            id=user.id,
+            name=user.name,
+            age=user.age,
+            gender=user.gender,
+            created_at=user.created_at,
+            # Last-Modified del historial desde el alta, en UTC
+            history_modified_at=datetime.utcnow()
+        )
 
+@instrument_repository
 class SQLAlchemyBloodTestRepository(BloodTestRepository):
     """Implementación SQLAlchemy del repositorio de exámenes de sangre"""
     
-    def save(self, blood_test: BloodTest) -> BloodTest:
-        blood_test_model = BloodTestModel(
+    def save(self, blood_test: BloodTest, risk: Optional[PatientRiskSnapshot] = None,
+             trends: Optional[List[AnalyteTrend]] = None) -> BloodTest:
+        try:
+            db.session.add(self._entity_to_model(blood_test))
+            _bump_history_version(blood_test.user_id)
+            _save_trends(trends or ())
+            if risk is not None:
+                _apply_risk_snapshot(risk)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return blood_test
+    
+    def save_all(self, blood_tests: List[BloodTest], risks: Optional[List[PatientRiskSnapshot]] = None,
+                 trends: Optional[List[AnalyteTrend]] = None) -> List[BloodTest]:
+        try:
+            db.session.add_all([self._entity_to_model(blood_test) for blood_test in blood_tests])
+            for user_id in {blood_test.user_id for blood_test in blood_tests}:
+                _bump_history_version(user_id)
+            _save_trends(trends or ())
+            for risk in risks or ():
+                _apply_risk_snapshot(risk)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return blood_tests
+    
+    def get_by_id(self, test_id: str) -> Optional[BloodTest]:
+        test_model = BloodTestModel.query.filter_by(id=test_id).first()
+        if test_model:
+            return self._model_to_entity(test_model)
+        return None
+    
+    def get_by_user_id(self, user_id: str) -> List[BloodTest]:
+        rows = db.session.execute(self._user_rows_statement(user_id))
+        return [_blood_test_from_row(row) for row in rows]
+    
+    def get_panel_by_user_id(self, user_id: str) -> BloodTestPanel:
+        return BloodTestPanel.from_rows(db.session.execute(self._user_rows_statement(user_id)))
+    
+    def get_latest_by_user_id(self, user_id: str) -> Optional[BloodTest]:
+        test_model = BloodTestModel.query.filter_by(user_id=user_id).order_by(BloodTestModel.test_date.desc()).first()
+        if test_model:
+            return self._model_to_entity(test_model)
+        return None
+    
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[BloodTest]:
+        statement = select(BloodTestModel).where(BloodTestModel.user_id == user_id).order_by(BloodTestModel.test_date)
+        for test_model in _stream(statement, batch_size):
+            yield self._model_to_entity(test_model)
+    
+    def iter_with_users_since(self, watermark: Optional[Tuple[datetime, str]],
+                              batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        statement = (
+            select(BloodTestModel, UserModel)
+            .join(UserModel, UserModel.id == BloodTestModel.user_id)
+            .order_by(BloodTestModel.created_at, BloodTestModel.id)
+        )
+        if watermark is not None:
+            created_at, test_id = watermark
+            statement = statement.where(or_(
+                BloodTestModel.created_at > created_at,
+                and_(BloodTestModel.created_at == created_at, BloodTestModel.id > test_id)
+            ))
+        for test_model, user_model in db.session.execute(statement.execution_options(yield_per=batch_size)):
+            yield self._model_to_entity(test_model), _user_to_entity(user_model)
+    
+    def iter_latest_with_users(self, batch_size: int) -> Iterator[Tuple[BloodTest, User]]:
+        # Lotes de usuarios paginados por clave (sin cursor abierto, quien consume puede
+        # escribir entre lotes); en cada lote el primer examen de cada usuario es el último
+        last_user_id = None
+        while True:
+            users = select(UserModel.id).order_by(UserModel.id).limit(batch_size)
+            if last_user_id is not None:
+                users = users.where(UserModel.id > last_user_id)
+            user_ids = db.session.scalars(users).all()
+            if not user_ids:
+                return
+            rows = db.session.execute(
+                select(BloodTestModel, UserModel)
+                .join(UserModel, UserModel.id == BloodTestModel.user_id)
+                .where(BloodTestModel.user_id.in_(user_ids))
+                .order_by(BloodTestModel.user_id, BloodTestModel.test_date.desc(), BloodTestModel.id.desc())
+            ).all()
+            current_user_id = None
+            for test_model, user_model in rows:
+                if test_model.user_id == current_user_id:
+                    continue
+                current_user_id = test_model.user_id
+                yield self._model_to_entity(test_model), _user_to_entity(user_model)
+            if len(user_ids) < batch_size:
+                return
+            last_user_id = user_ids[-1]
+    
+    def _entity_to_model(self, blood_test: BloodTest) -> BloodTestModel:
+        return BloodTestModel(
             id=blood_test.id,
             user_id=blood_test.user_id,
             glucose=blood_test.glucose,
@@ -65,25 +332,13 @@ class SQLAlchemyBloodTestRepository(BloodTestRepository):
             test_date=blood_test.test_date,
             created_at=blood_test.created_at
         )
-        db.session.add(blood_test_model)
-        db.session.commit()
-        return blood_test
-    
-    def get_by_id(self, test_id: str) -> Optional[BloodTest]:
-        test_model = BloodTestModel.query.filter_by(id=test_id).first()
-        if test_model:
-            return self._model_to_entity(test_model)
-        return None
-    
-    def get_by_user_id(self, user_id: str) -> List[BloodTest]:
-        test_models = BloodTestModel.query.filter_by(user_id=user_id).order_by(BloodTestModel.test_date.desc()).all()
-        return [self._model_to_entity(model) for model in test_models]
     
-    def get_latest_by_user_id(self, user_id: str) -> Optional[BloodTest]:
-        test_model = BloodTestModel.query.filter_by(user_id=user_id).order_by(BloodTestModel.test_date.desc()).first()
-        if test_model:
-            return self._model_to_entity(test_model)
-        return None
+    def _user_rows_statement(self, user_id: str):
+        return (
+            select(*_BLOOD_TEST_ROW_COLUMNS)
+            .where(BloodTestModel.user_id == user_id)
+            .order_by(BloodTestModel.test_date.desc())
+        )
     
     def _model_to_entity(self, model: BloodTestModel) -> BloodTest:
         return BloodTest(
@@ -105,6 +360,7 @@ class SQLAlchemyBloodTestRepository(BloodTestRepository):
             created_at=model.created_at
         )
 
+@instrument_repository
 class SQLAlchemyChatConversationRepository(ChatConversationRepository):
     """Implementación SQLAlchemy del repositorio de conversaciones"""
     
@@ -116,23 +372,20 @@ class SQLAlchemyChatConversationRepository(ChatConversationRepository):
             created_at=conversation.created_at
         )
         db.session.add(conversation_model)
+        _bump_history_version(conversation.user_id)
         db.session.commit()
         return conversation
     
     def get_by_id(self, conversation_id: str) -> Optional[ChatConversation]:
         conversation_model = ChatConversationModel.query.filter_by(id=conversation_id).first()
         if conversation_model:
-            # Cargar mensajes
+            # Cargar mensajes (los archivados primero)
             message_models = ChatMessageModel.query.filter_by(conversation_id=conversation_id).order_by(ChatMessageModel.timestamp).all()
-            messages = [
-                ChatMessage(
-                    id=msg.id,
-                    conversation_id=msg.conversation_id,
-                    content=msg.content,
-                    sender=msg.sender,
-                    timestamp=msg.timestamp
-                ) for msg in message_models
-            ]
+            archived = _archived_messages(ChatConversationArchiveModel.conversation_id == conversation_id)
+            messages = _merge_messages(
+                archived.get(conversation_id, []),
+                [_message_to_entity(msg) for msg in message_models]
+            )
             
             return ChatConversation(
                 id=conversation_model.id,
@@ -145,20 +398,17 @@ class SQLAlchemyChatConversationRepository(ChatConversationRepository):
     
     def get_by_user_id(self, user_id: str) -> List[ChatConversation]:
         conversation_models = ChatConversationModel.query.filter_by(user_id=user_id).order_by(ChatConversationModel.created_at.desc()).all()
+        # Los mensajes archivados de todas las conversaciones del usuario, en una consulta
+        archived = _archived_messages(ChatConversationModel.user_id == user_id)
         conversations = []
         
         for conv_model in conversation_models:
             # Cargar mensajes para cada conversación
             message_models = ChatMessageModel.query.filter_by(conversation_id=conv_model.id).order_by(ChatMessageModel.timestamp).all()
-            messages = [
-                ChatMessage(
-                    id=msg.id,
-                    conversation_id=msg.conversation_id,
-                    content=msg.content,
-                    sender=msg.sender,
-                    timestamp=msg.timestamp
-                ) for msg in message_models
-            ]
+            messages = _merge_messages(
+                archived.get(conv_model.id, []),
+                [_message_to_entity(msg) for msg in message_models]
+            )
             
             conversations.append(ChatConversation(
                 id=conv_model.id,
@@ -169,10 +419,122 @@ class SQLAlchemyChatConversationRepository(ChatConversationRepository):
             ))
         
         return conversations
+    
+    def list_by_user_id(self, user_id: str) -> List[ConversationSummary]:
+        # Solo chat_conversations, por el índice (user_id, created_at)
+        rows = db.session.execute(
+            select(ChatConversationModel.id, ChatConversationModel.blood_test_id, ChatConversationModel.created_at,
+                   ChatConversationModel.message_count, ChatConversationModel.last_message_at,
+                   ChatConversationModel.last_sender)
+            .where(ChatConversationModel.user_id == user_id)
+            .order_by(ChatConversationModel.created_at.desc())
+        )
+        return [ConversationSummary(*row) for row in rows]
+    
+    def get_user_id(self, conversation_id: str) -> Optional[str]:
+        return db.session.execute(
+            select(ChatConversationModel.user_id).where(ChatConversationModel.id == conversation_id)
+        ).scalar()
+    
+    def repair_counters(self, batch_size: int) -> Tuple[int, int]:
+        # Lotes paginados por id; cada lote bloquea sus conversaciones hasta el commit para
+        # que un mensaje guardado a la vez no se pierda entre el recálculo y la escritura
+        conversation = ChatConversationModel
+        checked = corrected = 0
+        last_id = None
+        while True:
+            statement = (
+                select(conversation.id, conversation.message_count, conversation.last_message_at,
+                       conversation.last_sender)
+                .order_by(conversation.id)
+                .limit(batch_size)
+                .with_for_update()
+            )
+            if last_id is not None:
+                statement = statement.where(conversation.id > last_id)
+            try:
+                page = db.session.execute(statement).all()
+                expected = self._counters_from_messages([row.id for row in page]) if page else {}
+                corrected_ids = []
+                for conversation_id, *current in page:
+                    values = expected.get(conversation_id, (0, None, None))
+                    if tuple(current) == values:
+                        continue
+                    message_count, last_message_at, last_sender = values
+                    db.session.execute(
+                        update(conversation)
+                        .where(conversation.id == conversation_id)
+                        .values(message_count=message_count, last_message_at=last_message_at, last_sender=last_sender)
+                    )
+                    corrected_ids.append(conversation_id)
+                if corrected_ids:
+                    # El historial incluye message_count: los ETag anteriores a la corrección dejan de valer
+                    _bump_owners_history_version(corrected_ids)
+                corrected += len(corrected_ids)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            checked += len(page)
+            if len(page) < batch_size:
+                return checked, corrected
+            last_id = page[-1].id
+    
+    def _counters_from_messages(self, conversation_ids: List[str]) -> Dict[str, Tuple[int, Optional[datetime], Optional[str]]]:
+        """(mensajes, última actividad, último emisor) de cada conversación, sumando vigentes y archivados"""
+        message = ChatMessageModel
+        latest = (
+            select(message.conversation_id, func.count().label('messages'), func.max(message.timestamp).label('last_at'))
+            .where(message.conversation_id.in_(conversation_ids))
+            .group_by(message.conversation_id)
+            .subquery()
+        )
+        # Con varios mensajes en el último instante gana el de mayor id (UUIDv7: el último guardado)
+        rows = db.session.execute(
+            select(latest.c.conversation_id, latest.c.messages, latest.c.last_at, message.sender)
+            .join(message, and_(message.conversation_id == latest.c.conversation_id,
+                                message.timestamp == latest.c.last_at))
+            .order_by(message.id)
+        )
+        counters = {conversation_id: (count, last_at, sender) for conversation_id, count, last_at, sender in rows}
+        
+        archive = ChatConversationArchiveModel
+        archived = db.session.execute(
+            select(archive.conversation_id, archive.message_count, archive.last_message_at)
+            .where(archive.conversation_id.in_(conversation_ids))
+        ).all()
+        for conversation_id, archived_count, archived_last_at in archived:
+            count, last_at, sender = counters.get(conversation_id, (0, None, None))
+            if last_at is None or (archived_last_at is not None and archived_last_at > last_at):
+                # El último mensaje está en el archivo: hay que descomprimirlo para saber su emisor
+                messages = _archived_messages(archive.conversation_id == conversation_id).get(conversation_id, [])
+                last_at = archived_last_at
+                sender = messages[-1].sender if messages else None
+            counters[conversation_id] = (count + archived_count, last_at, sender)
+        return counters
+    
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatConversation]:
+        statement = (
+            select(ChatConversationModel)
+            .where(ChatConversationModel.user_id == user_id)
+            .order_by(ChatConversationModel.created_at)
+        )
+        for conv_model in _stream(statement, batch_size):
+            yield ChatConversation(
+                id=conv_model.id,
+                user_id=conv_model.user_id,
+                blood_test_id=conv_model.blood_test_id,
+                messages=[],
+                created_at=conv_model.created_at
+            )
 
+@instrument_repository
 class SQLAlchemyChatMessageRepository(ChatMessageRepository):
     """Implementación SQLAlchemy del repositorio de mensajes"""
     
+    def __init__(self, search_repository: Optional[MessageSearchRepository] = None):
+        self.search_repository = search_repository
+    
     def save(self, message: ChatMessage) -> ChatMessage:
         message_model = ChatMessageModel(
             id=message.id,
@@ -182,17 +544,595 @@ class SQLAlchemyChatMessageRepository(ChatMessageRepository):
             timestamp=message.timestamp
         )
         db.session.add(message_model)
+        _count_message(message)
+        _bump_history_version(_conversation_owner(message.conversation_id))
+        if self.search_repository is not None:
+            # En la misma transacción: el índice nunca tiene mensajes que no existen ni al revés
+            self.search_repository.index([message])
         db.session.commit()
         return message
     
     def get_by_conversation_id(self, conversation_id: str) -> List[ChatMessage]:
         message_models = ChatMessageModel.query.filter_by(conversation_id=conversation_id).order_by(ChatMessageModel.timestamp).all()
-        return [
-            ChatMessage(
-                id=msg.id,
-                conversation_id=msg.conversation_id,
-                content=msg.content,
-                sender=msg.sender,
-                timestamp=msg.timestamp
-            ) for msg in message_models
-        ]
+        archived = _archived_messages(ChatConversationArchiveModel.conversation_id == conversation_id)
+        return _merge_messages(
+            archived.get(conversation_id, []),
+            [_message_to_entity(msg) for msg in message_models]
+        )
+    
+    def iter_by_user_id(self, user_id: str, batch_size: int) -> Iterator[ChatMessage]:
+        # Por páginas de conversaciones (paginación por clave, sin cursor abierto) para intercalar
+        # los mensajes archivados de cada conversación con los que siguen en chat_messages
+        last_key = None
+        while True:
+            statement = (
+                select(ChatConversationModel.created_at, ChatConversationModel.id)
+                .where(ChatConversationModel.user_id == user_id)
+                .order_by(ChatConversationModel.created_at, ChatConversationModel.id)
+                .limit(_CONVERSATIONS_PER_PAGE)
+            )
+            if last_key is not None:
+                created_at, conversation_id = last_key
+                statement = statement.where(or_(
+                    ChatConversationModel.created_at > created_at,
+                    and_(ChatConversationModel.created_at == created_at, ChatConversationModel.id > conversation_id)
+                ))
+            page = db.session.execute(statement).all()
+            if not page:
+                return
+            
+            conversation_ids = [conversation_id for _, conversation_id in page]
+            archived = _archived_messages(ChatConversationArchiveModel.conversation_id.in_(conversation_ids))
+            hot = defaultdict(list)
+            rows = db.session.execute(
+                select(*_MESSAGE_ROW_COLUMNS)
+                .where(ChatMessageModel.conversation_id.in_(conversation_ids))
+                .order_by(ChatMessageModel.conversation_id, ChatMessageModel.timestamp)
+                .execution_options(yield_per=batch_size)
+            )
+            for row in rows:
+                hot[row.conversation_id].append(ChatMessage(*row))
+            for conversation_id in conversation_ids:
+                yield from _merge_messages(archived.get(conversation_id, []), hot.get(conversation_id, []))
+            
+            if len(page) < _CONVERSATIONS_PER_PAGE:
+                return
+            last_key = tuple(page[-1])
+
+@instrument_repository
+class SQLAlchemyMessageSearchRepository(MessageSearchRepository):
+    """
+    Búsqueda de texto en los mensajes. Con SQLite usa una tabla FTS5 (ranking BM25 y fragmentos
+    del propio motor, sin distinguir tildes); con MySQL, el índice FULLTEXT de chat_messages en
+    modo booleano; en otros casos, LIKE sobre el contenido.
+    """
+    
+    def __init__(self, backend: str):
+        if backend not in SEARCH_BACKENDS:
+            raise ValueError(f"Motor de búsqueda desconocido: {backend}")
+        self.backend = backend
+    
+    def index(self, messages: List[ChatMessage]) -> None:
+        # FULLTEXT y LIKE leen directamente chat_messages; solo FTS5 tiene su propia tabla
+        if self.backend != 'fts5' or not messages:
+            return
+        db.session.flush()
+        db.session.execute(
+            insert(MESSAGE_SEARCH_TABLE).from_select(
+                ['rowid', 'content', 'message_id'],
+                self._indexed_rows().where(ChatMessageModel.id.in_([message.id for message in messages]))
+            )
+        )
+    
+    def remove(self, message_ids: List[str]) -> None:
+        if self.backend != 'fts5' or not message_ids:
+            return
+        # Búsqueda por rowid (sin recorrer la tabla FTS5). Si el rowid de chat_messages cambió
+        # (VACUUM, entradas previas a la indexación por rowid), la entrada queda huérfana: la
+        # búsqueda la descarta al no encontrar el mensaje y rebuild-search-index la elimina
+        rowids = select(self._message_rowid()).where(ChatMessageModel.id.in_(message_ids))
+        db.session.execute(
+            delete(MESSAGE_SEARCH_TABLE).where(
+                MESSAGE_SEARCH_TABLE.c.rowid.in_(rowids),
+                MESSAGE_SEARCH_TABLE.c.message_id.in_(message_ids)
+            )
+        )
+    
+    def search(self, query: str, limit: int, offset: int,
+               user_id: Optional[str] = None) -> Tuple[int, List[MessageSearchResult]]:
+        terms = parse_terms(query)
+        if not terms:
+            return 0, []
+        
+        if self.backend == 'fts5':
+            fts = literal_column(MESSAGE_SEARCH_TABLE.name)
+            match = fts.op('MATCH')(fts5_expression(terms))
+            # bm25 es menor cuanto más relevante: se invierte para que mayor sea mejor
+            score = -func.bm25(fts)
+            snippet = func.snippet(fts, 0, HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_ELLIPSIS, SNIPPET_TOKENS)
+            source = MESSAGE_SEARCH_TABLE.join(
+                ChatMessageModel, ChatMessageModel.id == MESSAGE_SEARCH_TABLE.c.message_id
+            )
+        elif self.backend == 'fulltext':
+            match = ChatMessageModel.content.match(mysql_boolean_expression(terms))
+            score = match
+            snippet = ChatMessageModel.content
+            source = ChatMessageModel.__table__
+        else:
+            match = and_(*[ChatMessageModel.content.ilike(like_pattern(word), escape='\\') for word, _ in terms])
+            score = literal_column('0.0')
+            snippet = ChatMessageModel.content
+            source = ChatMessageModel.__table__
+        
+        source = source.join(ChatConversationModel, ChatConversationModel.id == ChatMessageModel.conversation_id)
+        conditions = [match]
+        if user_id is not None:
+            conditions.append(ChatConversationModel.user_id == user_id)
+        
+        total = db.session.execute(select(func.count()).select_from(source).where(*conditions)).scalar()
+        if not total or offset >= total:
+            return total or 0, []
+        
+        rows = db.session.execute(
+            select(
+                ChatMessageModel.id, ChatMessageModel.conversation_id, ChatConversationModel.user_id,
+                ChatMessageModel.sender, ChatMessageModel.timestamp, snippet.label('snippet'), score.label('score')
+            )
+            .select_from(source)
+            .where(*conditions)
+            .order_by(score.desc(), ChatMessageModel.timestamp.desc())
+            .limit(limit)
+            .offset(offset)
+        )
+        results = []
+        for message_id, conversation_id, owner_id, sender, timestamp, fragment, relevance in rows:
+            if self.backend != 'fts5':
+                fragment = make_snippet(fragment, terms)
+            results.append(MessageSearchResult(
+                message_id=message_id,
+                conversation_id=conversation_id,
+                user_id=owner_id,
+                sender=sender,
+                timestamp=timestamp,
+                snippet=fragment,
+                score=round(float(relevance or 0.0), 4)
+            ))
+        return total, results
+    
+    def rebuild(self) -> int:
+        if self.backend == 'fts5':
+            db.session.execute(delete(MESSAGE_SEARCH_TABLE))
+            db.session.execute(
+                insert(MESSAGE_SEARCH_TABLE).from_select(['rowid', 'content', 'message_id'], self._indexed_rows())
+            )
+            # Compacta los segmentos del índice tras la carga masiva (comando especial de FTS5)
+            table = MESSAGE_SEARCH_TABLE.name
+            db.session.execute(text(f"INSERT INTO {table}({table}) VALUES ('optimize')"))
+            db.session.commit()
+        return db.session.execute(select(func.count()).select_from(ChatMessageModel)).scalar()
+    
+    def _message_rowid(self):
+        return literal_column(f'{ChatMessageModel.__tablename__}.rowid')
+    
+    def _indexed_rows(self):
+        return select(self._message_rowid(), ChatMessageModel.content, ChatMessageModel.id)
+
+@instrument_repository
+class SQLAlchemyConversationArchiveRepository(ConversationArchiveRepository):
+    """
+    Archivo de conversaciones inactivas en chat_conversation_archives. Cada lote es una
+    transacción corta: toma los mensajes de las conversaciones elegidas, los comprime junto
+    con lo que ya estuviera archivado, los borra de chat_messages y del índice de búsqueda
+    y confirma. Las lecturas de conversaciones y mensajes combinan ambas tablas.
+    """
+    
+    def __init__(self, codec: str, search_repository: Optional[MessageSearchRepository] = None,
+                 delete_chunk_size: int = 500):
+        self.codec = codec
+        self.search_repository = search_repository
+        self.delete_chunk_size = delete_chunk_size
+    
+    def archive_batch(self, idle_before: datetime, batch_size: int,
+                      after_conversation_id: Optional[str] = None) -> ArchiveBatchResult:
+        # Última actividad por conversación con el índice (conversation_id, timestamp); recorrer
+        # por id desde el lote anterior hace que el trabajo completo sea una sola pasada
+        candidates = (
+            select(ChatMessageModel.conversation_id)
+            .group_by(ChatMessageModel.conversation_id)
+            .having(func.max(ChatMessageModel.timestamp) < idle_before)
+            .order_by(ChatMessageModel.conversation_id)
+            .limit(batch_size)
+        )
+        if after_conversation_id is not None:
+            candidates = candidates.where(ChatMessageModel.conversation_id > after_conversation_id)
+        conversation_ids = db.session.scalars(candidates).all()
+        if not conversation_ids:
+            return ArchiveBatchResult(0, 0, 0, 0, None)
+        
+        try:
+            # Solo mensajes anteriores al corte: si llega uno nuevo mientras tanto, se queda vigente
+            hot = defaultdict(list)
+            rows = db.session.execute(
+                select(*_MESSAGE_ROW_COLUMNS)
+                .where(ChatMessageModel.conversation_id.in_(conversation_ids),
+                       ChatMessageModel.timestamp < idle_before)
+                .order_by(ChatMessageModel.conversation_id, ChatMessageModel.timestamp)
+            )
+            for row in rows:
+                hot[row.conversation_id].append(ChatMessage(*row))
+            archives = {
+                archive.conversation_id: archive
+                for archive in db.session.scalars(
+                    select(ChatConversationArchiveModel)
+                    .where(ChatConversationArchiveModel.conversation_id.in_(conversation_ids))
+                    .with_for_update()
+                )
+            }
+            
+            conversations = raw_bytes = compressed_bytes = 0
+            message_ids = []
+            for conversation_id, new_messages in hot.items():
+                archive = archives.get(conversation_id)
+                previous = decode_messages(conversation_id, archive.codec, archive.payload) if archive else []
+                messages = _merge_messages(previous, new_messages)
+                payload, raw_size = encode_messages(messages, self.codec)
+                values = dict(
+                    codec=self.codec,
+                    payload=payload,
+                    message_count=len(messages),
+                    raw_size=raw_size,
+                    first_message_at=messages[0].timestamp,
+                    last_message_at=messages[-1].timestamp
+                )
+                if archive is None:
+                    db.session.add(ChatConversationArchiveModel(conversation_id=conversation_id, **values))
+                else:
+                    for attribute, value in values.items():
+                        setattr(archive, attribute, value)
+                
+                conversations += 1
+                raw_bytes += raw_size
+                compressed_bytes += len(payload)
+                message_ids.extend(message.id for message in new_messages)
+            
+            db.session.flush()
+            for start in range(0, len(message_ids), self.delete_chunk_size):
+                chunk = message_ids[start:start + self.delete_chunk_size]
+                if self.search_repository is not None:
+                    self.search_repository.remove(chunk)
+                db.session.execute(
+                    delete(ChatMessageModel).where(ChatMessageModel.id.in_(chunk)),
+                    execution_options={'synchronize_session': False}
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        return ArchiveBatchResult(conversations, len(message_ids), raw_bytes, compressed_bytes, conversation_ids[-1])
+    
+    def stats(self) -> dict:
+        archive = ChatConversationArchiveModel
+        conversations, messages, raw_bytes, compressed_bytes = db.session.execute(
+            select(
+                func.count(),
+                func.coalesce(func.sum(archive.message_count), 0),
+                func.coalesce(func.sum(archive.raw_size), 0),
+                func.coalesce(func.sum(func.length(archive.payload)), 0)
+            )
+        ).one()
+        return {
+            'conversations': conversations,
+            'messages': int(messages),
+            'raw_bytes': int(raw_bytes),
+            'compressed_bytes': int(compressed_bytes),
+            'compression_ratio': round(raw_bytes / compressed_bytes, 2) if compressed_bytes else None
+        }
+
+def _cohort_contributions(age_band: str, gender: str, overall_risk: str, risk_factors: Iterable[str]):
+    """Filas de agregados a las que aporta un paciente"""
+    yield age_band, gender, 'risk_level', overall_risk
+    for risk_factor in risk_factors:
+        yield age_band, gender, 'risk_factor', risk_factor
+
+def _increment_aggregate(key: Tuple[str, str, str, str], delta: int) -> None:
+    """Suma delta al contador de la fila, creándola si no existe (upsert atómico)"""
+    table = CohortRiskAggregateModel.__table__
+    age_band, gender, dimension, value = key
+    values = dict(age_band=age_band, gender=gender, dimension=dimension, value=value, patient_count=delta)
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        statement = sqlite_insert(table).values(**values).on_conflict_do_update(
+            index_elements=[table.c.age_band, table.c.gender, table.c.dimension, table.c.value],
+            set_={'patient_count': table.c.patient_count + delta}
+        )
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        statement = mysql_insert(table).values(**values).on_duplicate_key_update(
+            patient_count=table.c.patient_count + delta
+        )
+    else:
+        updated = db.session.execute(
+            update(table)
+            .where(table.c.age_band == age_band, table.c.gender == gender,
+                   table.c.dimension == dimension, table.c.value == value)
+            .values(patient_count=table.c.patient_count + delta)
+        )
+        if updated.rowcount:
+            return
+        statement = insert(table).values(**values)
+    db.session.execute(statement)
+
+def _apply_risk_snapshot(snapshot: PatientRiskSnapshot) -> None:
+    """
+    Actualiza los agregados de cohortes dentro de la transacción en curso: el paciente deja de
+    aportar con su examen anterior y pasa a aportar con el nuevo, si este es el más reciente
+    """
+    current = db.session.get(UserLatestRiskModel, snapshot.user_id, with_for_update=True)
+    if current is not None:
+        if not snapshot.is_newer_than(current.test_date, current.blood_test_id):
+            return  # Examen antiguo (p. ej. importado): no cambia el riesgo actual del paciente
+        for key in _cohort_contributions(current.age_band, current.gender,
+                                         current.overall_risk, json.loads(current.risk_factors)):
+            _increment_aggregate(key, -1)
+        for attribute, value in _latest_risk_row(snapshot).items():
+            setattr(current, attribute, value)
+    else:
+        db.session.add(UserLatestRiskModel(**_latest_risk_row(snapshot)))
+    
+    for key in _cohort_contributions(snapshot.age_band, snapshot.gender,
+                                     snapshot.overall_risk.value, snapshot.risk_factors):
+        _increment_aggregate(key, 1)
+
+def _latest_risk_row(snapshot: PatientRiskSnapshot) -> dict:
+    return dict(
+        user_id=snapshot.user_id,
+        blood_test_id=snapshot.blood_test_id,
+        test_date=snapshot.test_date,
+        age_band=snapshot.age_band,
+        gender=snapshot.gender,
+        overall_risk=snapshot.overall_risk.value,
+        risk_factors=json.dumps(list(snapshot.risk_factors), ensure_ascii=False),
+        updated_at=datetime.utcnow()
+    )
+
+@instrument_repository
+class SQLAlchemyCohortRiskRepository(CohortRiskRepository):
+    """Implementación SQLAlchemy de los agregados de riesgo por cohorte"""
+    
+    def replace_all(self, snapshots: Iterable[PatientRiskSnapshot]) -> int:
+        # Todo en una transacción: el panel sigue viendo los agregados anteriores hasta el commit
+        counts = Counter()
+        patients = 0
+        pending = []
+        try:
+            db.session.execute(delete(CohortRiskAggregateModel))
+            db.session.execute(delete(UserLatestRiskModel))
+            for snapshot in snapshots:
+                pending.append(_latest_risk_row(snapshot))
+                counts.update(_cohort_contributions(
+                    snapshot.age_band, snapshot.gender, snapshot.overall_risk.value, snapshot.risk_factors
+                ))
+                patients += 1
+                if len(pending) >= 1000:
+                    db.session.execute(insert(UserLatestRiskModel), pending)
+                    pending = []
+            if pending:
+                db.session.execute(insert(UserLatestRiskModel), pending)
+            if counts:
+                db.session.execute(insert(CohortRiskAggregateModel), [
+                    dict(age_band=age_band, gender=gender, dimension=dimension, value=value, patient_count=count)
+                    for (age_band, gender, dimension, value), count in counts.items()
+                ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return patients
+    
+    def get_aggregates(self) -> List[CohortAggregate]:
+        rows = db.session.execute(
+            select(CohortRiskAggregateModel.age_band, CohortRiskAggregateModel.gender,
+                   CohortRiskAggregateModel.dimension, CohortRiskAggregateModel.value,
+                   CohortRiskAggregateModel.patient_count)
+            .where(CohortRiskAggregateModel.patient_count > 0)
+        )
+        return [tuple(row) for row in rows]
+
+def _trend_to_model(trend: AnalyteTrend) -> AnalyteTrendModel:
+    return AnalyteTrendModel(
+        user_id=trend.user_id,
+        analyte=trend.analyte,
+        count=trend.count,
+        mean=trend.mean,
+        m2=trend.m2,
+        recent_values=json.dumps([[test_date.isoformat(), value] for test_date, value in trend.recent])
+    )
+
+@instrument_repository
+class SQLAlchemyAnalyteTrendRepository(AnalyteTrendRepository):
+    """Implementación SQLAlchemy del repositorio de tendencias"""
+    
+    def get_by_user_id(self, user_id: str, for_update: bool = False) -> List[AnalyteTrend]:
+        statement = select(AnalyteTrendModel).where(AnalyteTrendModel.user_id == user_id)
+        if for_update:
+            statement = statement.with_for_update()
+        trend_models = db.session.scalars(statement).all()
+        return [self._model_to_entity(model) for model in trend_models]
+    
+    def replace_for_user(self, user_id: str, trends: List[AnalyteTrend]) -> None:
+        try:
+            db.session.execute(delete(AnalyteTrendModel).where(AnalyteTrendModel.user_id == user_id))
+            db.session.add_all([_trend_to_model(trend) for trend in trends])
+            # El historial incluye las tendencias: los ETag anteriores a la reconstrucción dejan de valer
+            _invalidate_history([user_id])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    def _model_to_entity(self, model: AnalyteTrendModel) -> AnalyteTrend:
+        return AnalyteTrend(
+            user_id=model.user_id,
+            analyte=model.analyte,
+            count=model.count,
+            mean=model.mean,
+            m2=model.m2,
+            recent=tuple((datetime.fromisoformat(test_date), value)
+                         for test_date, value in json.loads(model.recent_values))
+        )
+
+# Borrados masivos: las filas no están en la sesión, no hay nada que sincronizar
+_BULK_DELETE = {'synchronize_session': False}
+
+@instrument_repository
+class SQLAlchemyRetentionRepository(RetentionRepository):
+    """
+    Depuración por retención con DELETE por lotes de ids: cada llamada selecciona como
+    máximo limit ids (solo la columna de la clave, sin modelos), los borra y confirma. Ninguna
+    transacción retiene bloqueos mucho tiempo ni la memoria crece con el volumen a borrar.
+    """
+    
+    def __init__(self, search_repository: Optional[MessageSearchRepository] = None):
+        self.search_repository = search_repository
+    
+    def purge_archives_before(self, cutoff: datetime, limit: int) -> int:
+        archive = ChatConversationArchiveModel
+        rows = db.session.execute(
+            select(archive.conversation_id, archive.message_count)
+            .where(archive.last_message_at < cutoff)
+            .order_by(archive.last_message_at)
+            .limit(limit)
+        ).all()
+        if not rows:
+            return 0
+        try:
+            db.session.execute(
+                delete(archive).where(archive.conversation_id.in_([conversation_id for conversation_id, _ in rows])),
+                execution_options=_BULK_DELETE
+            )
+            self._discount_messages(dict(rows))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(rows)
+    
+    def purge_messages_before(self, cutoff: datetime, limit: int) -> int:
+        message = ChatMessageModel
+        rows = db.session.execute(
+            select(message.id, message.conversation_id)
+            .where(message.timestamp < cutoff)
+            .order_by(message.timestamp)
+            .limit(limit)
+        ).all()
+        if not rows:
+            return 0
+        try:
+            message_ids = [message_id for message_id, _ in rows]
+            if self.search_repository is not None:
+                self.search_repository.remove(message_ids)
+            db.session.execute(delete(message).where(message.id.in_(message_ids)), execution_options=_BULK_DELETE)
+            self._discount_messages(Counter(conversation_id for _, conversation_id in rows))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(rows)
+    
+    def find_inactive_users(self, inactive_since: datetime, limit: int) -> List[str]:
+        # history_updated_at cambia con cada examen, conversación o mensaje nuevo. Es nulo en los
+        # usuarios sin escrituras desde que se agregó la columna: su actividad se busca en las tablas
+        conversation = ChatConversationModel
+        archive = ChatConversationArchiveModel
+        user_conversations = select(conversation.id).where(conversation.user_id == UserModel.id)
+        recent_activity = (
+            select(BloodTestModel.id)
+            .where(BloodTestModel.user_id == UserModel.id, BloodTestModel.created_at >= inactive_since),
+            select(conversation.id)
+            .where(conversation.user_id == UserModel.id,
+                   or_(conversation.created_at >= inactive_since, conversation.last_message_at >= inactive_since)),
+            select(ChatMessageModel.id)
+            .where(ChatMessageModel.conversation_id.in_(user_conversations),
+                   ChatMessageModel.timestamp >= inactive_since),
+            select(archive.conversation_id)
+            .where(archive.conversation_id.in_(user_conversations), archive.last_message_at >= inactive_since),
+        )
+        inactive = or_(
+            UserModel.history_updated_at < inactive_since,
+            and_(UserModel.history_updated_at.is_(None), UserModel.created_at < inactive_since,
+                 *(~query.exists() for query in recent_activity))
+        )
+        return db.session.scalars(
+            select(UserModel.id).where(inactive).order_by(UserModel.id).limit(limit)
+        ).all()
+    
+    def purge_user(self, user_id: str, limit: int) -> Tuple[int, bool]:
+        conversation_ids = select(ChatConversationModel.id).where(ChatConversationModel.user_id == user_id)
+        # Orden de las claves foráneas: primero lo que depende de las conversaciones y de los exámenes
+        steps = (
+            (ChatConversationArchiveModel, ChatConversationArchiveModel.conversation_id,
+             ChatConversationArchiveModel.conversation_id.in_(conversation_ids)),
+            (ChatMessageModel, ChatMessageModel.id, ChatMessageModel.conversation_id.in_(conversation_ids)),
+            (ChatConversationModel, ChatConversationModel.id, ChatConversationModel.user_id == user_id),
+            (BloodTestModel, BloodTestModel.id, BloodTestModel.user_id == user_id),
+        )
+        try:
+            for model, id_column, condition in steps:
+                ids = db.session.scalars(select(id_column).where(condition).limit(limit)).all()
+                if not ids:
+                    continue
+                if model is ChatMessageModel and self.search_repository is not None:
+                    self.search_repository.remove(ids)
+                db.session.execute(delete(model).where(id_column.in_(ids)), execution_options=_BULK_DELETE)
+                db.session.commit()
+                return len(ids), False
+            
+            # Por último, en una transacción: tendencias, riesgo actual (y su aporte a los agregados) y el usuario
+            deleted = db.session.execute(
+                delete(AnalyteTrendModel).where(AnalyteTrendModel.user_id == user_id), execution_options=_BULK_DELETE
+            ).rowcount
+            latest = db.session.execute(
+                select(UserLatestRiskModel.age_band, UserLatestRiskModel.gender,
+                       UserLatestRiskModel.overall_risk, UserLatestRiskModel.risk_factors)
+                .where(UserLatestRiskModel.user_id == user_id)
+                .with_for_update()
+            ).first()
+            if latest is not None:
+                age_band, gender, overall_risk, risk_factors = latest
+                for key in _cohort_contributions(age_band, gender, overall_risk, json.loads(risk_factors)):
+                    _increment_aggregate(key, -1)
+                deleted += db.session.execute(
+                    delete(UserLatestRiskModel).where(UserLatestRiskModel.user_id == user_id),
+                    execution_options=_BULK_DELETE
+                ).rowcount
+            deleted += db.session.execute(
+                delete(UserModel).where(UserModel.id == user_id), execution_options=_BULK_DELETE
+            ).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return deleted, True
+    
+    def _discount_messages(self, removed: Dict[str, int]) -> None:
+        """Resta los mensajes borrados de los contadores de cada conversación"""
+        conversation = ChatConversationModel
+        by_count = defaultdict(list)
+        for conversation_id, count in removed.items():
+            by_count[count].append(conversation_id)
+        for count, conversation_ids in by_count.items():
+            remaining = conversation.message_count - count
+            # Se borran los mensajes más antiguos: la última actividad solo cambia si no queda ninguno.
+            # message_count va al final porque MySQL aplica las asignaciones en orden
+            db.session.execute(
+                update(conversation)
+                .where(conversation.id.in_(conversation_ids))
+                .ordered_values(
+                    (conversation.last_message_at, case((remaining > 0, conversation.last_message_at), else_=None)),
+                    (conversation.last_sender, case((remaining > 0, conversation.last_sender), else_=None)),
+                    (conversation.message_count, case((remaining > 0, remaining), else_=0))
+                )
+            )
+        _bump_owners_history_version(list(removed))
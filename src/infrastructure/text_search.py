@@ -0,0 +1,91 @@
+"""
+Utilidades de la búsqueda de texto en mensajes: términos de la consulta, expresiones para
+cada motor y fragmentos resaltados cuando el motor no los genera (FULLTEXT y LIKE)
+"""
+import re
+import unicodedata
+from typing import List, Tuple
+
+HIGHLIGHT_START = '**'
+HIGHLIGHT_END = '**'
+SNIPPET_ELLIPSIS = '…'
+SNIPPET_TOKENS = 12  # palabras del fragmento en FTS5
+SNIPPET_CHARS = 120  # caracteres del fragmento generado en Python
+MAX_TERMS = 10
+
+# (término, es_prefijo): "insul*" busca palabras que empiezan por "insul"
+SearchTerm = Tuple[str, bool]
+
+_TERM_PATTERN = re.compile(r'(\w+)(\*?)')
+
+
+def parse_terms(query: str) -> List[SearchTerm]:
+    """Palabras de la consulta; se ignoran los operadores para que no se puedan inyectar"""
+    return [(word, bool(star)) for word, star in _TERM_PATTERN.findall(query or '')][:MAX_TERMS]
+
+
+def fts5_expression(terms: List[SearchTerm]) -> str:
+    # Cada término entre comillas (frase literal); separados por espacio equivalen a AND
+    return ' '.join(f'"{word}"' + ('*' if prefix else '') for word, prefix in terms)
+
+
+def mysql_boolean_expression(terms: List[SearchTerm]) -> str:
+    return ' '.join(f'+{word}' + ('*' if prefix else '') for word, prefix in terms)
+
+
+def like_pattern(word: str) -> str:
+    escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def fold(text: str) -> str:
+    """Minúsculas sin tildes, carácter por carácter (conserva las posiciones del texto original)"""
+    return ''.join(unicodedata.normalize('NFD', char)[0].lower() for char in text)
+
+
+def make_snippet(content: str, terms: List[SearchTerm], width: int = SNIPPET_CHARS) -> str:
+    """Fragmento alrededor de la primera coincidencia con los términos resaltados"""
+    folded = fold(content)
+    words = [fold(word) for word, _ in terms]
+    positions = [folded.find(word) for word in words if word in folded]
+    first = min(positions) if positions else 0
+
+    start = max(0, first - width // 3)
+    end = min(len(content), start + width)
+    start = max(0, min(start, end - width))
+    if start > 0:
+        space = content.rfind(' ', 0, start)
+        start = space + 1 if space >= 0 and start - space < 15 else start
+    if end < len(content):
+        space = content.find(' ', end)
+        end = space if 0 <= space and space - end < 15 else end
+
+    spans = []
+    window = folded[start:end]
+    for word in words:
+        position = window.find(word)
+        while word and position >= 0:
+            spans.append((position, position + len(word)))
+            position = window.find(word, position + len(word))
+    highlighted = _highlight(content[start:end], spans)
+
+    prefix = SNIPPET_ELLIPSIS if start > 0 else ''
+    suffix = SNIPPET_ELLIPSIS if end < len(content) else ''
+    return f'{prefix}{highlighted}{suffix}'
+
+
+def _highlight(text: str, spans: List[Tuple[int, int]]) -> str:
+    merged = []
+    for span_start, span_end in sorted(spans):
+        if merged and span_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+        else:
+            merged.append((span_start, span_end))
+    parts = []
+    position = 0
+    for span_start, span_end in merged:
+        parts.append(text[position:span_start])
+        parts.append(f'{HIGHLIGHT_START}{text[span_start:span_end]}{HIGHLIGHT_END}')
+        position = span_end
+    parts.append(text[position:])
+    return ''.join(parts)
@@ -0,0 +1,232 @@
+"""
+Trazas ligeras por petición con exportación local a JSONL
+"""
+import json
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import getrandbits, random
+from threading import Lock
+from time import time_ns, perf_counter_ns
+from typing import Any, Dict, List, Optional, Tuple
+
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+TRACE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Longitud máxima de las sentencias SQL guardadas como atributo
+MAX_STATEMENT_LENGTH = 1000
+
+
+def new_trace_id() -> str:
+    return f'{getrandbits(128):032x}'
+
+
+def new_span_id() -> str:
+    return f'{getrandbits(64):016x}'
+
+
+def parse_trace_headers(headers) -> Tuple[Optional[str], Optional[str], Optional[bool]]:
+    """Extrae (trace_id, parent_span_id, sampled) de traceparent o X-Trace-Id"""
+    traceparent = headers.get('traceparent', '').strip().lower()
+    match = TRACEPARENT_PATTERN.match(traceparent)
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+    trace_id = headers.get('X-Trace-Id', '').strip().lower().replace('-', '')
+    if TRACE_ID_PATTERN.match(trace_id):
+        return trace_id, None, None
+    return None, None, None
+
+
+class Span:
+    """Operación medida dentro de una traza"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes',
+                 'start_time_ns', 'end_time_ns', '_start_perf_ns', 'status')
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_time_ns = time_ns()
+        self._start_perf_ns = perf_counter_ns()
+        self.end_time_ns = None
+        self.status = 'ok'
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        self.end_time_ns = self.start_time_ns + (perf_counter_ns() - self._start_perf_ns)
+        if error is not None:
+            self.status = 'error'
+            self.attributes['error.type'] = type(error).__name__
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_time_ns if self.end_time_ns is not None else time_ns()
+        return (end - self.start_time_ns) / 1_000_000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'startTimeUnixNano': self.start_time_ns,
+            'endTimeUnixNano': self.end_time_ns,
+            'durationMs': round(self.duration_ms, 3),
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+
+class _Trace:
+    """Spans acumulados de una petición hasta decidir si se exportan"""
+
+    __slots__ = ('trace_id', 'sampled', 'spans')
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List[Span] = []
+
+
+class JsonlSpanExporter:
+    """Escribe cada span como una línea JSON en un archivo local"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+
+    def export(self, spans: List[Span]) -> None:
+        lines = ''.join(json.dumps(span.to_dict(), default=str, ensure_ascii=False) + '\n' for span in spans)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as trace_file:
+                trace_file.write(lines)
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar('current_trace', default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """
+    Registra spans anidados por petición. Una traza se exporta si fue muestreada
+    al inicio (cabecera o tasa de muestreo) o si su duración supera el umbral de lentitud.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.slow_threshold_ms = None
+        self.exporter = None
+
+    def configure(self, exporter: JsonlSpanExporter, sample_rate: float = 0.0,
+                  slow_threshold_ms: Optional[float] = None) -> None:
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self.enabled = True
+
+    def start_trace(self, name: str, trace_id: Optional[str] = None, parent_span_id: Optional[str] = None,
+                    sampled: Optional[bool] = None, **attributes):
+        """Inicia la traza de una petición y devuelve su span raíz (o None si está deshabilitado)"""
+        if not self.enabled:
+            return None
+        if sampled is None:
+            sampled = random() < self.sample_rate
+        trace = _Trace(trace_id or new_trace_id(), sampled)
+        _current_trace.set(trace)
+        root = Span(trace.trace_id, parent_span_id, name, attributes)
+        trace.spans.append(root)
+        _current_span.set(root)
+        return root
+
+    def end_trace(self, root: Optional[Span], error: Optional[BaseException] = None) -> None:
+        trace = _current_trace.get()
+        _current_trace.set(None)
+        _current_span.set(None)
+        if root is None or trace is None:
+            return
+        root.end(error)
+        slow = self.slow_threshold_ms is not None and root.duration_ms >= self.slow_threshold_ms
+        if trace.sampled or slow:
+            if slow:
+                root.set_attribute('trace.slow', True)
+            self.exporter.export(trace.spans)
+
+    def start_span(self, name: str, **attributes):
+        """Abre un span hijo del span actual; devuelve (span, token) o (None, None)"""
+        trace = _current_trace.get()
+        if trace is None:
+            return None, None
+        parent = _current_span.get()
+        span = Span(trace.trace_id, parent.span_id if parent else None, name, attributes)
+        trace.spans.append(span)
+        return span, _current_span.set(span)
+
+    def end_span(self, span: Optional[Span], token, error: Optional[BaseException] = None) -> None:
+        if span is None:
+            return
+        span.end(error)
+        _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span, token = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as error:
+            self.end_span(span, token, error)
+            raise
+        self.end_span(span, token)
+
+    def current_trace_id(self) -> Optional[str]:
+        trace = _current_trace.get()
+        return trace.trace_id if trace else None
+
+
+tracer = Tracer()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span, token = tracer.start_span(
+        'sql',
+        **{'db.system': conn.dialect.name, 'db.statement': statement[:MAX_STATEMENT_LENGTH]}
+    )
+    if span is not None:
+        conn.info.setdefault('trace_spans', []).append((span, token))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    pending = conn.info.get('trace_spans')
+    if pending:
+        span, token = pending.pop()
+        span.set_attribute('db.rowcount', cursor.rowcount)
+        tracer.end_span(span, token)
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    pending = conn.info.get('trace_spans') if conn is not None else None
+    if pending:
+        span, token = pending.pop()
+        tracer.end_span(span, token, exception_context.original_exception)
+
+
+def register_sql_tracing(engine_class) -> None:
+    """
+    Crea un span por cada sentencia SQL ejecutada por SQLAlchemy. Es idempotente: cada create_app
+    con trazas la vuelve a llamar y los listeners sobre la clase Engine valen para todo el proceso
+    """
+    from sqlalchemy import event
+
+    for identifier, listener in (('before_cursor_execute', _before_cursor_execute),
+                                 ('after_cursor_execute', _after_cursor_execute),
+                                 ('handle_error', _handle_error)):
+        if not event.contains(engine_class, identifier, listener):
+            event.listen(engine_class, identifier, listener)
@@ -0,0 +1,164 @@
+"""
+Captura de tráfico anonimizada para reproducir la mezcla real de peticiones (benchmarks/replay.py).
+
+Cada petición a /api es una línea NDJSON con su instante de llegada, la ruta (plantilla, no la
+URL), la forma del cuerpo y de la query, el estado y la duración. No se guarda ningún dato que
+identifique al paciente:
+
+- Los identificadores (user_id, conversation_id, ...) se sustituyen por seudónimos HMAC con una
+  sal que no se escribe en el log: el mismo id da el mismo seudónimo durante la captura, así que
+  la reproducción conserva qué peticiones son del mismo paciente o conversación.
+- Los textos (nombres, mensajes, búsquedas) se reducen a su longitud.
+- Las fechas se reducen al mes y los números a dos cifras significativas.
+- Las cabeceras no se guardan; solo si la petición traía el token de administrador.
+
+El archivo rota al superar max_bytes (capture.ndjson.1, .2, ...). Varios workers pueden escribir
+en el mismo archivo: la escritura y la rotación se serializan con un bloqueo de archivo (flock, o
+msvcrt.locking en Windows).
+"""
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+from datetime import datetime
+from math import floor, log10
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin flock, se bloquea el primer byte con msvcrt
+    fcntl = None
+    import msvcrt
+
+# Campos cuyo valor es el id de una entidad
+IDENTIFIER_FIELDS = frozenset({'id', 'user_id', 'user_ids', 'conversation_id', 'blood_test_id', 'profile_id'})
+
+# Campos de texto con un conjunto cerrado de valores, que no identifican a nadie
+ENUMERATED_FIELDS = frozenset({'gender', 'format'})
+
+
+class TrafficCaptureLog:
+    """Escribe las peticiones capturadas en un NDJSON con rotación por tamaño"""
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5,
+                 salt: Optional[str] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # Sin sal configurada se genera una por arranque; el maestro del servidor pre-fork la
+        # crea antes del fork, así que todos sus workers usan la misma
+        self._salt = (salt or secrets.token_hex(16)).encode('utf-8')
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Oculto, para que capture.ndjson* solo incluya capturas
+        self._lock_path = os.path.join(directory, f'.{os.path.basename(path)}.lock')
+
+    def pseudonym(self, value: Any) -> str:
+        """Seudónimo estable de un identificador durante la captura"""
+        return hmac.new(self._salt, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def anonymize(self, value: Any, field: Optional[str] = None) -> Any:
+        """Forma anonimizada de un valor del cuerpo o de la query"""
+        if isinstance(value, dict):
+            return {key: self.anonymize(item, key) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item, field) for item in value]
+        if value is None or isinstance(value, bool):
+            return value
+        if field in IDENTIFIER_FIELDS:
+            return {'$id': self.pseudonym(value)}
+        if isinstance(value, (int, float)):
+            return _round_significant(value)
+        if field in ENUMERATED_FIELDS:
+            return value
+        if field is not None and field.endswith('_date'):
+            try:
+                return {'$date': datetime.fromisoformat(value).strftime('%Y-%m')}
+            except ValueError:
+                pass
+        return {'$text': len(str(value))}
+
+    def created_ids(self, data: Any) -> List[str]:
+        """Seudónimos de los ids que devuelve una petición de escritura, en orden de aparición"""
+        return [self.pseudonym(identifier) for identifier in iter_identifiers(data)]
+
+    def write(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            _lock_file(lock_file)
+            try:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    self._rotate()
+                with open(self.path, 'a', encoding='utf-8') as capture_file:
+                    capture_file.write(line)
+            finally:
+                _unlock_file(lock_file)
+
+    def _rotate(self) -> None:
+        # capture.ndjson -> .1 -> .2 ...; el más antiguo se descarta
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
+def iter_identifiers(data: Any) -> Iterator[Any]:
+    """Valores de los campos de identificador de una respuesta, recorridos en orden"""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in IDENTIFIER_FIELDS:
+                if isinstance(value, list):
+                    yield from (item for item in value if isinstance(item, str))
+                elif isinstance(value, str):
+                    yield value
+            else:
+                yield from iter_identifiers(value)
+    elif isinstance(data, list):
+        for item in data:
+            yield from iter_identifiers(item)
+
+
+def read_capture(paths: Iterable[str]) -> List[Dict[str, Any]]:
+    """Entradas de uno o varios archivos de captura (incluidos los rotados), por instante de llegada"""
+    entries = []
+    for path in paths:
+        with open(path, encoding='utf-8') as capture_file:
+            entries.extend(json.loads(line) for line in capture_file if line.strip())
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+
+def _lock_file(lock_file: IO) -> None:
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    lock_file.seek(0)
+    while True:
+        try:
+            # LK_LOCK reintenta durante unos 10 s antes de fallar
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(lock_file: IO) -> None:
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    lock_file.seek(0)
+    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _round_significant(value, digits: int = 2):
+    if value == 0:
+        return value
+    rounded = round(value, digits - 1 - floor(log10(abs(value))))
+    return int(rounded) if isinstance(value, int) else float(rounded)
@@ -0,0 +1,172 @@
+"""
+Comandos de administración para la línea de comandos (flask --app app <comando>)
+"""
+import os
+import sys
+from typing import Optional
+
+import click
+from flask import Flask
+from ..application.use_cases import (
+    ExportBloodTestsToParquetUseCase, CohortAnalyticsUseCase, RebuildAnalyteTrendsUseCase, SearchMessagesUseCase,
+    ArchiveIdleConversationsUseCase, RepairConversationCountersUseCase, PurgeExpiredDataUseCase
+)
+from ..infrastructure.database import dispose_engines
+from ..infrastructure.shared_state import SharedStateStore
+from .server import PreforkServer
+
+def register_commands(app: Flask, export_blood_tests_use_case: ExportBloodTestsToParquetUseCase,
+                      cohort_analytics_use_case: CohortAnalyticsUseCase,
+                      rebuild_trends_use_case: RebuildAnalyteTrendsUseCase,
+                      search_messages_use_case: SearchMessagesUseCase,
+                      archive_conversations_use_case: ArchiveIdleConversationsUseCase,
+                      repair_counters_use_case: RepairConversationCountersUseCase,
+                      purge_expired_data_use_case: PurgeExpiredDataUseCase,
+                      shared_state: Optional[SharedStateStore] = None):
+    """Registra los comandos de la aplicación en app.cli"""
+    
+    @app.cli.command('export-blood-tests')
+    @click.option('--output', default=None,
+                  help='Directorio del dataset Parquet (por defecto PARQUET_EXPORT_DIR)')
+    @click.option('--full', is_flag=True,
+                  help='Reemplaza el dataset completo en lugar de exportar solo lo nuevo')
+    def export_blood_tests(output, full):
+        """Exportar exámenes de sangre a Parquet particionado por mes de test_date"""
+        output_dir = output or app.config['PARQUET_EXPORT_DIR']
+        try:
+            result = export_blood_tests_use_case.execute(output_dir, full=full)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        
+        click.echo(f"📦 {result['rows']} exámenes exportados a {output_dir}")
+        for partition, rows in sorted(result['partitions'].items()):
+            click.echo(f"   test_month={partition}: {rows}")
+        if result['watermark']:
+            click.echo(f"   Marca de agua: {result['watermark']}")
+    
+    @app.cli.command('rebuild-cohorts')
+    def rebuild_cohorts():
+        """Recalcular desde cero los agregados de riesgo por cohorte"""
+        patients = cohort_analytics_use_case.rebuild()
+        click.echo(f"📊 Agregados de cohortes reconstruidos con {patients} pacientes")
+    
+    @app.cli.command('rebuild-trends')
+    def rebuild_trends():
+        """Recalcular las tendencias por analito de todos los pacientes desde su historial"""
+        patients = rebuild_trends_use_case.execute()
+        click.echo(f"📈 Tendencias recalculadas para {patients} pacientes")
+    
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        """Indexar todos los mensajes existentes para la búsqueda de texto"""
+        messages = search_messages_use_case.rebuild_index()
+        backend = search_messages_use_case.search_repository.backend
+        click.echo(f"🔎 Índice de búsqueda ({backend}) con {messages} mensajes")
+    
+    @app.cli.command('repair-conversation-counters')
+    def repair_conversation_counters():
+        """Recalcular los contadores y la última actividad de las conversaciones"""
+        result = repair_counters_use_case.execute()
+        click.echo(f"💬 {result['conversations']} conversaciones revisadas, {result['corrected']} corregidas")
+    
+    @app.cli.command('archive-conversations')
+    @click.option('--idle-days', type=int, default=None,
+                  help='Días sin mensajes para archivar una conversación (por defecto ARCHIVE_IDLE_DAYS)')
+    @click.option('--max-batches', type=int, default=None,
+                  help='Detenerse tras este número de lotes (por defecto, hasta terminar)')
+    @click.option('--stats', 'show_stats', is_flag=True, help='Solo mostrar el tamaño del archivo')
+    def archive_conversations(idle_days, max_batches, show_stats):
+        """Archivar comprimidas las conversaciones inactivas (sale de chat_messages)"""
+        if not show_stats:
+            try:
+                result = archive_conversations_use_case.execute(idle_days=idle_days, max_batches=max_batches)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            click.echo(f"🗄️ {result['conversations']} conversaciones y {result['messages']} mensajes archivados "
+                       f"en {result['batches']} lotes (sin actividad desde {result['idle_before']})")
+        
+        stats = archive_conversations_use_case.stats()
+        ratio = f", {stats['compression_ratio']}x" if stats['compression_ratio'] else ''
+        click.echo(f"   Archivo: {stats['conversations']} conversaciones, {stats['messages']} mensajes, "
+                   f"{stats['raw_bytes']} → {stats['compressed_bytes']} bytes{ratio}")
+    
+    @app.cli.command('purge-expired-data')
+    @click.option('--message-days', type=int, default=None,
+                  help='Borrar los mensajes con más de estos días (por defecto RETENTION_MESSAGE_DAYS)')
+    @click.option('--inactive-user-days', type=int, default=None,
+                  help='Borrar los usuarios sin actividad en estos días (por defecto RETENTION_INACTIVE_USER_DAYS)')
+    @click.option('--max-seconds', type=float, default=None, help='Presupuesto de tiempo de la ejecución')
+    @click.option('--max-rows', type=int, default=None, help='Presupuesto de filas borradas de la ejecución')
+    @click.option('--quiet', is_flag=True, help='Solo mostrar el resumen final')
+    def purge_expired_data(message_days, inactive_user_days, max_seconds, max_rows, quiet):
+        """Aplicar las políticas de retención con borrados por lotes"""
+        def progress(phase, rows, report):
+            if not quiet:
+                click.echo(f"   {phase}: -{rows} filas (total {report['rows']})")
+        
+        try:
+            result = purge_expired_data_use_case.execute(
+                message_max_days=message_days,
+                inactive_user_days=inactive_user_days,
+                max_seconds=max_seconds,
+                max_rows=max_rows,
+                on_progress=progress
+            )
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        
+        click.echo(f"🧹 {result['rows']} filas borradas en {result['elapsed_seconds']} s: "
+                   f"{result['messages']} mensajes, {result['archived_conversations']} archivos de conversación, "
+                   f"{result['users']} usuarios ({result['user_rows']} filas)")
+        if not result['completed']:
+            click.echo("   Presupuesto agotado: vuelve a ejecutar el comando para continuar")
+    
+    @app.cli.command('serve')
+    @click.option('--host', default=None, help='Dirección de escucha (por defecto SERVE_HOST)')
+    @click.option('--port', type=int, default=None, help='Puerto (por defecto PORT)')
+    @click.option('--workers', type=int, default=None, help='Procesos worker (por defecto SERVE_WORKERS)')
+    @click.option('--threads', type=int, default=None, help='Peticiones simultáneas por worker (por defecto SERVE_THREADS)')
+    @click.option('--graceful-timeout', type=float, default=None,
+                  help='Segundos para terminar las peticiones en curso al detener un worker')
+    @click.option('--max-requests', type=int, default=None,
+                  help='Reciclar cada worker tras estas peticiones (0 = nunca)')
+    def serve(host, port, workers, threads, graceful_timeout, max_requests):
+        """Servidor de producción pre-fork con estado compartido entre workers"""
+        workers = workers or app.config['SERVE_WORKERS']
+        if workers > 1 and shared_state is None:
+            # Los límites de tasa y el control de admisión se crean con la aplicación: se vuelve a
+            # lanzar el mismo comando con SHARED_STATE_PATH para que los compartan todos los workers
+            os.environ['SHARED_STATE_PATH'] = os.path.join(app.instance_path, 'shared_state.db')
+            click.echo(f"🔗 Estado compartido entre workers en {os.environ['SHARED_STATE_PATH']}")
+            os.execv(sys.executable, [sys.executable, *_command_line()])
+        
+        def before_fork():
+            dispose_engines()
+            if shared_state is not None:
+                shared_state.reset_admission()
+        
+        def after_fork():
+            with app.app_context():
+                dispose_engines(close=False)
+        
+        PreforkServer(
+            app,
+            host or app.config['SERVE_HOST'],
+            port or app.config['SERVE_PORT'],
+            workers,
+            threads or app.config['SERVE_THREADS'],
+            graceful_timeout if graceful_timeout is not None else app.config['SERVE_GRACEFUL_TIMEOUT'],
+            max_requests if max_requests is not None else app.config['SERVE_MAX_REQUESTS'],
+            before_fork=before_fork,
+            after_fork=after_fork,
+            on_worker_exit=shared_state.forget_process if shared_state is not None else None
+        ).run()
+
+def _command_line():
+    """Argumentos con que se lanzó el comando, para volver a ejecutarlo con el intérprete actual"""
+    # Con python -m flask, sys.argv[0] es la ruta de flask/__main__.py: se vuelve a usar -m
+    spec = getattr(sys.modules['__main__'], '__spec__', None)
+    if spec is not None and spec.name:
+        module = spec.name[:-len('.__main__')] if spec.name.endswith('.__main__') else spec.name
+        return ['-m', module, *sys.argv[1:]]
+    return sys.argv
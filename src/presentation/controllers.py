@@ -1,17 +1,35 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 from flask_restx import Api, Resource, Namespace
 from .swagger_models import create_swagger_models
+from .security import is_admin_request
+from .serialization import response_marshaller, ndjson_response
+from .http_caching import conditional_get
+from .traffic_capture import register_traffic_capture
 from ..application.use_cases import (
     CreateUserUseCase, 
     AnalyzeBloodTestUseCase, 
     ChatWithUserUseCase, 
-    GetUserHistoryUseCase
+    GetUserHistoryUseCase,
+    BulkImportUseCase,
+    ExportUserRecordsUseCase,
+    CohortAnalyticsUseCase,
+    SearchMessagesUseCase
 )
+from ..application.schemas import CreateUserRequest, AnalyzeBloodTestRequest, ChatMessageRequest, BulkImportRequest
+from ..infrastructure.profiling import ProfileStore
+from ..infrastructure.reference_ranges import ReferenceRangeRegistry
+from ..infrastructure.traffic_capture import TrafficCaptureLog
 
-def create_api(app: Flask, user_controller_factory, chat_controller_factory):
+def create_api(app: Flask, user_controller_factory, chat_controller_factory, admin_controller_factory=None,
+               analytics_controller_factory=None, search_controller_factory=None,
+               traffic_capture_log: TrafficCaptureLog = None):
     """Crear la API con Swagger/OpenAPI"""
     
+    # Captura anonimizada del tráfico de /api para reproducirlo (benchmarks/replay.py)
+    if traffic_capture_log is not None:
+        register_traffic_capture(app, traffic_capture_log)
+    
     # Configurar Flask-RESTX
     api = Api(
         app,
@@ -25,10 +43,16 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     # Crear modelos de Swagger
     models = create_swagger_models(api)
     
+    # marshal_with o serializador precompilado (FAST_JSON_RESPONSES)
+    marshal = response_marshaller(app.config.get('FAST_JSON_RESPONSES', False))
+    
     # Crear namespaces
     users_ns = Namespace('users', description='Operaciones de usuarios')
     chat_ns = Namespace('chat', description='Operaciones de chat y análisis médico')
     health_ns = Namespace('health', description='Estado de la API')
+    analytics_ns = Namespace('analytics', description='Indicadores agregados de la población de pacientes')
+    admin_ns = Namespace('admin', description='Operaciones de administración (requiere X-Admin-Token)')
+    search_ns = Namespace('search', description='Búsqueda de texto en las conversaciones (requiere X-Admin-Token)')
     
     # Registrar namespaces
     api.add_namespace(users_ns)
@@ -38,6 +62,9 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     # Obtener controladores
     user_controller = user_controller_factory()
     chat_controller = chat_controller_factory()
+    admin_controller = admin_controller_factory() if admin_controller_factory else None
+    analytics_controller = analytics_controller_factory() if analytics_controller_factory else None
+    search_controller = search_controller_factory() if search_controller_factory else None
     
     # === ENDPOINTS DE USUARIOS ===
     
@@ -45,32 +72,45 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     class UserList(Resource):
         @users_ns.doc('create_user')
         @users_ns.expect(models['user_input'])
-        @users_ns.marshal_with(models['success_response'], code=201)
+        @marshal(users_ns, models['success_response'], code=201)
         @users_ns.response(400, 'Datos inválidos', models['error_response'])
         def post(self):
             """Crear un nuevo usuario"""
             try:
-                data = request.get_json()
+                # Validar datos con el esquema
+                user_request = CreateUserRequest.parse(request.get_json(silent=True))
                 
-                # Validar datos requeridos
-                required_fields = ['name', 'age', 'gender']
-                for field in required_fields:
-                    if field not in data:
-                        return {'error': f'Campo requerido: {field}'}, 400
+                # Crear usuario
+                result = user_controller.create_user_logic(user_request)
                 
-                # Validar tipos de datos
-                if not isinstance(data['age'], (int, float)) or data['age'] <= 0:
-                    return {'error': 'La edad debe ser un número positivo'}, 400
+                return {
+                    'success': True,
+                    'message': 'Usuario creado exitosamente',
+                    'data': result
+                }, 201
                 
-                if data['gender'].lower() not in ['male', 'female', 'masculino', 'femenino']:
-                    return {'error': 'Género debe ser male/female o masculino/femenino'}, 400
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            except Exception as e:
+                return {'error': 'Error interno del servidor'}, 500
+    
+    @users_ns.route('/bulk')
+    class UserBulkImport(Resource):
+        @users_ns.doc('bulk_import_users')
+        @users_ns.expect(models['bulk_import_input'])
+        @marshal(users_ns, models['success_response'], code=201)
+        @users_ns.response(400, 'Datos inválidos', models['error_response'])
+        def post(self):
+            """Importar usuarios y exámenes de sangre en bloque"""
+            try:
+                # Validar todos los registros con el esquema
+                import_request = BulkImportRequest.parse(request.get_json(silent=True))
                 
-                # Crear usuario
-                result = user_controller.create_user_logic(data)
+                result = user_controller.bulk_import_logic(import_request)
                 
                 return {
                     'success': True,
-                    'message': 'Usuario creado exitosamente',
+                    'message': 'Importación completada exitosamente',
                     'data': result
                 }, 201
                 
@@ -82,7 +122,9 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     @users_ns.route('/<string:user_id>/history')
     class UserHistory(Resource):
         @users_ns.doc('get_user_history')
-        @users_ns.marshal_with(models['success_response'])
+        @users_ns.response(304, 'El historial no cambió desde el ETag / fecha indicados')
+        @conditional_get(lambda user_id: user_controller.get_user_history_version_logic(user_id))
+        @marshal(users_ns, models['success_response'])
         @users_ns.response(400, 'ID de usuario inválido', models['error_response'])
         @users_ns.response(404, 'Usuario no encontrado', models['error_response'])
         def get(self, user_id):
@@ -104,46 +146,38 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
             except Exception as e:
                 return {'error': 'Error interno del servidor'}, 500
     
+    @users_ns.route('/<string:user_id>/export')
+    class UserExport(Resource):
+        @users_ns.doc('export_user', produces=['application/x-ndjson'])
+        @users_ns.response(200, 'Expediente en NDJSON: un registro por línea (user, blood_test, conversation, message)')
+        @users_ns.response(404, 'Usuario no encontrado', models['error_response'])
+        def get(self, user_id):
+            """Exportar el expediente completo de un usuario, incluidos los mensajes"""
+            try:
+                records = user_controller.export_user_logic(user_id)
+            except ValueError as e:
+                return {'error': str(e)}, 404
+            except Exception as e:
+                return {'error': 'Error interno del servidor'}, 500
+            
+            return ndjson_response(records, f'user-{user_id}.ndjson')
+    
     # === ENDPOINTS DE CHAT ===
     
     @chat_ns.route('/analyze')
     class BloodTestAnalysis(Resource):
         @chat_ns.doc('analyze_blood_test')
         @chat_ns.expect(models['blood_test_input'])
-        @chat_ns.marshal_with(models['success_response'])
+        @marshal(chat_ns, models['success_response'])
         @chat_ns.response(400, 'Datos de examen inválidos', models['error_response'])
         def post(self):
             """Analizar examen de sangre y crear conversación inicial con el chatbot"""
             try:
-                data = request.get_json()
-                
-                # Validar datos requeridos
-                if 'user_id' not in data:
-                    return {'error': 'Campo requerido: user_id'}, 400
-                
-                # Validar que al menos algunos valores de examen estén presentes
-                blood_test_fields = [
-                    'glucose', 'cholesterol', 'hdl_cholesterol', 'ldl_cholesterol',
-                    'triglycerides', 'hemoglobin', 'hematocrit', 'white_blood_cells',
-                    'red_blood_cells', 'platelets', 'creatinine', 'urea'
-                ]
-                
-                present_fields = [field for field in blood_test_fields if field in data]
-                if len(present_fields) < 3:
-                    return {'error': 'Se requieren al menos 3 valores de examen de sangre'}, 400
-                
-                # Validar user_id (ya no necesita ser UUID)
-                user_id = data['user_id']
-                if not isinstance(user_id, str) or not user_id.strip():
-                    return {'error': 'user_id debe ser una cadena válida'}, 400
-                
-                # Validar valores numéricos
-                for field in present_fields:
-                    if not isinstance(data[field], (int, float)) or data[field] < 0:
-                        return {'error': f'{field} debe ser un número positivo'}, 400
+                # Validar user_id y valores de examen con el esquema
+                blood_test_request = AnalyzeBloodTestRequest.parse(request.get_json(silent=True))
                 
                 # Analizar examen
-                result = chat_controller.analyze_blood_test_logic(user_id, data)
+                result = chat_controller.analyze_blood_test_logic(blood_test_request)
                 
                 return {
                     'success': True,
@@ -160,27 +194,21 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     class ChatMessage(Resource):
         @chat_ns.doc('send_chat_message')
         @chat_ns.expect(models['chat_message_input'])
-        @chat_ns.marshal_with(models['success_response'])
+        @marshal(chat_ns, models['success_response'])
         @chat_ns.response(400, 'Mensaje inválido', models['error_response'])
         @chat_ns.response(404, 'Conversación no encontrada', models['error_response'])
         def post(self, conversation_id):
             """Enviar mensaje al chatbot en una conversación existente"""
             try:
-                data = request.get_json()
-                
-                # Validar datos requeridos
-                if 'message' not in data:
-                    return {'error': 'Campo requerido: message'}, 400
-                
-                if not data['message'].strip():
-                    return {'error': 'El mensaje no puede estar vacío'}, 400
+                # Validar mensaje con el esquema
+                message_request = ChatMessageRequest.parse(request.get_json(silent=True))
                 
                 # Validar conversation_id
-                if not isinstance(conversation_id, str) or not conversation_id.strip():
+                if not conversation_id.strip():
                     return {'error': 'conversation_id debe ser una cadena válida'}, 400
                 
                 # Procesar mensaje
-                result = chat_controller.chat_message_logic(conversation_id, data['message'])
+                result = chat_controller.chat_message_logic(conversation_id, message_request)
                 
                 return {
                     'success': True,
@@ -197,7 +225,7 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
     @health_ns.route('')
     class HealthCheck(Resource):
         @health_ns.doc('health_check')
-        @health_ns.marshal_with(models['health_response'])
+        @marshal(health_ns, models['health_response'])
         def get(self):
             """Verificar el estado de la API"""
             return {
@@ -205,23 +233,178 @@ def create_api(app: Flask, user_controller_factory, chat_controller_factory):
                 'message': 'Medical Chatbot API is running'
             }, 200
     
+    # === ENDPOINTS DE ANALÍTICA ===
+    
+    if analytics_controller is not None:
+        api.add_namespace(analytics_ns)
+        
+        @analytics_ns.route('/cohorts')
+        class CohortRisk(Resource):
+            @analytics_ns.doc('cohort_risk')
+            @marshal(analytics_ns, models['success_response'])
+            def get(self):
+                """Distribución de niveles y factores de riesgo por banda de edad y género"""
+                try:
+                    return {
+                        'success': True,
+                        'data': analytics_controller.cohort_risk_logic()
+                    }, 200
+                except Exception as e:
+                    return {'error': 'Error interno del servidor'}, 500
+    
+    # === ENDPOINTS DE BÚSQUEDA ===
+    
+    if search_controller is not None:
+        api.add_namespace(search_ns)
+        
+        @search_ns.route('/messages')
+        class MessageSearch(Resource):
+            @search_ns.doc('search_messages', params={
+                'q': 'Texto a buscar; "insul*" busca por prefijo',
+                'user_id': 'Limitar a las conversaciones de un usuario (opcional)',
+                'page': 'Página, desde 1 (por defecto 1)',
+                'per_page': 'Resultados por página (por defecto 20, máximo 100)'
+            })
+            @marshal(search_ns, models['success_response'])
+            @search_ns.response(400, 'Consulta inválida', models['error_response'])
+            @search_ns.response(403, 'Acceso denegado', models['error_response'])
+            def get(self):
+                """Buscar mensajes por texto, ordenados por relevancia y con fragmentos resaltados"""
+                if not is_admin_request():
+                    return {'error': 'Acceso denegado'}, 403
+                
+                try:
+                    return {
+                        'success': True,
+                        'data': search_controller.search_messages_logic(
+                            request.args.get('q', ''),
+                            request.args.get('page', 1, type=int),
+                            request.args.get('per_page', 20, type=int),
+                            request.args.get('user_id')
+                        )
+                    }, 200
+                except ValueError as e:
+                    return {'error': str(e)}, 400
+                except Exception as e:
+                    return {'error': 'Error interno del servidor'}, 500
+    
+    if admin_controller is None:
+        return api
+    
+    # === ENDPOINTS DE ADMINISTRACIÓN ===
+    
+    api.add_namespace(admin_ns)
+    
+    @admin_ns.route('/profiles')
+    class ProfileList(Resource):
+        @admin_ns.doc('list_profiles')
+        @marshal(admin_ns, models['success_response'])
+        @admin_ns.response(403, 'Acceso denegado', models['error_response'])
+        def get(self):
+            """Listar los perfiles de peticiones guardados"""
+            if not is_admin_request():
+                return {'error': 'Acceso denegado'}, 403
+            
+            return {
+                'success': True,
+                'data': admin_controller.list_profiles_logic()
+            }, 200
+    
+    @admin_ns.route('/profiles/<string:profile_id>')
+    class ProfileDownload(Resource):
+        @admin_ns.doc('download_profile', params={'format': 'pstats (por defecto) o text'})
+        @admin_ns.response(403, 'Acceso denegado', models['error_response'])
+        @admin_ns.response(404, 'Perfil no encontrado', models['error_response'])
+        def get(self, profile_id):
+            """Descargar un perfil en formato pstats o como resumen de texto"""
+            if not is_admin_request():
+                return {'error': 'Acceso denegado'}, 403
+            
+            if request.args.get('format') == 'text':
+                summary = admin_controller.profile_summary_logic(profile_id)
+                if summary is None:
+                    return {'error': 'Perfil no encontrado'}, 404
+                return Response(summary, mimetype='text/plain')
+            
+            path = admin_controller.profile_path_logic(profile_id)
+            if path is None:
+                return {'error': 'Perfil no encontrado'}, 404
+            return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                             download_name=f'{profile_id}.pstats')
+    
+    @admin_ns.route('/export')
+    class ExportAll(Resource):
+        @admin_ns.doc('export_all_users', produces=['application/x-ndjson'])
+        @admin_ns.response(200, 'Expedientes de todos los usuarios en NDJSON')
+        @admin_ns.response(403, 'Acceso denegado', models['error_response'])
+        def get(self):
+            """Exportar el expediente completo de todos los usuarios"""
+            if not is_admin_request():
+                return {'error': 'Acceso denegado'}, 403
+            
+            return ndjson_response(admin_controller.export_all_logic(), 'users.ndjson')
+    
+    @admin_ns.route('/reference-ranges')
+    class ReferenceRanges(Resource):
+        @admin_ns.doc('reference_ranges_status')
+        @marshal(admin_ns, models['success_response'])
+        @admin_ns.response(403, 'Acceso denegado', models['error_response'])
+        def get(self):
+            """Versión del ruleset de rangos de referencia vigente"""
+            if not is_admin_request():
+                return {'error': 'Acceso denegado'}, 403
+            
+            return {
+                'success': True,
+                'data': admin_controller.reference_ranges_logic()
+            }, 200
+        
+        @admin_ns.doc('reload_reference_ranges')
+        @marshal(admin_ns, models['success_response'])
+        @admin_ns.response(403, 'Acceso denegado', models['error_response'])
+        def post(self):
+            """Recargar el ruleset desde su archivo sin esperar la revisión periódica"""
+            if not is_admin_request():
+                return {'error': 'Acceso denegado'}, 403
+            
+            return {
+                'success': True,
+                'data': admin_controller.reload_reference_ranges_logic()
+            }, 200
+    
     return api
 
 class UserController:
     """Controlador para operaciones de usuarios"""
     
     def __init__(self, create_user_use_case: CreateUserUseCase, 
-                 get_user_history_use_case: GetUserHistoryUseCase):
+                 get_user_history_use_case: GetUserHistoryUseCase,
+                 bulk_import_use_case: BulkImportUseCase,
+                 export_user_records_use_case: ExportUserRecordsUseCase):
         self.create_user_use_case = create_user_use_case
         self.get_user_history_use_case = get_user_history_use_case
+        self.bulk_import_use_case = bulk_import_use_case
+        self.export_user_records_use_case = export_user_records_use_case
     
-    def create_user_logic(self, data):
+    def create_user_logic(self, user_request):
         """Lógica para crear usuario"""
-        return self.create_user_use_case.execute(data)
+        return self.create_user_use_case.execute(user_request)
+    
+    def bulk_import_logic(self, import_request):
+        """Lógica para importar usuarios en bloque"""
+        return self.bulk_import_use_case.execute(import_request)
     
     def get_user_history_logic(self, user_uuid):
         """Lógica para obtener historial de usuario"""
         return self.get_user_history_use_case.execute(user_uuid)
+    
+    def get_user_history_version_logic(self, user_uuid):
+        """Lógica para obtener la versión del historial de usuario"""
+        return self.get_user_history_use_case.get_version(user_uuid)
+    
+    def export_user_logic(self, user_uuid):
+        """Lógica para exportar el expediente de un usuario"""
+        return self.export_user_records_use_case.execute(user_uuid)
 
 class ChatController:
     """Controlador para operaciones de chat"""
@@ -231,10 +414,65 @@ class ChatController:
         self.analyze_blood_test_use_case = analyze_blood_test_use_case
         self.chat_with_user_use_case = chat_with_user_use_case
     
-    def analyze_blood_test_logic(self, user_uuid, data):
+    def analyze_blood_test_logic(self, blood_test_request):
         """Lógica para analizar examen de sangre"""
-        return self.analyze_blood_test_use_case.execute(user_uuid, data)
+        return self.analyze_blood_test_use_case.execute(blood_test_request)
     
-    def chat_message_logic(self, conversation_uuid, message):
+    def chat_message_logic(self, conversation_uuid, message_request):
         """Lógica para procesar mensaje de chat"""
-        return self.chat_with_user_use_case.execute(conversation_uuid, message)
+        return self.chat_with_user_use_case.execute(conversation_uuid, message_request)
+
+class AdminController:
+    """Controlador para operaciones de administración"""
+    
+    def __init__(self, profile_store: ProfileStore,
+                 export_user_records_use_case: ExportUserRecordsUseCase,
+                 reference_ranges: ReferenceRangeRegistry):
+        self.profile_store = profile_store
+        self.export_user_records_use_case = export_user_records_use_case
+        self.reference_ranges = reference_ranges
+    
+    def list_profiles_logic(self):
+        """Lógica para listar perfiles"""
+        return self.profile_store.list()
+    
+    def profile_path_logic(self, profile_id):
+        """Lógica para ubicar el archivo pstats de un perfil"""
+        return self.profile_store.stats_path(profile_id)
+    
+    def profile_summary_logic(self, profile_id):
+        """Lógica para resumir un perfil"""
+        return self.profile_store.summary(profile_id)
+    
+    def export_all_logic(self):
+        """Lógica para exportar todos los usuarios"""
+        return self.export_user_records_use_case.execute_all()
+    
+    def reference_ranges_logic(self):
+        """Lógica para consultar el ruleset vigente"""
+        return self.reference_ranges.status()
+    
+    def reload_reference_ranges_logic(self):
+        """Lógica para recargar el ruleset"""
+        reloaded = self.reference_ranges.reload(force=True)
+        return {'reloaded': reloaded, **self.reference_ranges.status()}
+
+class SearchController:
+    """Controlador para la búsqueda de mensajes"""
+    
+    def __init__(self, search_messages_use_case: SearchMessagesUseCase):
+        self.search_messages_use_case = search_messages_use_case
+    
+    def search_messages_logic(self, query, page, per_page, user_id):
+        """Lógica para buscar mensajes"""
+        return self.search_messages_use_case.execute(query, page, per_page, user_id)
+
+class AnalyticsController:
+    """Controlador para indicadores agregados"""
+    
+    def __init__(self, cohort_analytics_use_case: CohortAnalyticsUseCase):
+        self.cohort_analytics_use_case = cohort_analytics_use_case
+    
+    def cohort_risk_logic(self):
+        """Lógica para obtener el riesgo por cohortes"""
+        return self.cohort_analytics_use_case.execute()
@@ -0,0 +1,83 @@
+"""
+GET condicional (ETag / Last-Modified) y compresión negociada de respuestas
+"""
+import gzip
+from functools import wraps
+from flask import Flask, Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional; sin él solo se ofrece gzip
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = frozenset({'application/json', 'text/plain', 'text/html', 'application/x-ndjson'})
+
+def conditional_get(resolve_version):
+    """
+    Responde 304 Not Modified cuando el cliente ya tiene la versión actual.
+    ``resolve_version(**view_args)`` devuelve (versión, última modificación) o None.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            validator = resolve_version(**kwargs)
+            if validator is None:
+                return func(*args, **kwargs)
+
+            version, last_modified = validator
+            etag = f'v{version}'
+            headers = {'ETag': f'W/"{etag}"', 'Cache-Control': 'private, no-cache'}
+            if last_modified is not None:
+                headers['Last-Modified'] = last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+            if _is_not_modified(etag, last_modified):
+                return Response(status=304, headers=headers)
+
+            result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                result.headers.update(headers)
+                return result
+            if isinstance(result, tuple):
+                data, status, *rest = result
+                return data, status, {**(rest[0] if rest else {}), **headers}
+            return result, 200, headers
+        return wrapper
+    return decorator
+
+def _is_not_modified(etag: str, last_modified) -> bool:
+    # If-None-Match tiene prioridad sobre If-Modified-Since (RFC 9110)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def register_compression(app: Flask):
+    """Comprimir con brotli o gzip las respuestas grandes según Accept-Encoding"""
+    min_size = app.config.get('COMPRESSION_MIN_SIZE', 1024)
+    encodings = (['br'] if brotli is not None else []) + ['gzip']
+
+    @app.after_request
+    def compress_response(response):
+        if (not 200 <= response.status_code < 300 or response.status_code in (204, 206)
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=4)
+        else:
+            compressed = gzip.compress(data, compresslevel=5)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        return response
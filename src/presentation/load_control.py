@@ -0,0 +1,60 @@
+from typing import Callable, Optional
+from flask import Flask, g, jsonify, request
+from ..infrastructure.metrics import http_requests_rejected_total
+from ..infrastructure.rate_limiting import SlidingWindowRateLimiter, AdmissionController
+
+# Rutas que dependen del LLM: limitadas por usuario/IP y sujetas al control de admisión.
+# El resto (salud, historial, métricas, administración) sigue respondiendo bajo sobrecarga.
+LLM_BOUND_ROUTES = frozenset({
+    '/api/chat/analyze',
+    '/api/chat/<string:conversation_id>/message'
+})
+
+def register_load_control(app: Flask,
+                          user_limiter: SlidingWindowRateLimiter,
+                          ip_limiter: SlidingWindowRateLimiter,
+                          admission: AdmissionController,
+                          resolve_conversation_owner: Callable[[str], Optional[str]]):
+    """Límites de tasa por usuario e IP y descarte de carga en las rutas costosas"""
+
+    def reject(route: str, reason: str, status: int, message: str, retry_after: int):
+        http_requests_rejected_total.inc(route=route, reason=reason)
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def user_key() -> Optional[str]:
+        conversation_id = (request.view_args or {}).get('conversation_id')
+        if conversation_id is not None:
+            return resolve_conversation_owner(conversation_id) or f'conversation:{conversation_id}'
+        data = request.get_json(silent=True)
+        user_id = data.get('user_id') if isinstance(data, dict) else None
+        return user_id if isinstance(user_id, str) else None
+
+    @app.before_request
+    def enforce_load_limits():
+        route = request.url_rule.rule if request.url_rule else None
+        if route not in LLM_BOUND_ROUTES:
+            return None
+
+        allowed, retry_after = ip_limiter.hit(f'ip:{request.remote_addr}')
+        if not allowed:
+            return reject(route, 'ip_rate_limit', 429, 'Demasiadas solicitudes desde esta IP', retry_after)
+
+        user_id = user_key()
+        if user_id is not None:
+            allowed, retry_after = user_limiter.hit(f'user:{user_id}')
+            if not allowed:
+                return reject(route, 'user_rate_limit', 429, 'Demasiadas solicitudes para este usuario', retry_after)
+
+        if not admission.try_acquire():
+            return reject(route, 'overloaded', 503, 'Servicio sobrecargado, intenta de nuevo más tarde',
+                          admission.retry_after_seconds)
+        g.llm_admitted = True
+        return None
+
+    @app.teardown_request
+    def release_admission(error=None):
+        if g.pop('llm_admitted', False):
+            admission.release()
@@ -0,0 +1,93 @@
+from datetime import datetime
+from time import perf_counter
+from flask import Flask, Response, g, request
+from sqlalchemy.engine import Engine
+from ..infrastructure.metrics import registry, http_request_duration, http_requests_total
+from ..infrastructure.tracing import tracer, JsonlSpanExporter, parse_trace_headers, register_sql_tracing
+from ..infrastructure.profiling import RequestProfiler
+from .security import is_admin_request
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PROFILE_REQUEST_HEADER = 'X-Profile-Request'
+
+def register_monitoring(app: Flask):
+    """Registrar métricas y trazas de las peticiones HTTP y el endpoint /metrics"""
+
+    if app.config.get('TRACING_ENABLED'):
+        tracer.configure(
+            JsonlSpanExporter(app.config['TRACE_EXPORT_PATH']),
+            sample_rate=app.config['TRACE_SAMPLE_RATE'],
+            slow_threshold_ms=app.config['TRACE_SLOW_THRESHOLD_MS']
+        )
+        register_sql_tracing(Engine)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = perf_counter()
+        if tracer.enabled:
+            trace_id, parent_span_id, sampled = parse_trace_headers(request.headers)
+            g.trace_root = tracer.start_trace(
+                f'{request.method} {request.path}',
+                trace_id=trace_id,
+                parent_span_id=parent_span_id,
+                sampled=sampled,
+                **{'http.method': request.method, 'http.target': request.path}
+            )
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('request_start', None)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if start is not None:
+            labels = {'method': request.method, 'route': route, 'status': str(response.status_code)}
+            http_request_duration.observe(perf_counter() - start, **labels)
+            http_requests_total.inc(**labels)
+        root = g.get('trace_root')
+        if root is not None:
+            root.set_attribute('http.route', route)
+            root.set_attribute('http.status_code', response.status_code)
+            response.headers['X-Trace-Id'] = root.trace_id
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(error=None):
+        root = g.pop('trace_root', None)
+        if root is not None:
+            tracer.end_trace(root, error)
+
+    @app.route('/metrics')
+    def metrics():
+        """Métricas en formato de texto de Prometheus"""
+        return Response(registry.render(), mimetype=None, content_type=PROMETHEUS_CONTENT_TYPE)
+
+def register_profiling(app: Flask, profiler: RequestProfiler):
+    """Perfilar peticiones con cProfile por muestreo o a pedido de un administrador"""
+
+    @app.before_request
+    def start_request_profile():
+        forced = request.headers.get(PROFILE_REQUEST_HEADER, '').lower() == 'true' and is_admin_request()
+        if profiler.should_profile(forced):
+            g.request_profile = profiler.start()
+            g.request_profile_start = perf_counter()
+
+    @app.after_request
+    def finish_request_profile(response):
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profile_id = profiler.finish(profile, {
+                'method': request.method,
+                'path': request.path,
+                'route': request.url_rule.rule if request.url_rule else None,
+                'status': response.status_code,
+                'duration_ms': round((perf_counter() - g.pop('request_profile_start')) * 1000, 3),
+                'trace_id': tracer.current_trace_id(),
+                'created_at': datetime.utcnow().isoformat()
+            })
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def discard_request_profile(error=None):
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profile.disable()
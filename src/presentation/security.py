@@ -0,0 +1,12 @@
+import hmac
+from flask import current_app, request
+
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+def is_admin_request() -> bool:
+    """Verifica la cabecera de administrador; sin ADMIN_TOKEN configurado nadie es administrador"""
+    expected = current_app.config.get('ADMIN_TOKEN')
+    provided = request.headers.get(ADMIN_TOKEN_HEADER, '')
+    if not expected or not provided:
+        return False
+    return hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
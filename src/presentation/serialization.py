@@ -0,0 +1,122 @@
+"""
+Serialización rápida de respuestas: compila el modelo de Swagger una sola vez y
+serializa con orjson en lugar de recorrer los campos con marshal_with en cada petición
+"""
+import json
+from typing import Any, Callable, Iterable, Optional
+from functools import wraps
+from flask import Response, stream_with_context
+from flask_restx import fields
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional; sin él se usa json de la librería estándar
+    orjson = None
+
+Serializer = Callable[[Any], Any]
+
+
+def dumps(data: Any) -> bytes:
+    """Serializa a JSON con orjson si está disponible"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compile_model(model) -> Serializer:
+    """Convierte un modelo de flask-restx en una función que proyecta sus campos"""
+    plan = []
+    for name, field in model.items():
+        attribute = field.attribute if isinstance(field.attribute, str) else name
+        default = getattr(field, 'default', None)
+        plan.append((name, attribute, default, _compile_field(field)))
+
+    def serialize(obj):
+        if obj is None:
+            return None
+        get = obj.get if isinstance(obj, dict) else (lambda key, _obj=obj: getattr(_obj, key, None))
+        result = {}
+        for name, attribute, default, convert in plan:
+            value = get(attribute)
+            if value is None:
+                result[name] = default
+            else:
+                result[name] = convert(value) if convert is not None else value
+        return result
+
+    return serialize
+
+
+def _compile_field(field) -> Optional[Serializer]:
+    if isinstance(field, fields.Nested):
+        return compile_model(field.nested)
+    if isinstance(field, fields.List):
+        convert = _compile_field(field.container)
+        if convert is None:
+            return list
+        return lambda values: [convert(value) if value is not None else None for value in values]
+    # Campos primitivos y Raw: el valor ya es serializable
+    return None
+
+
+def response_marshaller(fast: bool):
+    """
+    Devuelve un decorador equivalente a ``ns.marshal_with``. En modo rápido conserva la
+    documentación de Swagger pero serializa con el modelo precompilado.
+    """
+
+    def marshal(ns, model, code: int = 200, description: Optional[str] = None):
+        if not fast:
+            return ns.marshal_with(model, code=code, description=description)
+
+        serialize = compile_model(model)
+        document = ns.response(code, description, model)
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                result = func(*args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+                headers = None
+                status = 200
+                if isinstance(result, tuple):
+                    data, status, *rest = result
+                    headers = rest[0] if rest else None
+                else:
+                    data = result
+                return Response(dumps(serialize(data)), status=status, headers=headers,
+                                mimetype='application/json')
+            return document(wrapper)
+        return decorator
+
+    return marshal
+
+
+# Tamaño aproximado de cada fragmento enviado en las respuestas NDJSON (bytes)
+NDJSON_CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_response(records: Iterable[Any], filename: Optional[str] = None) -> Response:
+    """
+    Respuesta en streaming con un objeto JSON por línea. Los registros se serializan a
+    medida que se generan y se envían agrupados en fragmentos de ~64 KB
+    """
+    def generate():
+        chunk = []
+        size = 0
+        for record in records:
+            line = dumps(record) + b'\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= NDJSON_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b''.join(chunk)
+
+    # El contexto de la petición (y la sesión de base de datos) sigue activo mientras se envía
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if filename:
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,251 @@
+"""
+Servidor de producción pre-fork (flask --app app serve).
+
+El proceso maestro crea la aplicación una sola vez, abre el socket y hace fork de N workers:
+los módulos importados, los modelos de Swagger y el ruleset de rangos compilado quedan en
+páginas compartidas (copy-on-write) en lugar de reconstruirse en cada worker. Cada worker
+atiende el socket común con un servidor WSGI de hilos acotados.
+
+Señales del maestro:
+    SIGTERM / SIGINT  parada ordenada: los workers terminan las peticiones en curso
+    SIGHUP            reinicio gradual: arranca workers nuevos y luego detiene los viejos
+"""
+import gc
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import traceback
+from typing import Callable, Dict, Optional
+
+from werkzeug.serving import ThreadedWSGIServer
+
+
+class _BoundedThreadedWSGIServer(ThreadedWSGIServer):
+    """
+    Servidor WSGI con un hilo por petición y como máximo max_threads a la vez. Solo acepta una
+    conexión cuando tiene un hilo libre: con todos ocupados la deja en la cola del socket común
+    y la acepta otro worker.
+    """
+
+    daemon_threads = False  # server_close espera a las peticiones en curso
+    slot_wait = 0.5  # espera máxima por un hilo libre antes de volver a revisar shutdown()
+
+    def __init__(self, *args, max_threads: int, max_requests: int = 0, on_limit: Callable[[], None] = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        # Todos los workers despiertan con cada conexión: los que no la obtienen no deben
+        # quedarse bloqueados en accept()
+        self.socket.setblocking(False)
+        self._slots = threading.BoundedSemaphore(max_threads)
+        self._max_requests = max_requests
+        self._handled = 0
+        self._on_limit = on_limit
+
+    def _handle_request_noblock(self):
+        # El hilo se reserva antes de accept(), no después
+        if not self._slots.acquire(timeout=self.slot_wait):
+            return
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            # Otro worker aceptó la conexión antes
+            self._slots.release()
+            return
+        if not self.verify_request(request, client_address):
+            self.shutdown_request(request)
+            self._slots.release()
+            return
+        try:
+            self.process_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            self._slots.release()
+        except BaseException:
+            self.shutdown_request(request)
+            self._slots.release()
+            raise
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        request.setblocking(True)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        super().process_request(request, client_address)
+        self._handled += 1
+        if self._max_requests and self._handled == self._max_requests and self._on_limit is not None:
+            self._on_limit()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
+class PreforkServer:
+    """Proceso maestro: mantiene N workers vivos sobre un socket compartido"""
+
+    def __init__(self, app, host: str, port: int, workers: int, threads: int = 16,
+                 graceful_timeout: float = 30.0, max_requests: int = 0, backlog: int = 2048,
+                 before_fork: Optional[Callable[[], None]] = None,
+                 after_fork: Optional[Callable[[], None]] = None,
+                 on_worker_exit: Optional[Callable[[int], None]] = None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.max_requests = max_requests
+        self.backlog = backlog
+        self.before_fork = before_fork
+        self.after_fork = after_fork
+        self.on_worker_exit = on_worker_exit
+        self._socket: Optional[socket.socket] = None
+        self._children: Dict[int, int] = {}  # pid -> generación
+        self._stopping_since: Dict[int, float] = {}  # pid -> momento en que se le pidió terminar
+        self._generation = 0
+        self._stop_requested = False
+        self._reload_requested = False
+        self._respawn_after = 0.0
+
+    # === MAESTRO ===
+
+    def run(self) -> None:
+        self._socket = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self._socket.set_inheritable(True)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        print(f"🚀 Servidor pre-fork en http://{self.host}:{self.port} "
+              f"({self.workers} workers x {self.threads} hilos, maestro {os.getpid()})")
+
+        if self.before_fork is not None:
+            self.before_fork()
+        # Los objetos creados hasta aquí no vuelven a recorrerse en el GC de los workers:
+        # sus páginas siguen compartidas en lugar de copiarse al actualizar los contadores del GC
+        gc.freeze()
+        try:
+            self._spawn_generation()
+            while self._children:
+                self._reap()
+                if self._stop_requested:
+                    self._stop_all()
+                elif self._reload_requested:
+                    self._reload_requested = False
+                    self._rolling_restart()
+                else:
+                    self._replace_missing()
+                self._kill_overdue()
+                time.sleep(0.1)
+        finally:
+            self._socket.close()
+            print("👋 Servidor detenido")
+
+    def _request_stop(self, signum, frame) -> None:
+        self._stop_requested = True
+
+    def _request_reload(self, signum, frame) -> None:
+        self._reload_requested = True
+
+    def _spawn_generation(self) -> None:
+        self._generation += 1
+        for _ in range(self.workers):
+            self._spawn_worker()
+
+    def _spawn_worker(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._children[pid] = self._generation
+
+    def _reap(self) -> None:
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            self._children.pop(pid, None)
+            self._stopping_since.pop(pid, None)
+            if self.on_worker_exit is not None:
+                self.on_worker_exit(pid)
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            if code != 0 and not self._stop_requested:
+                print(f"⚠️ El worker {pid} terminó con código {code}")
+                # Pausa antes de reemplazarlo para no entrar en un ciclo de fallos inmediatos
+                self._respawn_after = time.monotonic() + 1.0
+
+    def _replace_missing(self) -> None:
+        # Reemplaza a los workers de la generación actual que murieron o se reciclaron
+        if time.monotonic() < self._respawn_after:
+            return
+        alive = sum(1 for generation in self._children.values() if generation == self._generation)
+        for _ in range(self.workers - alive):
+            self._spawn_worker()
+
+    def _rolling_restart(self) -> None:
+        old = [pid for pid, generation in self._children.items() if generation == self._generation]
+        print(f"🔄 Reinicio gradual: {len(old)} workers")
+        self._spawn_generation()
+        for pid in old:
+            self._terminate(pid)
+
+    def _stop_all(self) -> None:
+        for pid in list(self._children):
+            if pid not in self._stopping_since:
+                self._terminate(pid)
+
+    def _terminate(self, pid: int) -> None:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        self._stopping_since[pid] = time.monotonic()
+
+    def _kill_overdue(self) -> None:
+        now = time.monotonic()
+        for pid, since in list(self._stopping_since.items()):
+            if now - since > self.graceful_timeout:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self._stopping_since.pop(pid, None)
+
+    # === WORKER ===
+
+    def _run_worker(self) -> None:
+        # Ctrl+C llega a todo el grupo de procesos: el worker espera la orden del maestro
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        random.seed()
+        if self.after_fork is not None:
+            self.after_fork()
+
+        # Reciclar con algo de variación para que los workers no se reinicien todos a la vez
+        max_requests = self.max_requests + random.randint(0, self.max_requests // 10) if self.max_requests else 0
+        server = _BoundedThreadedWSGIServer(
+            self.host, self.port, self.app, fd=self._socket.fileno(),
+            max_threads=self.threads, max_requests=max_requests,
+            on_limit=lambda: threading.Thread(target=server.shutdown, daemon=True).start()
+        )
+        # shutdown() espera a que serve_forever termine: se llama desde otro hilo
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown,
+                                                                             daemon=True).start())
+        server.serve_forever()
+        server.server_close()
@@ -37,6 +37,21 @@ def create_swagger_models(api):
         'test_date': fields.String(description='Fecha del examen (ISO)', example='2025-01-15T08:00:00.000Z')
     })
     
+    # Modelo de examen para importación masiva
+    bulk_blood_test_model = api.model('BulkBloodTestInput', {
+        name: field for name, field in blood_test_input_model.items() if name != 'user_id'
+    })
+    
+    # Modelo de usuario para importación masiva
+    bulk_user_model = api.inherit('BulkUserInput', user_input_model, {
+        'blood_tests': fields.List(fields.Nested(bulk_blood_test_model), description='Exámenes previos del usuario')
+    })
+    
+    # Modelo para importación masiva
+    bulk_import_input_model = api.model('BulkImportInput', {
+        'users': fields.List(fields.Nested(bulk_user_model), required=True, description='Usuarios a importar (máximo 1000)')
+    })
+    
     # Modelo de recomendación
     recommendation_model = api.model('Recommendation', {
         'type': fields.String(description='Tipo de recomendación', enum=['dietary', 'exercise', 'medication', 'medical_consultation', 'lifestyle']),
@@ -54,7 +69,8 @@ def create_swagger_models(api):
         'blood_count_status': fields.String(description='Estado del hemograma', example='Normal - Hemograma completo dentro de rangos normales'),
         'recommendations': fields.List(fields.Nested(recommendation_model), description='Lista de recomendaciones'),
         'needs_doctor_consultation': fields.Boolean(description='Requiere consulta médica', example=False),
-        'risk_factors': fields.List(fields.String, description='Factores de riesgo identificados', example=['Edad de riesgo cardiovascular'])
+        'risk_factors': fields.List(fields.String, description='Factores de riesgo identificados', example=['Edad de riesgo cardiovascular']),
+        'reference_ranges_version': fields.String(description='Versión del ruleset de rangos de referencia aplicado', example='2025.1')
     })
     
     # Modelo de respuesta de análisis
@@ -91,7 +107,9 @@ def create_swagger_models(api):
         'id': fields.String(description='ID de la conversación'),
         'blood_test_id': fields.String(description='ID del examen asociado'),
         'created_at': fields.String(description='Fecha de creación'),
-        'message_count': fields.Integer(description='Número de mensajes')
+        'message_count': fields.Integer(description='Número de mensajes'),
+        'last_message_at': fields.String(description='Fecha del último mensaje'),
+        'last_sender': fields.String(description='Emisor del último mensaje (user o assistant)')
     })
     
     # Modelo de historial de usuario
@@ -121,6 +139,7 @@ def create_swagger_models(api):
         'user_input': user_input_model,
         'user_response': user_response_model,
         'blood_test_input': blood_test_input_model,
+        'bulk_import_input': bulk_import_input_model,
         'blood_test_response': blood_test_response_model,
         'blood_analysis': blood_analysis_model,
         'recommendation': recommendation_model,
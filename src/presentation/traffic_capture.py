@@ -0,0 +1,58 @@
+import gzip
+import json
+from time import perf_counter, time
+from typing import Any
+from flask import Flask, Response, g, request
+from ..infrastructure.traffic_capture import TrafficCaptureLog
+from .http_caching import brotli
+from .security import is_admin_request
+
+def register_traffic_capture(app: Flask, capture_log: TrafficCaptureLog):
+    """Registrar cada petición a /api en el log de captura anonimizado (TRAFFIC_CAPTURE_ENABLED)"""
+
+    @app.before_request
+    def start_traffic_capture():
+        route = request.url_rule.rule if request.url_rule else None
+        # El WebSocket de chat no se puede reproducir como una petición HTTP
+        if route is None or not route.startswith('/api/') or request.headers.get('Upgrade', '').lower() == 'websocket':
+            return
+        g.capture_arrival = time()
+        g.capture_start = perf_counter()
+
+    @app.after_request
+    def record_traffic_capture(response):
+        start = g.pop('capture_start', None)
+        if start is None:
+            return response
+
+        query = {key: int(value) if value.isdigit() else value for key, value in request.args.items()}
+        entry = {
+            'ts': round(g.pop('capture_arrival'), 6),
+            'method': request.method,
+            'route': request.url_rule.rule,
+            'params': capture_log.anonymize(request.view_args or {}),
+            'query': capture_log.anonymize(query),
+            'body': capture_log.anonymize(request.get_json(silent=True)) if request.is_json else None,
+            'admin': is_admin_request(),
+            'status': response.status_code,
+            'duration_ms': round((perf_counter() - start) * 1000, 3),
+            'response_bytes': None if response.is_streamed else response.calculate_content_length()
+        }
+        # Ids creados por la petición, para que la reproducción asocie las peticiones posteriores
+        if request.method == 'POST' and response.status_code < 300 and response.is_json and not response.is_streamed:
+            entry['created'] = capture_log.created_ids(_response_json(response))
+        capture_log.write(entry)
+        return response
+
+def _response_json(response: Response) -> Any:
+    # Este hook se registra antes que la compresión, así que se ejecuta después de ella
+    data = response.get_data()
+    encoding = response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif encoding == 'br' and brotli is not None:
+        data = brotli.decompress(data)
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
@@ -0,0 +1,90 @@
+"""
+Canal WebSocket para conversaciones de varios turnos con respuestas en streaming
+"""
+import json
+from typing import Optional
+from flask import Flask
+from ..application.use_cases import ChatWithUserUseCase
+from ..application.schemas import ChatMessageRequest, RequestValidationError
+from ..infrastructure.rate_limiting import SlidingWindowRateLimiter, AdmissionController
+
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:  # flask-sock es opcional; sin él no se registra el WebSocket
+    Sock = None
+
+CHAT_WEBSOCKET_ROUTE = '/api/chat/<string:conversation_id>/ws'
+
+def register_chat_websocket(app: Flask, chat_with_user_use_case: ChatWithUserUseCase,
+                            user_limiter: Optional[SlidingWindowRateLimiter] = None,
+                            admission: Optional[AdmissionController] = None) -> bool:
+    """
+    Registra el WebSocket de chat. Protocolo (JSON por mensaje):
+      cliente -> {"message": "..."}
+      servidor -> {"type": "ready"} al cargar el contexto,
+                  {"type": "token", "content": "..."} por cada fragmento,
+                  {"type": "done", "assistant_response": "...", "timestamp": "..."} al guardar la respuesta,
+                  {"type": "error", "error": "..."} ante un error del turno
+    """
+    if Sock is None:
+        return False
+
+    sock = Sock(app)
+
+    def send(ws, payload):
+        ws.send(json.dumps(payload, ensure_ascii=False))
+
+    @sock.route(CHAT_WEBSOCKET_ROUTE)
+    def chat_websocket(ws, conversation_id):
+        try:
+            # El contexto (conversación, usuario, examen y análisis) se carga una sola vez
+            session = chat_with_user_use_case.open_session(conversation_id)
+        except ValueError as e:
+            send(ws, {'type': 'error', 'error': str(e)})
+            ws.close()
+            return
+
+        send(ws, {'type': 'ready', 'conversation_id': conversation_id})
+
+        try:
+            while True:
+                raw = ws.receive()
+                try:
+                    message_request = ChatMessageRequest.parse(json.loads(raw))
+                except (ValueError, TypeError) as e:
+                    error = str(e) if isinstance(e, RequestValidationError) else 'JSON inválido'
+                    send(ws, {'type': 'error', 'error': error})
+                    continue
+
+                if user_limiter is not None:
+                    allowed, retry_after = user_limiter.hit(f'user:{session.context.user_id}')
+                    if not allowed:
+                        send(ws, {'type': 'error', 'error': 'Demasiadas solicitudes para este usuario',
+                                  'retry_after': retry_after})
+                        continue
+
+                if admission is not None and not admission.try_acquire():
+                    send(ws, {'type': 'error', 'error': 'Servicio sobrecargado, intenta de nuevo más tarde',
+                              'retry_after': admission.retry_after_seconds})
+                    continue
+
+                try:
+                    result = _stream_turn(ws, session, message_request, send)
+                finally:
+                    if admission is not None:
+                        admission.release()
+                send(ws, {'type': 'done', **result})
+        except ConnectionClosed:
+            pass
+
+    return True
+
+def _stream_turn(ws, session, message_request, send):
+    """Envía cada fragmento de la respuesta y devuelve el resultado del turno ya guardado"""
+    reply = session.stream_reply(message_request)
+    while True:
+        try:
+            chunk = next(reply)
+        except StopIteration as finished:
+            return finished.value
+        send(ws, {'type': 'token', 'content': chunk})